@@ -0,0 +1,117 @@
+import tempfile
+import zipfile
+
+# Служебные записи ZIP: локальный и центральный заголовки на файл и конец каталога
+ZIP_ENTRY_OVERHEAD = 30 + 46
+ZIP_END_OVERHEAD = 22
+
+
+class ArchivePart:
+    """Готовая часть архива во временном файле"""
+
+    def __init__(self, number: int, file, names: list[str]):
+        self.number = number
+        self.file = file
+        self.names = names
+
+    @property
+    def size(self) -> int:
+        self.file.seek(0, 2)
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class SplitZipWriter:
+    """
+    Пишет файлы в ZIP-архив во временном файле (в памяти до spool_size,
+    дальше на диске). Если следующий файл может вывести архив за limit,
+    текущая часть закрывается и начинается новая. Файл, который не влезает
+    в limit даже один, пропускается и попадает в skipped
+    """
+
+    def __init__(self, limit: int, spool_size: int = 8 * 1024 * 1024,
+                 compression: int = zipfile.ZIP_DEFLATED):
+        """
+        :param limit: Максимальный размер одной части в байтах
+        :param spool_size: Сколько держать в памяти до сброса во временный файл
+        :param compression: Метод сжатия zipfile
+        """
+        self.limit = limit
+        self.spool_size = spool_size
+        self.compression = compression
+        self.parts_count = 0
+        self._file = None
+        self._zip = None
+        self._names = []
+        self._directory_size = 0
+        self.skipped = []
+
+    def _open(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self._zip = zipfile.ZipFile(self._file, 'w', compression=self.compression)
+        self._names = []
+        self._directory_size = ZIP_END_OVERHEAD
+
+    def _compressed_bound(self, data: bytes) -> int:
+        size = len(data)
+        if self.compression == zipfile.ZIP_DEFLATED:
+            # Верхняя граница deflate (deflateBound из zlib): несжимаемые данные
+            # уходят блоками stored с заголовком на каждые 16 КБ
+            return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+        return size
+
+    def _size(self) -> int:
+        # Центральный каталог допишется при закрытии части
+        return self._file.tell() + self._directory_size
+
+    def _projected_size(self, name: str, data: bytes) -> int:
+        entry_size = 2 * len(name.encode()) + ZIP_ENTRY_OVERHEAD
+        return self._size() + self._compressed_bound(data) + entry_size
+
+    def add(self, name: str, data: bytes) -> list[ArchivePart]:
+        """
+        Добавляет файл в архив
+        :return: Части, закрытые при добавлении (пустой список или одна часть)
+        """
+        finished = []
+        if self._zip is not None and self._names and self._projected_size(name, data) > self.limit:
+            finished.append(self._finish())
+        if self._zip is None:
+            self._open()
+        self._zip.writestr(name, data)
+        self._names.append(name)
+        self._directory_size += len(name.encode()) + 46
+        if self._size() > self.limit:
+            # Граница не пустила бы файл в непустую часть, значит, он в части один
+            self.discard()
+            self.skipped.append(name)
+        return finished
+
+    def _finish(self) -> ArchivePart:
+        self._zip.close()
+        self._file.seek(0)
+        self.parts_count += 1
+        part = ArchivePart(self.parts_count, self._file, self._names)
+        self._file = None
+        self._zip = None
+        return part
+
+    def close(self):
+        """
+        Закрывает последнюю часть
+        :return: ArchivePart или None, если в неё ничего не добавлено
+        """
+        if self._zip is None:
+            return None
+        return self._finish()
+
+    def discard(self):
+        """Удаляет незаконченную часть"""
+        if self._zip is not None:
+            self._zip.close()
+            self._file.close()
+            self._file = None
+            self._zip = None
+            self._names = []
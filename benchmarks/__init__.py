@@ -0,0 +1,5 @@
+"""
+Замеры производительности без настоящей клавиатуры:
+source — синтетические потоки событий, ports — замена входных портов mido,
+runs — сценарии замеров, запуск: python -m benchmarks --sizes 10k,1M
+"""
@@ -0,0 +1,77 @@
+import argparse
+import json
+import logging
+import platform
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.runs import SIZES, run
+
+log = logging.getLogger()
+
+
+def version() -> str:
+    """Версия кода для сравнения результатов: git describe или None вне репозитория"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results: list[dict], baseline_path: str):
+    """Печатает изменение времени относительно прошлого файла результатов"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["name"], r["rows"]): r["seconds"] for r in baseline["results"]}
+    print(f"Сравнение с {baseline.get('version')} ({baseline.get('created')})")
+    for result in results:
+        before = previous.get((result["name"], result["rows"]))
+        if before:
+            print(f"  {result['name']} [{result['rows']}]: {before:.3f} -> {result['seconds']:.3f} s "
+                  f"({result['seconds'] / before - 1:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры записи и выгрузки MIDI-логов")
+    parser.add_argument("--sizes", default="10k", help=f"Размеры через запятую: {', '.join(SIZES)}")
+    parser.add_argument("--output", default="benchmark_results.json", help="Файл результатов (JSON)")
+    parser.add_argument("--compare", help="Прошлый файл результатов для сравнения")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--capture-seconds", type=float, default=5.0, help="Длительность захвата, 0 — пропустить")
+    parser.add_argument("--capture-ports", type=int, default=2)
+    parser.add_argument("--capture-rate", type=float, default=200.0, help="Событий в секунду на порт")
+    parser.add_argument("--dir", help="Каталог для временных БД")
+    args = parser.parse_args()
+
+    # data_engine и midi_logger при импорте уже вешают обработчики на корневой логгер
+    if not log.handlers:
+        logging.basicConfig(format="%(message)s")
+    log.setLevel(logging.INFO)
+    sizes = [size.strip() for size in args.sizes.split(",")]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"Unknown sizes: {', '.join(unknown)}")
+
+    results = run(sizes, args.seed, args.capture_seconds, args.capture_ports, args.capture_rate, args.dir)
+    report = {
+        "version": version(),
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    log.info(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
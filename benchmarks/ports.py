@@ -0,0 +1,108 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import mido
+
+from benchmarks.source import SyntheticSource
+from data_engine import NS_PER_SEC
+
+
+class FakeInputPort:
+    """
+    Замена входного порта mido: отдаёт события SyntheticSource в реальном
+    времени. С callback события доставляет отдельный поток, как у бэкенда,
+    без него — iter_pending для опроса
+    """
+
+    def __init__(self, name: str, source: SyntheticSource, callback=None, limit: int = None,
+                 speed: float = 1.0):
+        """
+        :param limit: Сколько событий отдать, None — без ограничения
+        :param speed: Множитель скорости воспроизведения потока
+        """
+        self.name = name
+        self.closed = False
+        self.sent = 0
+        self.done = threading.Event()
+        self._events = source.events(limit) if limit is not None else source.events(2 ** 62)
+        self._speed = speed
+        self._started = time.monotonic_ns()
+        self._next = next(self._events, None)
+        self._thread = None
+        if callback is not None:
+            self._thread = threading.Thread(target=self._pump, args=(callback,), daemon=True)
+            self._thread.start()
+
+    def _due(self) -> int:
+        return self._started + int(self._next[0] / self._speed)
+
+    def _advance(self) -> mido.Message:
+        message = self._next[1]
+        self.sent += 1
+        self._next = next(self._events, None)
+        if self._next is None:
+            self.done.set()
+        return message
+
+    def _pump(self, callback):
+        while not self.closed and self._next is not None:
+            delay = self._due() - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / NS_PER_SEC)
+            callback(self._advance())
+
+    def iter_pending(self):
+        now = time.monotonic_ns()
+        while not self.closed and self._next is not None and self._due() <= now:
+            yield self._advance()
+
+    def close(self):
+        self.closed = True
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __str__(self):
+        # Как у портов mido: имя устройства берётся из name, а не из str(port)
+        state = "closed" if self.closed else "open"
+        return f"<{state} input {self.name!r} (fake)>"
+
+
+class FakeInputs:
+    """
+    Замена mido.open_input: открывает FakeInputPort по имени. Сериализуется pickle,
+    поэтому годится и для процессов захвата; в процесс попадают только источники
+    """
+
+    def __init__(self, sources: dict[str, SyntheticSource], limit: int = None, speed: float = 1.0):
+        self.sources = sources
+        self.limit = limit
+        self.speed = speed
+        # Имя -> последний открытый в этом процессе FakeInputPort
+        self.opened = {}
+
+    def __call__(self, name: str, callback=None) -> FakeInputPort:
+        port = self.opened[name] = FakeInputPort(name, self.sources[name], callback, self.limit, self.speed)
+        return port
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "opened": {}}
+
+
+@contextmanager
+def fake_inputs(sources: dict[str, SyntheticSource], limit: int = None, speed: float = 1.0):
+    """
+    Подменяет mido.get_input_names и mido.open_input, чтобы MidiLogApp
+    работал с синтетическими портами. В режиме "process" тот же FakeInputs
+    нужно передать в MidiLogApp как open_input: процессы захвата подмену не видят
+    :param sources: Имя порта -> источник событий
+    :return: FakeInputs, в opened — порты, открытые в этом процессе
+    """
+    inputs = FakeInputs(sources, limit, speed)
+    saved = mido.get_input_names, mido.open_input
+    mido.get_input_names = lambda: list(sources)
+    mido.open_input = inputs
+    try:
+        yield inputs
+    finally:
+        mido.get_input_names, mido.open_input = saved
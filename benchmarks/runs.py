@@ -0,0 +1,188 @@
+import itertools
+import logging
+import random
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from archive import SplitZipWriter
+from benchmarks.ports import fake_inputs
+from benchmarks.source import SyntheticSource
+from data_engine import MidiLog
+from midi_logger import MidiLogApp
+
+log = logging.getLogger()
+
+SIZES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+
+# Сколько событий генерировать заранее; дальше шаблон повторяется со сдвигом времени
+PATTERN_SIZE = 100_000
+# Режим sync делает commit на каждое событие, на больших объёмах он бесполезно долгий
+SYNC_LIMIT = 10_000
+# Лимит части архива, как у бота
+ZIP_PART_SIZE = 50 * 1024 * 1024
+SESSION_SAMPLES = 20
+
+
+def _result(name: str, rows: int, seconds: float, **extra) -> dict:
+    result = {"name": name, "rows": rows, "seconds": round(seconds, 6)}
+    result.update(extra)
+    log.info(f"{name} [{rows}]: {seconds:.3f} s {extra or ''}")
+    return result
+
+
+def _timings(samples: list[float]) -> dict:
+    """Сводка по замерам в миллисекундах"""
+    return {
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+
+def ingest(midi_log: MidiLog, source: SyntheticSource, count: int, device: str = "bench") -> float:
+    """
+    Пишет count событий через add_messages с метками, заканчивающимися сейчас,
+    и ждёт, пока всё окажется в БД
+    :return: Время в секундах
+    """
+    pattern = list(source.events(min(count, PATTERN_SIZE)))
+    cycle = pattern[-1][0] + int(source.session_gap * 1e9)
+    cycles = -(-count // len(pattern))
+    start_ns = time.time_ns() - cycles * cycle
+    events = itertools.islice(
+        ((start_ns + n * cycle + ts, message) for n in range(cycles) for ts, message in pattern), count
+    )
+
+    add_messages = midi_log.add_messages
+    started = time.perf_counter()
+    for ts, message in events:
+        add_messages(device, message, ts)
+    midi_log.flush()
+    return time.perf_counter() - started
+
+
+def bench_ingest(directory: Path, count: int, seed: int) -> tuple[list[dict], MidiLog]:
+    """
+    Пропускная способность add_messages. БД после режима batch
+    остаётся для следующих замеров
+    """
+    results = []
+    if count <= SYNC_LIMIT:
+        with MidiLog(writer_mode="sync", db_path=str(directory / "sync.db")) as midi_log:
+            seconds = ingest(midi_log, SyntheticSource(seed=seed), count)
+        results.append(_result("add_messages_sync", count, seconds, events_per_sec=round(count / seconds)))
+
+    midi_log = MidiLog(writer_mode="batch", db_path=str(directory / "batch.db"))
+    seconds = ingest(midi_log, SyntheticSource(seed=seed), count)
+    results.append(_result("add_messages_batch", count, seconds, events_per_sec=round(count / seconds)))
+    return results, midi_log
+
+
+def bench_export(midi_log: MidiLog, count: int) -> list[dict]:
+    """get_midi_logs за день и за всё время: с холодным и прогретым кешем, плюс сборка ZIP"""
+    results = []
+    for days in (1, 0):
+        midi_log.cache.clear()
+        started = time.perf_counter()
+        sessions = midi_log.get_midi_logs(days)
+        cold = time.perf_counter() - started
+
+        started = time.perf_counter()
+        midi_log.get_midi_logs(days)
+        warm = time.perf_counter() - started
+
+        size = sum(len(session[1]) for session in sessions)
+        results.append(_result(f"get_midi_logs_{days}d", count, cold, warm_seconds=round(warm, 6),
+                               sessions=len(sessions), bytes=size))
+
+        writer = SplitZipWriter(limit=ZIP_PART_SIZE)
+        parts = []
+        started = time.perf_counter()
+        for name, data, *_ in sessions:
+            parts.extend(writer.add(name, data))
+        last = writer.close()
+        if last:
+            parts.append(last)
+        seconds = time.perf_counter() - started
+        archive_size = sum(part.size for part in parts)
+        for part in parts:
+            part.close()
+        results.append(_result(f"zip_{days}d", count, seconds, parts=len(parts), bytes=archive_size))
+    return results
+
+
+def bench_session_by_id(midi_log: MidiLog, count: int, seed: int) -> list[dict]:
+    """get_session_by_id для случайных сессий: первый вызов и повторный из кеша"""
+    with midi_log.readers.cursor() as cur:
+        cur.execute("SELECT id FROM sessions")
+        ids = [row[0] for row in cur.fetchall()]
+    if not ids:
+        return []
+    sample = random.Random(seed).sample(ids, min(SESSION_SAMPLES, len(ids)))
+
+    midi_log.cache.clear()
+    cold, warm = [], []
+    for session_id in sample:
+        for timings in (cold, warm):
+            started = time.perf_counter()
+            midi_log.get_session_by_id(session_id)
+            timings.append(time.perf_counter() - started)
+    return [
+        _result("get_session_by_id", count, sum(cold), samples=len(sample), **_timings(cold)),
+        _result("get_session_by_id_cached", count, sum(warm), samples=len(sample), **_timings(warm)),
+    ]
+
+
+def bench_capture(directory: Path, capture_mode: str, ports: int, rate: float, seconds: float,
+                  seed: int) -> dict:
+    """
+    Захват с синтетических портов через MidiLogApp в реальном времени
+    :return: Результат с задержкой до записи на диск из метрик логгера
+    """
+    sources = {f"bench {n}": SyntheticSource(rate=rate, seed=seed + n, channel=n % 16) for n in range(ports)}
+    with fake_inputs(sources) as inputs:
+        app = MidiLogApp(capture_mode, stats_port=None, db_path=str(directory / f"capture_{capture_mode}.db"),
+                         open_input=inputs)
+        thread = threading.Thread(target=app.process, daemon=True)
+        thread.start()
+        time.sleep(seconds)
+        app.stop()
+        thread.join()
+    snapshot = app.metrics.snapshot()
+    app.close()
+    return _result(
+        f"capture_{capture_mode}", snapshot["events"], seconds,
+        ports=ports, rate=rate,
+        storage_delay=snapshot["storage_delay"], commit_latency=snapshot["commit_latency"],
+    )
+
+
+def run(sizes: list[str], seed: int = 0, capture_seconds: float = 5.0, capture_ports: int = 2,
+        capture_rate: float = 200.0, directory: str = None) -> list[dict]:
+    """
+    Полный прогон: захват, затем для каждого размера запись, выгрузка и чтение сессий
+    :param sizes: Ключи SIZES
+    :param directory: Где создавать БД, по умолчанию временный каталог
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        tmp = Path(tmp)
+        if capture_seconds:
+            for capture_mode in ("callback", "poll", "process"):
+                results.append(bench_capture(tmp, capture_mode, capture_ports, capture_rate, capture_seconds, seed))
+
+        for size in sizes:
+            count = SIZES[size]
+            size_dir = tmp / size
+            size_dir.mkdir()
+            ingest_results, midi_log = bench_ingest(size_dir, count, seed)
+            results.extend(ingest_results)
+            try:
+                results.extend(bench_export(midi_log, count))
+                results.extend(bench_session_by_id(midi_log, count, seed))
+            finally:
+                midi_log.close()
+    return results
@@ -0,0 +1,99 @@
+import random
+from typing import Iterator
+
+import mido
+
+from data_engine import NS_PER_SEC
+
+
+class SyntheticSource:
+    """
+    Поток событий, похожий на игру на клавишах: ноты парами note_on/note_off
+    вокруг медленно плавающего центра, педаль (CC 64), модуляция (CC 1)
+    и серии pitch bend. Игра идёт сессиями с паузами между ними
+    """
+
+    def __init__(self, rate: float = 20.0, seed: int = 0, channel: int = 0,
+                 session_length: float = 1800.0, session_gap: float = 600.0,
+                 cc_share: float = .1, bend_share: float = .1):
+        """
+        :param rate: Средняя частота событий во время игры, событий в секунду
+        :param seed: Зерно генератора, одинаковое зерно — одинаковый поток
+        :param channel: MIDI-канал (0-15)
+        :param session_length: Длительность сессии, секунды
+        :param session_gap: Пауза между сессиями, секунды
+        :param cc_share: Доля событий CC
+        :param bend_share: Доля событий pitch bend
+        """
+        self.rate = rate
+        self.channel = channel
+        self.session_length = session_length
+        self.session_gap = session_gap
+        self.cc_share = cc_share
+        self.bend_share = bend_share
+        self._random = random.Random(seed)
+        self._held = []
+        self._center = 60.0
+        self._sustain = False
+        self._modulation = 0
+        self._bend = 0
+
+    def _note(self) -> mido.Message:
+        rnd = self._random
+        # Отпускаем, если зажато много нот, иначе примерно через раз
+        if self._held and (len(self._held) >= 6 or rnd.random() < .5):
+            note = self._held.pop(rnd.randrange(len(self._held)))
+            # Часть клавиатур отпускает ноту через note_on с velocity=0
+            if rnd.random() < .3:
+                return mido.Message('note_on', channel=self.channel, note=note, velocity=0)
+            return mido.Message('note_off', channel=self.channel, note=note, velocity=64)
+
+        self._center = min(max(self._center + rnd.gauss(0, .5), 36), 84)
+        note = int(min(max(rnd.gauss(self._center, 7), 21), 108))
+        if note in self._held:
+            self._held.remove(note)
+        self._held.append(note)
+        velocity = int(min(max(rnd.gauss(72, 18), 1), 127))
+        return mido.Message('note_on', channel=self.channel, note=note, velocity=velocity)
+
+    def _control(self) -> mido.Message:
+        if self._random.random() < .3:
+            self._sustain = not self._sustain
+            return mido.Message('control_change', channel=self.channel, control=64,
+                                value=127 if self._sustain else 0)
+        self._modulation = (self._modulation + self._random.randint(1, 8)) % 128
+        return mido.Message('control_change', channel=self.channel, control=1, value=self._modulation)
+
+    def _pitch_bend(self) -> mido.Message:
+        # Колесо уходит от нуля и возвращается обратно
+        step = self._random.randint(200, 1200)
+        self._bend = 0 if abs(self._bend) > 6000 else self._bend + step * self._random.choice((-1, 1))
+        return mido.Message('pitchwheel', channel=self.channel, pitch=self._bend)
+
+    def message(self) -> mido.Message:
+        r = self._random.random()
+        if r < self.cc_share:
+            return self._control()
+        if r < self.cc_share + self.bend_share:
+            return self._pitch_bend()
+        return self._note()
+
+    def events(self, count: int, start_ns: int = 0) -> Iterator[tuple[int, mido.Message]]:
+        """
+        :param count: Количество событий
+        :param start_ns: Метка первого события
+        :return: Пары (метка в наносекундах, сообщение), метки не убывают
+        """
+        ts = start_ns
+        session_end = start_ns + int(self.session_length * NS_PER_SEC)
+        for _ in range(count):
+            ts += int(self._random.expovariate(self.rate) * NS_PER_SEC)
+            if ts >= session_end:
+                ts += int(self.session_gap * NS_PER_SEC)
+                session_end = ts + int(self.session_length * NS_PER_SEC)
+            yield ts, self.message()
+
+    def span(self, count: int) -> int:
+        """Примерная длительность count событий с паузами, наносекунды"""
+        play = count / self.rate
+        return int(play * (1 + self.session_gap / self.session_length) * NS_PER_SEC)
@@ -1,14 +1,14 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-import io
+import asyncio
+import json
 import logging
 import os
-import zipfile
 from collections import defaultdict
 from contextlib import suppress
 from datetime import datetime
 from pathlib import Path
 from typing import List
-import matplotlib.pyplot as plt
+from urllib.request import urlopen
 
 import mido
 from aiogram import Bot, Dispatcher, types, F
@@ -17,7 +17,10 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import Message
 from mido import MidiFile
 
-from data_engine import MidiLog
+from archive import SplitZipWriter
+from data_engine import AsyncMidiLog, MidiLog
+from playback import PlayerService, midi_file_events
+from visualization import NoteRenderer
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,6 +33,13 @@ logger = logging.getLogger(__name__)
 TEMP_DIR = "temp_midi"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Лимиты Telegram на размер отправляемого файла и длину подписи к нему
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+MAX_CAPTION_LENGTH = 1024
+
+# Эндпоинт статистики логгера (midi_logger.py)
+STATS_URL = os.environ.get("stats_url", "http://127.0.0.1:8765/stats")
+
 # Глобальные переменные для хранения состояния
 active_ports = {}
 output_devices_cache = []
@@ -45,12 +55,17 @@ dp = Dispatcher()
 
 # Инициализация подключения к БД
 try:
-    db = MidiLog()
+    # Запросы к БД выполняются в пуле потоков, чтобы не блокировать event loop
+    db = AsyncMidiLog(MidiLog())
+    note_renderer = NoteRenderer(db)
     logger.info("Успешное подключение к БД")
 except Exception as e:
     logger.error(f"Ошибка подключения к БД: {e}")
     raise
 
+# Воспроизведение идёт в потоках плеера, порты остаются открытыми между запусками
+player = PlayerService()
+
 
 # Клавиатура с кнопками
 def get_period_keyboard():
@@ -93,6 +108,13 @@ async def process_callback(callback_query: types.CallbackQuery):
         }.get(period, 1)
 
         await callback_query.answer(f"Загружаю MIDI за {period}...")
+
+        # Итоги берутся из дневных сводок, события для них не читаются
+        with suppress(asyncio.TimeoutError):
+            summary = await db.get_practice_summary(days)
+            if summary:
+                await callback_query.message.reply(format_practice_summary(summary))
+
         await send_midi_files(callback_query.message, days)
     except Exception as e:
         logger.error(f"Ошибка в process_callback: {e}")
@@ -122,77 +144,195 @@ def format_notes_count(notes: int) -> str:
     return f"{formatted_num} {word}"
 
 
-async def send_midi_files(message: types.Message, days: int, input_name: str = None):
-    try:
-        # Теперь получаем кортеж (name, data, notes_count, formatted_date, formatted_time)
-        midi_sessions = db.get_midi_logs(days, input_name)
+def format_duration(seconds: float) -> str:
+    """Длительность в часах и минутах"""
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин"
+
+
+def format_practice_summary(summary: dict) -> str:
+    """
+    Итоги занятий за период
+    :param summary: {дата: (секунды игры, сессий, нот)} из get_practice_summary
+    """
+    play_time = sum(day[0] for day in summary.values())
+    sessions = sum(day[1] for day in summary.values())
+    notes = sum(day[2] for day in summary.values())
+    lines = [f"📈 Итого: {format_duration(play_time)}, сессий: {sessions}, {format_notes_count(notes)}"]
+
+    # По дням показываем только последнюю неделю
+    if len(summary) > 1:
+        for date, (day_time, day_sessions, day_notes) in list(summary.items())[-7:]:
+            lines.append(f"  {date.strftime('%d.%m.%Y')}: {format_duration(day_time)}, сессий: {day_sessions}")
+    return "\n".join(lines)
+
+
+def format_file_list(sessions: list, start_number: int = 1) -> str:
+    """
+    Список сессий, сгруппированный по датам (свежие сверху)
+    :param sessions: Словари с ключами 'time', 'notes', 'name', 'date'
+    """
+    date_sessions = defaultdict(list)
+    for session in sessions:
+        date_sessions[session['date']].append(session)
+
+    # Сортируем сессии по времени внутри дат
+    for date in date_sessions:
+        date_sessions[date].sort(key=lambda x: x['time'])
+
+    file_list = []
+    current_number = start_number
+
+    for date, date_items in sorted(date_sessions.items(),
+                                   key=lambda x: datetime.strptime(x[0], "%d.%m.%Y"),
+                                   reverse=True):
+        file_list.append(f"\n📅 {date}:")
+        for session in date_items:
+            notes_text = format_notes_count(session['notes'])
+            file_list.append(f"  {current_number}. Сессия {session['time']} ({notes_text})")
+            current_number += 1
+
+    return "\n".join(file_list)
+
+
+def format_caption(title: str, sessions: list, start_number: int = 1) -> str:
+    """
+    Подпись к файлу: заголовок и список сессий, обрезанный до MAX_CAPTION_LENGTH
+    :param title: Первая строка подписи
+    :param sessions: Словари для format_file_list
+    """
+    caption = title + format_file_list(sessions, start_number)
+    if len(caption) <= MAX_CAPTION_LENGTH:
+        return caption
+
+    lines = caption.split("\n")
+    total = len(sessions)
+    shown = 0
+    kept = []
+    length = 0
+    for line in lines:
+        is_session = line.startswith("  ")
+        # Запас под строку с числом пропущенных сессий
+        tail = len(f"\n… и ещё {total - shown - is_session}")
+        if length + len(line) + 1 + tail > MAX_CAPTION_LENGTH:
+            break
+        kept.append(line)
+        length += len(line) + 1
+        shown += is_session
+    kept.append(f"… и ещё {total - shown}")
+    return "\n".join(kept)
+
+
+class SpooledInputFile(types.InputFile):
+    """Загрузка части архива из временного файла порциями, без копии в памяти"""
+
+    def __init__(self, file, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot: Bot):
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
 
-        if not midi_sessions:
-            await message.reply("🚫 Нет данных за указанный период или устройство.",
-                                reply_markup=get_period_keyboard())
-            return
 
-        # Группируем по датам и считаем общее количество нот
-        date_sessions = defaultdict(list)
-        total_notes = sum(session[2] for session in midi_sessions)
+async def send_midi_files(message: types.Message, days: int, input_name: str = None):
+    # Сессии рендерятся в пуле БД и через небольшую очередь уходят на сжатие
+    # в отдельный поток; готовые части архива отправляются сразу
+    sessions_queue = asyncio.Queue(maxsize=4)
+    writer = SplitZipWriter(limit=MAX_UPLOAD_SIZE)
+
+    async def produce():
+        try:
+            async for session in db.iter_midi_logs(days, input_name):
+                await sessions_queue.put(session)
+        except asyncio.CancelledError:
+            # Отменяет только потребитель: ждать его в полной очереди некому
+            raise
+        except Exception:
+            await sessions_queue.put(None)
+            raise
+        await sessions_queue.put(None)
+
+    async def send_part(part, part_sessions: list, start_number: int):
+        try:
+            await message.reply_document(
+                document=SpooledInputFile(
+                    part.file,
+                    filename=f"midi_sessions_{days}_days_part{part.number}.zip"
+                ),
+                caption=format_caption(f"📦 Часть {part.number}, файлы в архиве:\n", part_sessions, start_number)
+            )
+        finally:
+            part.close()
 
-        for name, data, notes_count, formatted_date, formatted_time in midi_sessions:
-            date_sessions[formatted_date].append({
+    producer = asyncio.create_task(produce())
+    try:
+        sessions = []  # подписи сессий текущей части
+        sent_count = 0  # сессий в уже отправленных частях
+        first_session = None
+
+        while (session := await sessions_queue.get()) is not None:
+            name, data, notes_count, formatted_date, formatted_time = session
+            skipped = len(writer.skipped)
+            for part in await asyncio.to_thread(writer.add, name, data):
+                # Подписи новой сессии уже относятся к следующей части
+                await send_part(part, sessions, sent_count + 1)
+                sent_count += len(sessions)
+                sessions = []
+            if len(writer.skipped) > skipped:
+                continue
+
+            if first_session is None:
+                first_session = (name, data)
+            sessions.append({
                 'time': formatted_time,
                 'notes': notes_count,
                 'name': name,
-                'data': data
+                'date': formatted_date
             })
+        await producer
 
-        # Сортируем сессии по времени внутри дат
-        for date in date_sessions:
-            date_sessions[date].sort(key=lambda x: x['time'])
-
-        # Формируем список файлов
-        file_list = []
-        current_number = 1
-
-        for date, sessions in sorted(date_sessions.items(),
-                                     key=lambda x: datetime.strptime(x[0], "%d.%m.%Y"),
-                                     reverse=True):
-            file_list.append(f"\n📅 {date}:")
-            for session in sessions:
-                notes_text = format_notes_count(session['notes'])
-                file_list.append(f"  {current_number}. Сессия {session['time']} ({notes_text})")
-                current_number += 1
-
-        file_list_text = "\n".join(file_list)
-        total_notes_text = format_notes_count(total_notes)
+        if writer.skipped:
+            await message.reply(f"⚠️ Сессии больше лимита Telegram не отправлены: {', '.join(writer.skipped)}")
+        if not sent_count and not sessions:
+            if writer.skipped:
+                return
+            await message.reply("🚫 Нет данных за указанный период или устройство.",
+                                reply_markup=get_period_keyboard())
+            return
 
         # Отправка результата
-        if len(midi_sessions) == 1:
-            session = midi_sessions[0]
+        if not sent_count and len(sessions) == 1:
+            writer.discard()
+            name, data = first_session
             await message.reply_document(
-                document=types.BufferedInputFile(session[1], filename=session[0]),
-                caption=f"🎵 MIDI-сессия: {file_list_text}"
+                document=types.BufferedInputFile(data, filename=name),
+                caption=format_caption("🎵 MIDI-сессия: ", sessions)
             )
-        else:
-            with io.BytesIO() as zip_bytes:
-                with zipfile.ZipFile(zip_bytes, 'w') as zipf:
-                    for session in midi_sessions:
-                        zipf.writestr(session[0], session[1])
-
-                zip_data = zip_bytes.getvalue()
-                if len(zip_data) > 50 * 1024 * 1024:
-                    await message.reply("⚠️ Архив слишком большой для отправки")
-                    return
-
+        elif not sent_count:
+            part = await asyncio.to_thread(writer.close)
+            try:
                 await message.reply_document(
-                    document=types.BufferedInputFile(
-                        file=zip_data,
-                        filename=f"midi_sessions_{days}_days.zip"
-                    ),
-                    caption=f"📦 Файлы в архиве:\n{file_list_text}"
+                    document=SpooledInputFile(part.file, filename=f"midi_sessions_{days}_days.zip"),
+                    caption=format_caption("📦 Файлы в архиве:\n", sessions)
                 )
+            finally:
+                part.close()
+        else:
+            part = await asyncio.to_thread(writer.close)
+            await send_part(part, sessions, sent_count + 1)
 
+    except asyncio.TimeoutError:
+        logger.warning("Таймаут выгрузки MIDI")
+        await message.reply("⏳ Выгрузка заняла слишком много времени, попробуйте период поменьше.",
+                            reply_markup=get_period_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в send_midi_files: {e}")
         await message.reply("❌ Ошибка при загрузке MIDI.", reply_markup=get_period_keyboard())
+    finally:
+        producer.cancel()
+        writer.discard()
 
 
 def safe_filename(filename: str) -> str:
@@ -240,7 +380,8 @@ async def list_devices(message: types.Message):
         for i, device in enumerate(output_devices, 1):
             response.append(f"{i}. {device}")
 
-        response.append("\nℹ️ Для воспроизведения используйте /play <номер_устройства>")
+        response.append("\nℹ️ Для воспроизведения используйте /play <номер_устройства>, "
+                        "очередь — /queue, остановка — /stop [номер_устройства]")
         await message.reply("\n".join(response))
 
         # Обновляем кеш устройств
@@ -279,13 +420,19 @@ async def play_handler(message: Message):
             await message.reply("ℹ️ Сначала отправьте мне MIDI-файл.")
             return
 
-        await message.reply(f"🔄 Воспроизведение на устройстве {port_name}...")
+        # Файл читаем сразу: пока очередь дойдёт, пользователь может прислать новый
+        try:
+            events = await asyncio.to_thread(lambda: midi_file_events(MidiFile(str(user_file))))
+        except Exception as e:
+            logger.error(f"Ошибка чтения MIDI-файла: {e}")
+            await message.reply("⚠️ Не удалось прочитать MIDI-файл")
+            return
 
-        # Воспроизводим файл
-        if play_midi_file(port_name, str(user_file)):
-            await message.reply("✅ Воспроизведение завершено")
-        else:
-            await message.reply("⚠️ Ошибка при воспроизведении MIDI-файла")
+        title = f"файл от {message.from_user.full_name}"
+        ahead = player.play(port_name, title, events, playback_notifier(message))
+        if ahead:
+            await message.reply(f"🕒 Добавлено в очередь {port_name}, перед ним: {ahead}\n"
+                                f"/queue — очередь, /stop {device_num} — остановить")
     except ValueError:
         await message.reply("⚠️ Номер устройства должен быть числом")
     except Exception as e:
@@ -325,82 +472,235 @@ async def handle_visualize(message: types.Message):
         # Получаем аргументы команды (все что после /notes)
         command_args = message.text.split()[1:] if message.text else []
 
-        session_id = int(command_args[0]) if len(command_args) > 0 else 0
+        # Без номера показываем последнюю сессию
+        session_id = int(command_args[0]) if len(command_args) > 0 else None
         input_name = command_args[1] if len(command_args) > 1 else None
 
-        # Получаем данные сессии
-        session_data = db.get_session_by_id(session_id, input_name)
-        if not session_data:
+        # Рисование идёт вне event loop, готовые картинки берутся из кеша
+        image = await note_renderer.render(session_id, input_name)
+        if not image:
             await message.reply("Сессия не найдена")
             return
+        if image.png is None:
+            await message.reply("В сессии не найдено нот")
+            return
 
-        # Извлекаем MIDI данные
-        midi_bytes = session_data[1]
+        await message.reply_photo(
+            photo=types.BufferedInputFile(
+                file=image.png,
+                filename=f"notes_visualization_{image.session_id}.png"
+            ),
+            caption=f"Сессия {image.session_id} | {image.formatted_date} {image.formatted_time}\n"
+                    f"Всего нот: {image.notes_count}"
+        )
 
-        # Создаем временный файл для анализа
-        with io.BytesIO(midi_bytes) as midi_stream:
-            midi_file = MidiFile(file=midi_stream)
+    except (IndexError, ValueError):
+        await message.reply("Использование: /notes [номер_сессии] [устройство]")
+    except asyncio.TimeoutError:
+        await message.reply("⏳ Сессия загружается слишком долго, попробуйте позже")
+    except Exception as e:
+        logging.error(f"Error in handle_visualize: {e}")
+        await message.reply("Произошла ошибка при создании визуализации")
 
-            # Анализируем треки и собираем данные для графика
-            notes = []
-            times = []
 
-            for i, track in enumerate(midi_file.tracks):
-                current_time = 0
-                for msg in track:
-                    current_time += msg.time
-                    if msg.type == 'note_on' and msg.velocity > 0:
-                        notes.append(msg.note)
-                        times.append(current_time / 1000)  # переводим в секунды
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
 
-            if not notes:
-                await message.reply("В сессии не найдено нот")
-                return
 
-            # Создаем график
-            plt.figure(figsize=(10, 5))
-            plt.scatter(times, notes, alpha=0.5)
-            plt.title(f"Визуализация нот сессии {session_id}")
-            plt.xlabel("Время (секунды)")
-            plt.ylabel("Высота ноты")
-            plt.grid(True)
-
-            # Сохраняем во временный файл
-            with io.BytesIO() as plot_buffer:
-                plt.savefig(plot_buffer, format='png')
-                plot_buffer.seek(0)
-
-                # Отправляем изображение
-                await message.reply_photo(
-                    photo=types.BufferedInputFile(
-                        file=plot_buffer.getvalue(),
-                        filename=f"notes_visualization_{session_id}.png"
-                    ),
-                    caption=f"Сессия {session_id} | {session_data[3]} {session_data[4]}\n"
-                            f"Всего нот: {session_data[2]}"
-                )
+def note_name(note: int) -> str:
+    """Название ноты в научной нотации (60 — C4)"""
+    return f"{NOTE_NAMES[note % 12]}{note // 12 - 1}"
+
+
+def format_session_stats(stats: dict) -> str:
+    """Текст ответа /stats"""
+    start = stats["start"]
+    minutes, seconds = divmod(int(stats["duration"]), 60)
+    lines = [
+        f"📊 Сессия {stats['session_id']} | {start.strftime('%d.%m.%Y %H:%M')}",
+        f"Длительность: {minutes} мин {seconds} с",
+        f"Нажатий: {stats['presses']}",
+    ]
+
+    pitches = stats["pitches"]
+    played = [note for note, count in enumerate(pitches) if count]
+    if played:
+        lines.append(f"Диапазон: {note_name(played[0])} – {note_name(played[-1])}")
+        top = sorted(played, key=lambda note: pitches[note], reverse=True)[:5]
+        lines.append("Чаще всего: " + ", ".join(f"{note_name(note)} ({pitches[note]})" for note in top))
 
-            plt.close()
+        velocities = stats["velocities"]
+        average = sum(velocity * count for velocity, count in enumerate(velocities)) / stats["presses"]
+        lines.append(f"Средняя сила нажатия: {average:.0f}")
+
+    if stats["channels"]:
+        lines.append("Каналы: " + ", ".join(map(str, stats["channels"])))
+    return "\n".join(lines)
+
+
+@dp.message(Command("stats"))
+async def handle_stats(message: types.Message):
+    try:
+        command_args = message.text.split()[1:] if message.text else []
+        session_id = int(command_args[0]) if len(command_args) > 0 else None
+        input_name = command_args[1] if len(command_args) > 1 else None
+
+        # Статистика считается при записи, здесь только чтение агрегатов
+        stats = await db.get_session_stats(session_id, input_name)
+        if not stats:
+            await message.reply("Сессия не найдена")
+            return
+        await message.reply(format_session_stats(stats))
 
     except (IndexError, ValueError):
-        await message.reply("Использование: /notes [номер_сессии] [устройство]")
+        await message.reply("Использование: /stats [номер_сессии] [устройство]")
+    except asyncio.TimeoutError:
+        await message.reply("⏳ База данных занята, попробуйте позже")
     except Exception as e:
-        logging.error(f"Error in handle_visualize: {e}")
-        await message.reply("Произошла ошибка при создании визуализации")
+        logging.error(f"Error in handle_stats: {e}")
+        await message.reply("Произошла ошибка при получении статистики")
+
+
+def fetch_logger_stats(timeout: float = 2) -> dict:
+    with urlopen(STATS_URL, timeout=timeout) as response:
+        return json.load(response)
+
+
+def format_health(stats: dict, lateness: dict = None) -> str:
+    """
+    Текст ответа /health по снимку статистики логгера
+    :param lateness: Снимок опозданий воспроизведения (Histogram.snapshot), None — не показывать
+    """
+    commit = stats["commit_latency"]
+    delay = stats["storage_delay"]
+    counters = stats["counters"]
+    gauges = stats["gauges"]
+    lines = [
+        f"✅ Логгер работает {format_duration(stats['uptime'])}",
+        f"Событий: {stats['events']}, в очереди: {gauges.get('queue_depth', 'н/д')}",
+        f"Commit: p50 {commit['p50_ms']:.1f} мс, p99 {commit['p99_ms']:.1f} мс ({commit['count']} шт.)",
+        f"До записи на диск: p50 {delay['p50_ms']:.1f} мс, p99 {delay['p99_ms']:.1f} мс, "
+        f"макс. {delay['max_ms']:.1f} мс",
+    ]
+    if counters.get("write_errors"):
+        lines.append(f"⚠️ Ошибок записи: {counters['write_errors']}")
+    if counters.get("lost_events"):
+        lines.append(f"⚠️ Не записано событий: {counters['lost_events']}")
+    journal = gauges.get("journal")
+    if journal and journal["overflow"]:
+        lines.append(f"⚠️ Журнал переполнен, потеряно событий: {journal['overflow']}")
+    if journal and journal.get("corrupted"):
+        lines.append(f"⚠️ Пропущено повреждённых записей журнала: {journal['corrupted']}")
+
+    # Отброшенные фильтром записи: устройство -> {тип: количество}
+    dropped = {}
+    for counts in (gauges.get("dropped") or {}).values():
+        for kind, count in counts.items():
+            dropped[kind] = dropped.get(kind, 0) + count
+    if dropped:
+        lines.append("Отфильтровано: " + ", ".join(f"{kind} {count}" for kind, count in sorted(dropped.items())))
+
+    open_ports = gauges.get("open_ports") or []
+    lines.append(f"\n🎹 Открытых портов: {len(open_ports)}")
+    for name, port in sorted(stats["ports"].items()):
+        state = "" if name in open_ports else " (отключен)"
+        lines.append(f"  {name}{state}: {port['rate']:.1f} соб/с, всего {port['events']}")
+    if lateness and lateness["count"]:
+        lines.append(f"\n▶️ Опоздание воспроизведения: p50 {lateness['p50_ms']:.2f} мс, "
+                     f"p99 {lateness['p99_ms']:.2f} мс, макс. {lateness['max_ms']:.2f} мс")
+    return "\n".join(lines)
+
+
+@dp.message(Command("health"))
+async def handle_health(message: types.Message):
+    try:
+        stats = await asyncio.to_thread(fetch_logger_stats)
+    except Exception as e:
+        logger.warning(f"Logger stats unavailable: {e}")
+        await message.reply("❌ Логгер не отвечает")
+        return
+    try:
+        await message.reply(format_health(stats, player.lateness.snapshot()))
+    except Exception as e:
+        logging.error(f"Error in handle_health: {e}")
+        await message.reply("Произошла ошибка при получении состояния")
+
+
+PLAYBACK_STATUS = {
+    "started": "▶️ Воспроизведение: {title}",
+    "finished": "✅ Воспроизведение завершено: {title}",
+    "stopped": "⏹ Воспроизведение остановлено: {title}",
+    "failed": "⚠️ Ошибка при воспроизведении: {title}",
+}
+
+
+def playback_notifier(message: Message):
+    """
+    Статусы плеера приходят из его потоков, в чат они отправляются
+    через event loop бота
+    """
+    loop = asyncio.get_running_loop()
+
+    def notify(item, status: str):
+        text = PLAYBACK_STATUS[status].format(title=item.title)
+        asyncio.run_coroutine_threadsafe(message.answer(text), loop)
+
+    return notify
+
+
+def resolve_device(args: List[str]) -> str:
+    """
+    Имя устройства по номеру из аргументов команды
+    :return: Имя или None, если номер не указан
+    :raises ValueError: Номер не число или вне списка устройств
+    """
+    if not args:
+        return None
+    if not args[0].isdigit():
+        raise ValueError("Номер устройства должен быть числом")
+    output_devices = get_output_names()
+    device_num = int(args[0])
+    if device_num < 1 or device_num > len(output_devices):
+        raise ValueError(f"Неверный номер устройства. Доступно устройств: {len(output_devices)}")
+    return output_devices[device_num - 1]
+
+
+@dp.message(Command("stop"))
+async def stop_handler(message: Message):
+    """Обработчик команды /stop [номер_устройства]"""
+    try:
+        device = resolve_device(message.text.split()[1:])
+        stopped = player.stop(device)
+        if stopped:
+            await message.reply(f"⏹ Остановлено и снято с очереди: {stopped}")
+        else:
+            await message.reply("ℹ️ Сейчас ничего не воспроизводится")
+    except ValueError as e:
+        await message.reply(f"⚠️ {e}")
+    except Exception as e:
+        logger.error(f"Ошибка в stop_handler: {e}")
+        await message.reply("⚠️ Ошибка при остановке воспроизведения")
 
 
-# Добавляем недостающую функцию для воспроизведения MIDI
-def play_midi_file(port_name: str, file_path: str) -> bool:
-    """Воспроизведение MIDI-файла на указанном устройстве"""
+@dp.message(Command("queue"))
+async def queue_handler(message: Message):
+    """Обработчик команды /queue"""
     try:
-        with mido.open_output(port_name) as port:
-            midi_file = MidiFile(file_path)
-            for msg in midi_file.play():
-                port.send(msg)
-        return True
+        state = player.queue()
+        if not state:
+            await message.reply("ℹ️ Очередь воспроизведения пуста")
+            return
+
+        lines = ["🎼 Очередь воспроизведения:"]
+        for device, (current, pending) in state.items():
+            lines.append(f"\n{device}:")
+            if current is not None:
+                lines.append(f"▶️ {current.title}")
+            for i, item in enumerate(pending, 1):
+                lines.append(f"{i}. {item.title}")
+        await message.reply("\n".join(lines))
     except Exception as e:
-        logging.error(f"Error in play_midi_file: {e}")
-        return False
+        logger.error(f"Ошибка в queue_handler: {e}")
+        await message.reply("⚠️ Ошибка при получении очереди")
 
 # Запуск бота
 async def main():
@@ -416,5 +716,9 @@ if __name__ == '__main__':
         logger.critical(f"Фатальная ошибка: {e}")
     finally:
         # Закрытие соединения с БД
+        with suppress(Exception):
+            player.close()
+        with suppress(Exception):
+            note_renderer.close()
         with suppress(Exception):
             db.close()
@@ -1,82 +1,1687 @@
+import ast
+import asyncio
+import functools
+import heapq
 import io
 import json
 import logging
+import multiprocessing
+import os
+import queue
+import re
 import sqlite3
+import struct
+import threading
 import time
-from datetime import datetime, timedelta
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from itertools import groupby, islice
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, Iterator
 
-import matplotlib as plt
+import numpy as np
 from dateutil import parser
 from mido import Message, MidiTrack
 from mido import MidiFile
 
+from metrics import Metrics
+from playback import Player
+
 log = logging.getLogger()
 log.addHandler(logging.StreamHandler())
 log.setLevel(logging.DEBUG)
 
 
+NS_PER_MS = 1_000_000
+NS_PER_SEC = 1_000_000_000
+NS_PER_DAY = 86400 * NS_PER_SEC
+EPOCH = datetime(1970, 1, 1)
+# Начало блоба session_archive с событиями без потерь (pack_events);
+# блобы прежних версий — сжатый zlib готовый MIDI-файл
+ARCHIVE_MAGIC = b"MLA1"
+# str(port) у mido: <open input 'Piano' (RtMidi/ALSA)>
+PORT_REPR = re.compile(r"""<(?:open|closed) [\w/ ]+ ('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*") \(.*\)>""", re.S)
+
+
+def ns_to_datetime(ts: int) -> datetime:
+    """Переводит epoch-наносекунды в datetime (UTC)"""
+    return datetime.fromtimestamp(ts / NS_PER_SEC, tz=timezone.utc)
+
+
+def period_start(days: int) -> int:
+    """
+    Начало периода выгрузок и сводок: полночь (UTC) дня, отстоящего на days - 1
+    от сегодняшнего. Так «1 день» — это сегодня, как и в дневных сводках
+    :param days: Период в календарных днях, 0 — всё время
+    :return: Epoch-наносекунды, 0 для всего времени
+    """
+    if days <= 0:
+        return 0
+    return (time.time_ns() // NS_PER_DAY - days + 1) * NS_PER_DAY
+
+
+def port_name(input_name: str) -> str:
+    """
+    Имя устройства из строки старого лога: захват в режиме опроса
+    записывал str(port) вместо имени порта
+    :return: Имя порта из str(port) или input_name без изменений
+    """
+    match = PORT_REPR.fullmatch(input_name)
+    return ast.literal_eval(match[1]) if match else input_name
+
+
+def datetime_to_ns(value: datetime) -> int:
+    """Переводит naive-UTC datetime из старой схемы в epoch-наносекунды"""
+    return (value - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def render_midi(messages: list) -> tuple[bytes, int]:
+    """
+    Собирает MIDI-файл из событий сессии
+    :param messages: Список (ts в наносекундах, байты сообщения) по возрастанию ts
+    :return: Данные файла и количество нот
+    """
+    midi_file = MidiFile()
+    track = MidiTrack()
+    midi_file.tracks.append(track)
+
+    start_ts = messages[0][0] if messages else 0
+    prev_tick = 0
+    notes_count = 0  # Счетчик нот
+
+    for ts, data in messages:
+        msg = Message.from_bytes(data)
+        # 1 тик = 1 мс; тики считаются от начала сессии, чтобы округление не накапливалось
+        tick = (ts - start_ts) // NS_PER_MS
+        msg.time = tick - prev_tick
+        track.append(msg)
+        prev_tick = tick
+
+        # Подсчет нот
+        if msg.type == 'note_on':
+            notes_count += 1
+
+    # Сохраняем в bytes
+    midi_bytes = io.BytesIO()
+    midi_file.save(file=midi_bytes)
+    return midi_bytes.getvalue(), notes_count
+
+
+def midi_events(midi_bytes: bytes, start_ts: int) -> list:
+    """
+    Обратное к render_midi: события однодорожечного файла с точностью до тика (1 мс)
+    :param start_ts: Метка первого события сессии
+    :return: Список (ts в наносекундах, байты сообщения)
+    """
+    midi_file = MidiFile(file=io.BytesIO(midi_bytes))
+    events = []
+    ts = start_ts
+    for msg in midi_file.tracks[0]:
+        ts += msg.time * NS_PER_MS
+        if not msg.is_meta:
+            events.append((ts, bytes(msg.bytes())))
+    return events
+
+
+def pack_events(messages: list) -> bytes:
+    """
+    События сессии для session_archive без потерь: метки до наносекунды и байты
+    сообщений как есть. Разности меток, длины и данные идут отдельными массивами
+    и сжимаются zlib
+    :param messages: Список (ts в наносекундах, байты сообщения) по возрастанию ts
+    """
+    ts = np.fromiter((ts for ts, _ in messages), np.int64, len(messages))
+    lengths = np.fromiter((len(data) for _, data in messages), np.uint32, len(messages))
+    payload = b"".join((
+        struct.pack("<I", len(messages)),
+        np.diff(ts, prepend=0).astype("<i8").tobytes(),
+        lengths.astype("<u4").tobytes(),
+        *(data for _, data in messages),
+    ))
+    return ARCHIVE_MAGIC + zlib.compress(payload, 9)
+
+
+def unpack_events(blob: bytes) -> list:
+    """
+    Обратное к pack_events
+    :return: Список (ts в наносекундах, байты сообщения)
+    """
+    payload = zlib.decompress(blob[len(ARCHIVE_MAGIC):])
+    count, = struct.unpack_from("<I", payload)
+    ts = np.cumsum(np.frombuffer(payload, "<i8", count, 4))
+    lengths = np.frombuffer(payload, "<u4", count, 4 + 8 * count).astype(np.int64)
+    ends = 4 + 12 * count + np.cumsum(lengths)
+    return [
+        (ts, payload[end - length:end])
+        for ts, length, end in zip(ts.tolist(), lengths.tolist(), ends.tolist())
+    ]
+
+
+class BatchWriter:
+    """
+    Фоновый писатель: копит события в ограниченной очереди и
+    записывает их пачками, один commit на пачку
+    """
+    _STOP = object()
+    # Попытки записи одной пачки и пауза перед первым повтором, удваивается с каждым
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = .1
+
+    def __init__(self, midi_log: "MidiLog", queue_size: int, batch_size: int, flush_interval: float):
+        self.midi_log = midi_log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="midi-log-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def put(self, row):
+        # Блокируемся при переполнении очереди — это и есть backpressure
+        self.queue.put(row)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Дожидается записи всего, что уже лежит в очереди
+        :param timeout: Максимальное время ожидания в секундах
+        :return: True, если всё записано
+        """
+        if not self._thread.is_alive():
+            return self.queue.empty()
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = None):
+        if self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _write(self, batch: list):
+        """
+        Записывает пачку. Неудачная транзакция откатывается целиком (write_rows),
+        поэтому повтор не задваивает события. После MAX_ATTEMPTS неудач пачка
+        отбрасывается и учитывается в lost_events, чтобы flush и close не зависали
+        """
+        if not batch:
+            return
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                self.midi_log.write_rows(batch)
+            except Exception as e:
+                log.error(f"Error in BatchWriter (attempt {attempt}): {e}")
+                self.midi_log.metrics.incr("write_errors")
+                if attempt < self.MAX_ATTEMPTS:
+                    time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+            else:
+                break
+        else:
+            log.error(f"BatchWriter dropped {len(batch)} events")
+            self.midi_log.metrics.incr("lost_events", len(batch))
+        batch.clear()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                self._write(batch)
+                return
+            if isinstance(item, threading.Event):
+                self._write(batch)
+                deadline = None
+                item.set()
+                continue
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._write(batch)
+                deadline = None
+
+
+class ReaderPool:
+    """
+    Пул read-only соединений для запросов, отдельный от писателя.
+    Соединения создаются лениво, не больше size штук
+    """
+
+    def __init__(self, db_path: str, size: int, pragmas: dict):
+        self.uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+        self.size = size
+        self.pragmas = pragmas
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        apply_pragmas(con, self.pragmas)
+        return con
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._connect()
+        return self._idle.get()
+
+    @contextmanager
+    def cursor(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("Reader pool is closed")
+        con = self._acquire()
+        cur = con.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            if self._closed:
+                con.close()
+            else:
+                self._idle.put(con)
+
+    def detach(self, schema: str):
+        """
+        Отключает схему от простаивающих соединений. Соединения, занятые запросом,
+        остаются как есть и отключаются в следующий раз
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for con in reversed(idle):
+            # Схема могла быть не подключена к этому соединению
+            with suppress(sqlite3.OperationalError):
+                con.execute(f"DETACH DATABASE {schema}")
+            self._idle.put(con)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SessionCache:
+    """
+    Двухуровневый кеш готовых файлов сессий: LRU в памяти и каталог на диске.
+    Ключ — (id сессии, id первого события, id последнего события), поэтому
+    дописанная открытая сессия получает новый ключ, а старая запись удаляется.
+    На диск попадают только закрытые сессии
+    """
+
+    def __init__(self, directory: Path, memory_bytes: int, disk_bytes: int, suffix: str = ".mid"):
+        """
+        :param directory: Каталог дискового уровня
+        :param memory_bytes: Лимит уровня в памяти
+        :param disk_bytes: Лимит дискового уровня
+        :param suffix: Расширение файлов кеша
+        """
+        self.directory = directory
+        self.suffix = suffix
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # session_id -> (key, data)
+        self._memory_size = 0
+        self._disk = OrderedDict()  # key -> размер файла, от старых к новым
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in sorted(self.directory.glob(f"*{suffix}"), key=lambda p: p.stat().st_mtime):
+            key = self._parse_name(path.name)
+            if key:
+                size = path.stat().st_size
+                self._disk[key] = size
+                self._disk_size += size
+
+    def _file_name(self, key: tuple) -> str:
+        return "_".join(map(str, key)) + self.suffix
+
+    def _parse_name(self, name: str):
+        with suppress(ValueError):
+            return tuple(int(part) for part in name[:-len(self.suffix)].split("_"))
+        return None
+
+    def get(self, key: tuple):
+        session_id = key[0]
+        with self._lock:
+            entry = self._memory.get(session_id)
+            if entry:
+                if entry[0] == key:
+                    self._memory.move_to_end(session_id)
+                    return entry[1]
+                # Открытая сессия дописалась — старая версия больше не нужна
+                self._drop_memory(session_id)
+
+            if key not in self._disk:
+                return None
+            path = self.directory / self._file_name(key)
+            try:
+                data = path.read_bytes()
+                os.utime(path)
+            except OSError:
+                self._disk_size -= self._disk.pop(key)
+                return None
+            self._disk.move_to_end(key)
+            self._put_memory(key, data)
+            return data
+
+    def put(self, key: tuple, data: bytes, persistent: bool = True):
+        """
+        :param persistent: Сохранять на диск (только для закрытых сессий)
+        """
+        with self._lock:
+            self._put_memory(key, data)
+            if persistent and key not in self._disk and len(data) <= self.disk_bytes:
+                path = self.directory / self._file_name(key)
+                tmp_path = path.with_suffix(".tmp")
+                try:
+                    tmp_path.write_bytes(data)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    log.warning(f"Cache write failed: {e}")
+                    return
+                self._disk[key] = len(data)
+                self._disk_size += len(data)
+                self._evict_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            for key in list(self._disk):
+                with suppress(OSError):
+                    (self.directory / self._file_name(key)).unlink()
+            self._disk.clear()
+            self._disk_size = 0
+
+    def _put_memory(self, key: tuple, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        self._drop_memory(key[0])
+        self._memory[key[0]] = (key, data)
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _drop_memory(self, session_id: int):
+        entry = self._memory.pop(session_id, None)
+        if entry:
+            self._memory_size -= len(entry[1])
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            with suppress(OSError):
+                (self.directory / self._file_name(key)).unlink()
+
+
+# Pragma-настройки для режимов хранения. В WAL читатели не блокируют писателя,
+# а synchronous=NORMAL делает fsync только на checkpoint, а не на каждый commit
+STORAGE_MODES = {
+    "default": {
+        "writer": {},
+        "reader": {},
+    },
+    "wal": {
+        "writer": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -16000,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+        "reader": {
+            "cache_size": -32000,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+    },
+}
+
+
+def apply_pragmas(con: sqlite3.Connection, pragmas: dict):
+    for name, value in pragmas.items():
+        con.execute(f"PRAGMA {name} = {value}")
+
+
+class EventShards:
+    """
+    События по месяцам (UTC) в отдельных файлах YYYY-MM.db. Основная БД хранит
+    устройства, сессии и сводки, а также события, записанные до появления шардов.
+    Шарды подключаются к соединению через ATTACH по мере надобности, одновременно
+    не больше limit штук: лишние отключаются. ATTACH и DETACH SQLite не разрешает
+    внутри транзакции, поэтому attach вызывается до её начала
+    """
+    # Pragma-настройки писателя, которые относятся к конкретному файлу, а не к соединению
+    FILE_PRAGMAS = ("journal_mode", "synchronous")
+
+    def __init__(self, directory: Path, limit: int, pragmas: dict):
+        """
+        :param directory: Каталог с файлами шардов
+        :param limit: Максимум одновременно подключенных шардов на соединение
+        :param pragmas: Pragma-настройки писателя
+        """
+        self.directory = directory
+        self.limit = limit
+        self.pragmas = {name: value for name, value in pragmas.items() if name in self.FILE_PRAGMAS}
+        self._last = (0, 0, None)
+
+    def bounds(self, ts: int) -> tuple[int, int, str]:
+        """:return: Начало и конец месяца метки ts в наносекундах и его имя YYYY-MM"""
+        last = self._last
+        if last[0] <= ts < last[1]:
+            return last
+        moment = ns_to_datetime(ts)
+        first = datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+        following = datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1, tzinfo=timezone.utc)
+        self._last = last = (
+            int(first.timestamp()) * NS_PER_SEC, int(following.timestamp()) * NS_PER_SEC, first.strftime("%Y-%m")
+        )
+        return last
+
+    def month(self, ts: int) -> str:
+        return self.bounds(ts)[2]
+
+    def path(self, month: str) -> Path:
+        return self.directory / f"{month}.db"
+
+    @staticmethod
+    def schema(month: str) -> str:
+        return "shard_" + month.replace("-", "_")
+
+    def existing(self, start_ts: int = None, end_ts: int = None) -> list[str]:
+        """
+        Месяцы, у которых есть файл шарда, по возрастанию
+        :param start_ts: Начало интервала, None — все шарды
+        :param end_ts: Конец интервала включительно
+        """
+        if start_ts is None:
+            return sorted(path.stem for path in self.directory.glob("????-??.db"))
+        months = []
+        ts = start_ts
+        while ts <= end_ts:
+            _, ts, month = self.bounds(ts)
+            if self.path(month).exists():
+                months.append(month)
+        return months
+
+    def writable(self, month: str) -> bool:
+        # По битам прав, а не os.access: под root тот вернёт True и для замороженного файла
+        return bool(self.path(month).stat().st_mode & 0o222)
+
+    def frozen(self, month: str) -> bool:
+        """Шард заморожен freeze_shards: файл есть, но прав на запись нет"""
+        return self.path(month).exists() and not self.writable(month)
+
+    def target(self, month: str) -> str:
+        """
+        Схема, куда писатель пишет события месяца. Замороженный файл не меняется,
+        поэтому поздние события его месяца попадают в основную БД, где их находят
+        и читатели, и rebuild_sessions
+        """
+        return "main" if self.frozen(month) else self.schema(month)
+
+    def attach(self, con: sqlite3.Connection, months: list[str], readonly: bool = False) -> list[str]:
+        """
+        Подключает шарды месяцев к соединению, отключая остальные сверх лимита.
+        Писатель создаёт недостающие файлы, а вместо замороженных получает "main" (target)
+        :param readonly: Соединение читателя (открыто с uri=True)
+        :return: Имена схем в порядке months
+        """
+        if len(months) > self.limit:
+            raise ValueError(f"Too many shards for one query: {len(months)} > {self.limit}")
+        attached = {row[1] for row in con.execute("PRAGMA database_list")} - {"main", "temp"}
+        schemas = [self.schema(month) if readonly else self.target(month) for month in months]
+        unused = sorted(attached - set(schemas))
+        for month, schema in zip(months, schemas):
+            if schema in attached or schema == "main":
+                continue
+            if len(attached) >= self.limit:
+                old = unused.pop(0)
+                con.execute(f"DETACH DATABASE {old}")
+                attached.discard(old)
+
+            path = self.path(month)
+            if readonly:
+                # Замороженный шард больше не меняется, SQLite может не проверять блокировки
+                mode = "ro" if self.writable(month) else "ro&immutable=1"
+                con.execute(f"ATTACH DATABASE ? AS {schema}", (f"{path.resolve().as_uri()}?mode={mode}",))
+            else:
+                created = not path.exists()
+                self.directory.mkdir(parents=True, exist_ok=True)
+                con.execute(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+                self._prepare(con, schema, month, created)
+            attached.add(schema)
+        return schemas
+
+    def _prepare(self, con: sqlite3.Connection, schema: str, month: str, created: bool):
+        if created:
+            # auto_vacuum выбирается только до создания таблиц
+            con.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+        for name, value in self.pragmas.items():
+            con.execute(f"PRAGMA {schema}.{name} = {value}")
+        # Своя meta у шарда хранит позицию журнала, до которой его события записаны (write_rows)
+        con.execute(f"CREATE TABLE IF NOT EXISTS {schema}.meta (key TEXT PRIMARY KEY, value)")
+        if not created:
+            con.commit()
+            return
+        con.executescript(f"""
+                CREATE TABLE IF NOT EXISTS {schema}.events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts INTEGER NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    data BLOB NOT NULL);
+                CREATE INDEX IF NOT EXISTS {schema}.idx_events_device_ts ON events(device_id, ts);
+            """)
+        # id событий остаются уникальными между шардами: у каждого месяца свой диапазон
+        year, month_number = map(int, month.split("-"))
+        con.execute(
+            f"INSERT INTO {schema}.sqlite_sequence(name, seq) SELECT 'events', ? "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {schema}.sqlite_sequence WHERE name = 'events')",
+            ((year * 12 + month_number - 1) << 40,)
+        )
+        con.commit()
+
+
+def is_note_on(data: bytes) -> bool:
+    return (data[0] & 0xF0) == 0x90
+
+
+def segment(ts: np.ndarray, gap: int) -> np.ndarray:
+    """
+    Разбивает события одного устройства на сессии: новая начинается после паузы >= gap
+    :param ts: Метки событий в наносекундах по возрастанию
+    :return: Индексы первых событий сессий
+    """
+    if not len(ts):
+        return np.empty(0, np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(ts) >= gap) + 1))
+
+
+def segment_stats(payloads: list, starts: np.ndarray) -> tuple:
+    """
+    Агрегаты OpenSession для всех сессий сразу
+    :param payloads: Байты сообщений в порядке событий
+    :param starts: Индексы первых событий сессий (segment)
+    :return: Количество нот, гистограммы высоты и силы (сессия x 128), маски каналов
+    """
+    count = len(starts)
+    lengths = np.fromiter(map(len, payloads), np.int64, len(payloads))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # Два нулевых байта, чтобы data1/data2 читались и у коротких сообщений
+    buffer = np.frombuffer(b"".join(payloads) + b"\0\0", np.uint8)
+    status = buffer[offsets].astype(np.int64)
+    data1 = buffer[offsets + 1].astype(np.int64)
+    data2 = buffer[offsets + 2].astype(np.int64)
+    session = np.repeat(np.arange(count), np.diff(np.append(starts, len(payloads))))
+
+    channel_message = status < 0xF0
+    note_on = channel_message & ((status & 0xF0) == 0x90)
+    # note_on с velocity=0 — это отпускание
+    pressed = note_on & (lengths == 3) & (data2 > 0)
+    note_count = np.bincount(session[note_on], minlength=count)
+    pitches = np.bincount(session[pressed] * 128 + data1[pressed], minlength=count * 128).reshape(count, 128)
+    velocities = np.bincount(session[pressed] * 128 + data2[pressed], minlength=count * 128).reshape(count, 128)
+    channels = np.bitwise_or.reduceat(np.where(channel_message, 1 << (status & 0x0F), 0), starts)
+    return note_count, pitches, velocities, channels
+
+
+class OpenSession:
+    """
+    Состояние последней сессии устройства, которое обновляется при записи,
+    вместе с агрегатами для статистики
+    """
+    __slots__ = ("device_id", "id", "start_ts", "end_ts", "first_event_id", "last_event_id", "note_count",
+                 "pitches", "velocities", "channels")
+
+    def __init__(self, device_id: int, session_id: int, start_ts: int, end_ts: int,
+                 first_event_id: int = None, last_event_id: int = None, note_count: int = 0):
+        self.device_id = device_id
+        self.id = session_id
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.first_event_id = first_event_id
+        self.last_event_id = last_event_id
+        self.note_count = note_count
+        # Гистограммы нажатий по высоте и силе, битовая маска каналов
+        self.pitches = array('I', bytes(4 * 128))
+        self.velocities = array('I', bytes(4 * 128))
+        self.channels = 0
+
+    def load_stats(self, pitches: bytes, velocities: bytes, channels: int):
+        self.pitches = array('I', pitches)
+        self.velocities = array('I', velocities)
+        self.channels = channels
+
+    def add_segment(self, first_event_id: int, last_event_id: int, end_ts: int, note_count: int,
+                    pitches: np.ndarray, velocities: np.ndarray, channels: int):
+        """Добавляет сразу отрезок событий с агрегатами из segment_stats"""
+        if self.first_event_id is None:
+            self.first_event_id = first_event_id
+        self.last_event_id = last_event_id
+        self.end_ts = max(self.end_ts, end_ts)
+        self.note_count += note_count
+        self.pitches = self._sum(self.pitches, pitches)
+        self.velocities = self._sum(self.velocities, velocities)
+        self.channels |= int(channels)
+
+    @staticmethod
+    def _sum(histogram: array, values: np.ndarray) -> array:
+        return array('I', (np.frombuffer(histogram, np.uint32) + values).astype(np.uint32).tobytes())
+
+    def add(self, event_id: int, ts: int, data: bytes):
+        if self.first_event_id is None:
+            self.first_event_id = event_id
+        self.last_event_id = event_id
+        # Запоздавшее событие расширяет интервал, по которому читаются события сессии
+        self.start_ts = min(self.start_ts, ts)
+        self.end_ts = max(self.end_ts, ts)
+
+        status = data[0]
+        if status < 0xF0:
+            self.channels |= 1 << (status & 0x0F)
+            if (status & 0xF0) == 0x90:
+                self.note_count += 1
+                # note_on с velocity=0 — это отпускание
+                if len(data) == 3 and data[2]:
+                    self.pitches[data[1]] += 1
+                    self.velocities[data[2]] += 1
+
+
 class MidiLog:
     DB_PATH = "data/midi_log.db"
     MAX_RETIRES = 3
 
-    def __init__(self):
-        self.retires = 0
-        self.con = sqlite3.connect(self.DB_PATH)
+    # Режим записи "batch": события уходят в очередь фонового писателя
+    WRITER_QUEUE_SIZE = 10000
+    WRITER_BATCH_SIZE = 500
+    WRITER_FLUSH_INTERVAL = .25
+
+    STORAGE_MODE = "wal"
+    READER_POOL_SIZE = 4
+
+    # Пауза между событиями, после которой начинается новая сессия. Значение,
+    # с которым последний раз пересобирались сессии, хранится в meta и имеет приоритет.
+    # Работающие логгер и бот подхватывают его после пересборки (_check_generation)
+    SESSION_GAP = 60 * NS_PER_SEC
+
+    # Кеш готовых MIDI-файлов: каталог относительно файла БД и лимиты уровней
+    CACHE_DIR = "cache"
+    CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+    CACHE_DISK_BYTES = 512 * 1024 * 1024
+
+    # Параллельная сборка MIDI: число процессов и минимум сессий, ради которого стоит поднимать пул
+    RENDER_WORKERS = os.cpu_count() or 1
+    PARALLEL_MIN_SESSIONS = 8
+    # Процессы пулов не наследуют fork'ом потоки и блокировки писателя и пула соединений
+    PROCESS_START_METHOD = "forkserver"
+
+    # Хранение: события сессий старше RETENTION_DAYS дней сжимаются в один блоб на сессию
+    # и удаляются из events. Сессии обрабатываются пачками по COMPACT_BATCH_SIZE,
+    # место возвращается файлам порциями по VACUUM_CHUNK_PAGES страниц
+    RETENTION_DAYS = 90
+    COMPACT_BATCH_SIZE = 16
+    VACUUM_CHUNK_PAGES = 1024
+
+    # События пишутся в месячные шарды в каталоге <имя БД>SHARD_DIR_SUFFIX рядом с файлом БД.
+    # К одному соединению одновременно подключено не больше SHARD_ATTACH_LIMIT шардов
+    SHARD_DIR_SUFFIX = "_events"
+    SHARD_ATTACH_LIMIT = 4
+
+    # Размеры порций при потоковом чтении сессий и их событий
+    # и при пересборке сессий одного устройства
+    SESSION_PAGE_SIZE = 100
+    EVENT_CHUNK_SIZE = 5000
+    REBUILD_CHUNK_SIZE = 100_000
+
+    # Ключ meta основной БД и шардов: позиция журнала захвата, до которой записаны события файла
+    JOURNAL_KEY = "journal_checkpoint"
+
+    # Запросы чтения, которые выполняет бот. Планы проверяет explain_queries.
+    # {events} — таблица событий основной БД или шарда
+    QUERIES = {
+        "sessions_since": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            WHERE end_ts >= ? AND (start_ts, id) > (?, ?)
+            ORDER BY start_ts, id
+            LIMIT ?
+        """,
+        "device_sessions_since": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            WHERE device_id = (SELECT id FROM devices WHERE name = ?) AND end_ts >= ? AND (start_ts, id) > (?, ?)
+            ORDER BY start_ts, id
+            LIMIT ?
+        """,
+        "spanning_sessions": """
+            SELECT s.start_ts FROM devices
+            JOIN sessions AS s
+            ON s.id = (SELECT id FROM sessions WHERE device_id = devices.id AND start_ts < ?1
+                       ORDER BY start_ts DESC LIMIT 1)
+            WHERE s.end_ts >= ?1
+        """,
+        "device_spanning_session": """
+            SELECT start_ts FROM sessions
+            WHERE id = (SELECT id FROM sessions
+                        WHERE device_id = (SELECT id FROM devices WHERE name = ?) AND start_ts < ?2
+                        ORDER BY start_ts DESC LIMIT 1)
+            AND end_ts >= ?2
+        """,
+        "session_span": """
+            SELECT device_id, start_ts, end_ts FROM sessions
+            WHERE id = ?
+        """,
+        "session_events": """
+            SELECT ts, data FROM {events}
+            WHERE device_id = ? AND ts BETWEEN ? AND ?
+            ORDER BY ts, id
+        """,
+        "session_short_events": """
+            SELECT ts, data FROM {events}
+            WHERE device_id = ? AND ts BETWEEN ? AND ? AND length(data) = 3
+            ORDER BY ts, id
+        """,
+        "session_stats": """
+            SELECT pitches, velocities, channels FROM session_stats
+            WHERE session_id = ?
+        """,
+        "session_archive": """
+            SELECT a.midi, s.start_ts FROM session_archive AS a
+            JOIN sessions AS s ON s.id = a.session_id
+            WHERE a.session_id = ?
+        """,
+        "sessions_to_archive": """
+            SELECT id, device_id, start_ts, end_ts FROM sessions
+            WHERE start_ts < ?1 AND end_ts < ?1 AND (start_ts, id) > (?2, ?3)
+            AND id NOT IN (SELECT session_id FROM session_archive)
+            ORDER BY start_ts, id
+            LIMIT ?4
+        """,
+        "session_by_id": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            WHERE id = ?
+        """,
+        "device_session_by_id": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            WHERE id = ? AND device_id = (SELECT id FROM devices WHERE name = ?)
+        """,
+        "last_session": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            ORDER BY start_ts DESC
+            LIMIT 1
+        """,
+        "device_last_session": """
+            SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count FROM sessions
+            WHERE device_id = (SELECT id FROM devices WHERE name = ?)
+            ORDER BY start_ts DESC
+            LIMIT 1
+        """,
+        "daily_stats": """
+            SELECT day, play_ns, session_count, note_count FROM daily_stats
+            WHERE day >= ?
+        """,
+        "device_daily_stats": """
+            SELECT day, play_ns, session_count, note_count FROM daily_stats
+            WHERE device_id = (SELECT id FROM devices WHERE name = ?) AND day >= ?
+        """,
+        "open_sessions": """
+            SELECT s.start_ts, s.end_ts, s.note_count FROM devices
+            JOIN sessions AS s
+            ON s.id = (SELECT id FROM sessions WHERE device_id = devices.id ORDER BY start_ts DESC LIMIT 1)
+            WHERE s.start_ts >= ?
+        """,
+        "device_open_sessions": """
+            SELECT start_ts, end_ts, note_count FROM sessions
+            WHERE device_id = (SELECT id FROM devices WHERE name = ?) AND start_ts >= ?
+            ORDER BY start_ts DESC
+            LIMIT 1
+        """,
+        "session_by_number": """
+            SELECT id, start_ts FROM sessions
+            ORDER BY start_ts
+            LIMIT 1 OFFSET ?
+        """,
+    }
+    # Таблицы, которые можно просматривать целиком: в них по строке на устройство
+    SMALL_TABLES = {"devices"}
+    # Примеры параметров для EXPLAIN QUERY PLAN
+    QUERY_SAMPLE_PARAMS = {
+        "sessions_since": (0, -1, 0, 100),
+        "device_sessions_since": ("", 0, -1, 0, 100),
+        "spanning_sessions": (0,),
+        "device_spanning_session": ("", 0),
+        "session_span": (0,),
+        "session_events": (0, 0, 0),
+        "session_short_events": (0, 0, 0),
+        "session_stats": (0,),
+        "session_archive": (0,),
+        "sessions_to_archive": (0, -1, 0, 16),
+        "session_by_id": (0,),
+        "device_session_by_id": (0, ""),
+        "last_session": (),
+        "device_last_session": ("",),
+        "daily_stats": (0,),
+        "device_daily_stats": ("", 0),
+        "open_sessions": (0,),
+        "device_open_sessions": ("", 0),
+        "session_by_number": (0,),
+    }
+
+    def __init__(self, writer_mode: str = "sync", storage_mode: str = None, db_path: str = None,
+                 render_workers: int = None, session_gap: float = None):
+        """
+        :param writer_mode: "sync" — commit на каждое событие,
+            "batch" — групповая запись из фонового потока
+        :param storage_mode: Ключ из STORAGE_MODES, по умолчанию STORAGE_MODE
+        :param db_path: Путь к файлу БД, по умолчанию DB_PATH
+        :param render_workers: Процессов для сборки MIDI, по умолчанию RENDER_WORKERS;
+            1 — всегда последовательно
+        :param session_gap: Пауза между сессиями в секундах, по умолчанию из meta или SESSION_GAP.
+            Уже записанные сессии меняет только rebuild_sessions; после пересборки
+            в другом процессе берётся её значение
+        """
+        if writer_mode not in ("sync", "batch"):
+            raise ValueError(f"Unknown writer mode: {writer_mode}")
+        if session_gap is not None and session_gap <= 0:
+            raise ValueError(f"Session gap must be positive: {session_gap}")
+        storage_mode = storage_mode or self.STORAGE_MODE
+        if storage_mode not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode: {storage_mode}")
+        self.writer_mode = writer_mode
+        self.storage_mode = storage_mode
+        self.db_path = db_path or self.DB_PATH
+        self.render_workers = render_workers or self.RENDER_WORKERS
+        # Пул создаётся при первой параллельной сборке; её могут начать сразу несколько потоков AsyncMidiLog
+        self._render_pool = None
+        self._render_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self.con = self._connect_writer()
         self.cur = self.con.cursor()
-        self.cur.execute("""
-                CREATE TABLE IF NOT EXISTS midi_log (
-                    ID INTEGER PRIMARY KEY, 
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, 
-                    input_name varchar(128), 
-                    message_type varchar(128), 
-                    message varchar(255))
+        self._device_ids = {}
+        self._open_sessions = {}
+        self.metrics = Metrics()
+        self.shards = EventShards(
+            Path(self.db_path).with_name(Path(self.db_path).stem + self.SHARD_DIR_SUFFIX),
+            self.SHARD_ATTACH_LIMIT, STORAGE_MODES[storage_mode]["writer"]
+        )
+        upgraded, rollups_missing = self._create_schema()
+        # Поколение сессий из meta, для которого действительны открытые сессии писателя
+        # (_generation) и кеш готовых файлов читателей (generation)
+        self._generation = self.generation = self._read_meta(self.cur, "sessions_generation", 0)
+        if session_gap is not None:
+            self.session_gap = int(session_gap * NS_PER_SEC)
+        else:
+            self.session_gap = self._read_meta(self.cur, "session_gap", self.SESSION_GAP)
+        self.readers = ReaderPool(
+            self.db_path, self.READER_POOL_SIZE, STORAGE_MODES[storage_mode]["reader"]
+        )
+        self.cache = SessionCache(
+            Path(self.db_path).parent / self.CACHE_DIR, self.CACHE_MEMORY_BYTES, self.CACHE_DISK_BYTES
+        )
+        self.writer = None
+        if writer_mode == "batch":
+            self.writer = BatchWriter(
+                self, self.WRITER_QUEUE_SIZE, self.WRITER_BATCH_SIZE, self.WRITER_FLUSH_INTERVAL
+            )
+        self.metrics.gauge("queue_depth", lambda: self.queue_depth)
+        if upgraded:
+            log.warning("sessions or their stats are missing, rebuilding")
+            self.rebuild_sessions()
+        elif rollups_missing:
+            log.warning("daily rollups are missing, rebuilding")
+            self.rebuild_daily_stats()
+
+    def _create_schema(self) -> tuple[bool, bool]:
+        """
+        Создаёт таблицы и докатывает изменения схемы
+        :return: (у существующих событий ещё нет сессий или их статистики,
+            у существующих сессий нет дневных сводок)
+        """
+        tables = {row[0] for row in self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.cur.executescript("""
+                CREATE TABLE IF NOT EXISTS devices (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE);
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY,
+                    ts INTEGER NOT NULL,
+                    device_id INTEGER NOT NULL REFERENCES devices(id),
+                    data BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id INTEGER PRIMARY KEY,
+                    device_id INTEGER NOT NULL REFERENCES devices(id),
+                    start_ts INTEGER NOT NULL,
+                    end_ts INTEGER NOT NULL,
+                    first_event_id INTEGER,
+                    last_event_id INTEGER,
+                    note_count INTEGER NOT NULL DEFAULT 0);
+                CREATE TABLE IF NOT EXISTS session_stats (
+                    session_id INTEGER PRIMARY KEY REFERENCES sessions(id),
+                    pitches BLOB NOT NULL,
+                    velocities BLOB NOT NULL,
+                    channels INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    device_id INTEGER NOT NULL REFERENCES devices(id),
+                    day INTEGER NOT NULL,
+                    play_ns INTEGER NOT NULL,
+                    session_count INTEGER NOT NULL,
+                    note_count INTEGER NOT NULL,
+                    PRIMARY KEY (device_id, day)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS session_archive (
+                    session_id INTEGER PRIMARY KEY REFERENCES sessions(id),
+                    midi BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value);
             """)
+        upgraded = False
+        if "events" in tables and "sessions" not in tables:
+            # События записаны до появления сессий
+            upgraded = self.cur.execute("SELECT 1 FROM events LIMIT 1").fetchone() is not None
+        if "sessions" in tables and "session_stats" not in tables:
+            # Сессии записаны до появления статистики
+            upgraded = upgraded or self.cur.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is not None
+        # Сводки появились позже сессий
+        rollups_missing = "sessions" in tables and "daily_stats" not in tables
+        self.cur.executescript("""
+                CREATE INDEX IF NOT EXISTS idx_events_device_ts ON events(device_id, ts);
+                CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions(start_ts);
+                CREATE INDEX IF NOT EXISTS idx_sessions_device_start ON sessions(device_id, start_ts);
+                CREATE INDEX IF NOT EXISTS idx_daily_stats_day ON daily_stats(day);
+            """)
+        # Индексы, которые не использует ни один план QUERIES (explain_queries), а обновлять
+        # их приходится на каждой записи: end_ts сессии меняется с каждой пачкой событий
+        self.cur.executescript("""
+                DROP INDEX IF EXISTS idx_events_ts;
+                DROP INDEX IF EXISTS idx_sessions_end;
+                DROP INDEX IF EXISTS idx_sessions_device_end;
+            """)
+        self.con.commit()
+        return upgraded, rollups_missing
+
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cur.close()
-        self.conn.close()
-        super().__exit__()
+        self.close()
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество событий, ожидающих записи"""
+        return self.writer.depth if self.writer else 0
+
+    def flush(self, timeout: float = None) -> bool:
+        """Дожидается записи всех событий из очереди"""
+        if self.writer:
+            return self.writer.flush(timeout)
+        return True
+
+    def close(self):
+        """Записывает остаток очереди и закрывает соединение"""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        with self._render_lock:
+            pool, self._render_pool = self._render_pool, None
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        self.readers.close()
+        with self._write_lock:
+            # Обновляет статистику планировщика для новых индексов
+            with suppress(Exception):
+                self.cur.execute("PRAGMA optimize")
+            self.cur.close()
+            self.con.close()
+
+    def _connect_writer(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        if not con.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            # Режим выбирается только в пустой БД, до создания таблиц и перехода в WAL
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        apply_pragmas(con, STORAGE_MODES[self.storage_mode]["writer"])
+        return con
 
     def refresh_cursor(self):
         log.warning('refresh connection')
-        self.con = sqlite3.connect()
-        self.cur = self.con.cursor()
+        with self._write_lock:
+            with suppress(Exception):
+                self.con.close()
+            self.con = self._connect_writer()
+            self.cur = self.con.cursor()
 
-    def retry(self, input_name, message):
-        self.retires += 1
-        if self.retires == self.MAX_RETIRES:
-            time.sleep(1)
-            self.retires = 0
-            self.retry(input_name, message)
-        try:
-            self.refresh_cursor()
-            self.add_messages(input_name, message)
-        except Exception as e:
-            log.error(e)
-            log.error(e)
-            time.sleep(.01)
-            self.retry()
-
-    def add_messages(self, input_name, message):
-        timestamp = datetime.utcnow()
-        data = [(
-            timestamp,
+    def retry(self, row: tuple) -> bool:
+        """
+        Повторяет запись события после ошибки: переподключается и пробует
+        до MAX_RETIRES раз с нарастающей паузой
+        :param row: (ts в наносекундах, имя устройства, байты сообщения)
+        :return: True, если событие записано
+        """
+        for attempt in range(1, self.MAX_RETIRES + 1):
+            time.sleep(.01 * 4 ** attempt)
+            try:
+                self.refresh_cursor()
+                self.write_rows([row])
+            except Exception as e:
+                log.error(f"Retry {attempt} failed: {e}")
+            else:
+                return True
+        self.metrics.incr("lost_events")
+        return False
+
+    def _device_id(self, input_name: str) -> int:
+        """Возвращает id устройства, создавая запись при первом появлении"""
+        device_id = self._device_ids.get(input_name)
+        if device_id is None:
+            self.cur.execute("INSERT OR IGNORE INTO devices(name) VALUES (?)", (input_name,))
+            self.cur.execute("SELECT id FROM devices WHERE name = ?", (input_name,))
+            device_id = self._device_ids[input_name] = self.cur.fetchone()[0]
+        return device_id
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция на соединении писателя: commit при успехе, rollback при ошибке"""
+        with self._write_lock:
+            try:
+                yield self.cur
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                # id новых устройств и состояние сессий откатились вместе с транзакцией
+                self._device_ids.clear()
+                self._open_sessions.clear()
+                raise
+
+    @staticmethod
+    def _read_meta(cur: sqlite3.Cursor, key: str, default=None):
+        row = cur.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _check_generation(self, cur: sqlite3.Cursor):
+        """
+        Сверяет поколение сессий в meta с тем, для которого закешированы открытые сессии.
+        rebuild_sessions, в том числе из другого процесса, удаляет и перенумеровывает
+        сессии и увеличивает поколение; тогда кеш сбрасывается, сессии читаются заново,
+        а session_gap берётся тот, с которым они пересобраны.
+        Вызывается внутри транзакции записи
+        """
+        generation = self._read_meta(cur, "sessions_generation", 0)
+        if generation != self._generation:
+            self._open_sessions.clear()
+            self.session_gap = self._read_meta(cur, "session_gap", self.SESSION_GAP)
+            self._generation = generation
+
+    def _check_cache_generation(self, cur: sqlite3.Cursor):
+        """
+        То же для читателей: после rebuild_sessions в другом процессе сбрасывает кеш
+        готовых файлов (id сессий переиспользуются) и перечитывает session_gap для is_closed
+        """
+        generation = self._read_meta(cur, "sessions_generation", 0)
+        if generation != self.generation:
+            self.cache.clear()
+            self.session_gap = self._read_meta(cur, "session_gap", self.SESSION_GAP)
+            self.generation = generation
+
+    def _session_for(self, device_id: int, ts: int) -> "OpenSession":
+        """
+        Возвращает открытую сессию устройства для события с меткой ts,
+        начиная новую, если пауза с последнего события >= session_gap
+        """
+        session = self._open_sessions.get(device_id)
+        if session is None:
+            self.cur.execute(
+                "SELECT id, start_ts, end_ts, first_event_id, last_event_id, note_count "
+                "FROM sessions WHERE device_id = ? ORDER BY start_ts DESC LIMIT 1",
+                (device_id,)
+            )
+            row = self.cur.fetchone()
+            if row:
+                session = self._open_sessions[device_id] = OpenSession(device_id, *row)
+                self.cur.execute(
+                    "SELECT pitches, velocities, channels FROM session_stats WHERE session_id = ?", (session.id,)
+                )
+                stats = self.cur.fetchone()
+                if stats:
+                    session.load_stats(*stats)
+
+        if session is None or ts - session.end_ts >= self.session_gap:
+            if session is not None:
+                self._close_session(session)
+            self.cur.execute(
+                "INSERT INTO sessions(device_id, start_ts, end_ts) VALUES (?, ?, ?)",
+                (device_id, ts, ts)
+            )
+            session = self._open_sessions[device_id] = OpenSession(device_id, self.cur.lastrowid, ts, ts)
+        return session
+
+    def _close_session(self, session: "OpenSession"):
+        """
+        Добавляет закончившуюся сессию в дневную сводку устройства (по дню начала, UTC).
+        Последняя сессия устройства в сводки не входит, пока не начнётся следующая
+        """
+        self.cur.execute(
+            "INSERT INTO daily_stats(device_id, day, play_ns, session_count, note_count) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT(device_id, day) DO UPDATE SET play_ns = play_ns + excluded.play_ns, "
+            "session_count = session_count + 1, note_count = note_count + excluded.note_count",
+            (session.device_id, session.start_ts // NS_PER_DAY, session.end_ts - session.start_ts,
+             session.note_count)
+        )
+
+    def _save_sessions(self, sessions):
+        self.cur.executemany(
+            "UPDATE sessions SET start_ts = ?, end_ts = ?, first_event_id = ?, last_event_id = ?, note_count = ? "
+            "WHERE id = ?",
+            [(s.start_ts, s.end_ts, s.first_event_id, s.last_event_id, s.note_count, s.id) for s in sessions]
+        )
+        self.cur.executemany(
+            "INSERT OR REPLACE INTO session_stats(session_id, pitches, velocities, channels) VALUES (?, ?, ?, ?)",
+            [(s.id, s.pitches.tobytes(), s.velocities.tobytes(), s.channels) for s in sessions]
+        )
+
+    def _insert_rows(self, data: list, sessionize: bool = True):
+        """
+        :param sessionize: Сразу относить события к сессиям. Для исторических
+            данных выключается, сессии потом строит rebuild_sessions.
+        Шарды месяцев событий должны быть уже подключены. Принадлежность события
+        сессии задаётся устройством и интервалом сессии
+        """
+        shards = self.shards
+        schemas = {month: shards.target(month) for month in {shards.month(row[0]) for row in data}}
+        if not sessionize:
+            for month, rows in groupby(data, key=lambda row: shards.month(row[0])):
+                self.cur.executemany(
+                    f"INSERT INTO {schemas[month]}.events(ts, device_id, data) VALUES (?, ?, ?)",
+                    [(ts, self._device_id(input_name), payload) for ts, input_name, payload in rows]
+                )
+            return
+
+        touched = {}
+        for ts, input_name, payload in data:
+            session = self._session_for(self._device_id(input_name), ts)
+            self.cur.execute(
+                f"INSERT INTO {schemas[shards.month(ts)]}.events(ts, device_id, data) VALUES (?, ?, ?)",
+                (ts, session.device_id, payload)
+            )
+            session.add(self.cur.lastrowid, ts, payload)
+            touched[session.id] = session
+        self._save_sessions(touched.values())
+
+    def write_rows(self, data: list, journal: tuple = None):
+        """
+        Записывает пачку событий одной транзакцией
+        :param data: Список (ts в наносекундах, имя устройства, байты сообщения)
+        :param journal: Для пачки из журнала: (id журнала, позиции записей data, позиция после пачки).
+            Позиция после пачки сохраняется в meta основной БД и каждого шарда, куда попали события.
+            В режиме WAL commit нескольких подключенных файлов не атомарен, и после падения
+            часть файлов может уже содержать пачку. Поэтому при повторе событие пишется, только если
+            его позиция не меньше сохранённой в его файле, а к сессиям относится, только если
+            она не меньше сохранённой в основной БД (_replay_rows)
+        """
+        start = time.perf_counter_ns()
+        with self._write_lock:
+            months = sorted({self.shards.month(row[0]) for row in data})
+            self.shards.attach(self.con, months)
+            with self._transaction() as cur:
+                self._check_generation(cur)
+                if journal is None:
+                    self._insert_rows(data)
+                else:
+                    self._replay_rows(cur, data, *journal)
+        self.metrics.commit(time.perf_counter_ns() - start, (row[0] for row in data), time.time_ns())
+
+    def _journal_checkpoint(self, cur: sqlite3.Cursor, schema: str, journal_id: int) -> int:
+        """:return: Позиция журнала, до которой записаны события файла schema; 0 — для другого журнала"""
+        row = cur.execute(f"SELECT value FROM {schema}.meta WHERE key = ?", (self.JOURNAL_KEY,)).fetchone()
+        if not row:
+            return 0
+        saved_id, pos = map(int, row[0].split(":"))
+        return pos if saved_id == journal_id else 0
+
+    def _replay_rows(self, cur: sqlite3.Cursor, data: list, journal_id: int, positions: list, end: int):
+        shards = self.shards
+        schemas = {month: shards.target(month) for month in {shards.month(row[0]) for row in data}}
+        checkpoints = {schema: self._journal_checkpoint(cur, schema, journal_id)
+                       for schema in {"main", *schemas.values()}}
+        if positions[0] >= max(checkpoints.values()):
+            # Обычный случай: пачка не попала ещё ни в один файл
+            self._insert_rows(data)
+        else:
+            log.warning(f"Journal batch at {positions[0]} is partly written, skipping stored rows")
+            main_checkpoint = checkpoints["main"]
+            touched = {}
+            for pos, (ts, input_name, payload) in zip(positions, data):
+                schema = schemas[shards.month(ts)]
+                device_id = self._device_id(input_name)
+                event_id = None
+                if pos >= checkpoints[schema]:
+                    cur.execute(
+                        f"INSERT INTO {schema}.events(ts, device_id, data) VALUES (?, ?, ?)", (ts, device_id, payload)
+                    )
+                    event_id = cur.lastrowid
+                if pos < main_checkpoint:
+                    continue
+                if event_id is None:
+                    # Событие уже в шарде, а сессия основной БД о нём не знает
+                    event_id = cur.execute(
+                        f"SELECT id FROM {schema}.events WHERE device_id = ? AND ts = ? AND data = ?",
+                        (device_id, ts, payload)
+                    ).fetchone()[0]
+                session = self._session_for(device_id, ts)
+                session.add(event_id, ts, payload)
+                touched[session.id] = session
+            self._save_sessions(touched.values())
+
+        for schema in checkpoints:
+            cur.execute(f"INSERT OR REPLACE INTO {schema}.meta(key, value) VALUES (?, ?)",
+                        (self.JOURNAL_KEY, f"{journal_id}:{end}"))
+
+    def add_messages(self, input_name, message, timestamp: int = None):
+        """
+        :param timestamp: Время прихода события в epoch-наносекундах,
+            по умолчанию — момент вызова
+        """
+        row = (
+            timestamp or time.time_ns(),
             input_name,
-            message.type,
-            json.dumps(message.dict())
-        )]
-        log.debug("add message %s" % str(data))
+            bytes(message.bytes())
+        )
+
+        self.metrics.event(input_name)
+
+        if self.writer:
+            self.writer.put(row)
+            return
 
         try:
-            self.cur.executemany(
-                "INSERT INTO midi_log VALUES(NULL, ?, ?, ?, ?)", data
-            )
-            self.con.commit()
+            self.write_rows([row])
         except Exception as e:
             log.exception(e)
-            self.retry(input_name, message)
-        else:
-            self.retires = 0
+            self.metrics.incr("write_errors")
+            self.retry(row)
+
+    def migrate_legacy(self, batch_size: int = 10000, pause: float = .05, drop: bool = False) -> int:
+        """
+        Переносит события из старой таблицы midi_log в events. Имена устройств
+        вида str(port) приводятся к имени порта (port_name), как при захвате.
+        Работает пачками по ID с отдельным commit на каждую, поэтому её можно
+        запускать при работающем логгере; прогресс хранится в meta и
+        прерванная миграция продолжается с того же места
+        :param batch_size: Количество строк в одной транзакции
+        :param pause: Пауза между пачками, чтобы не задерживать запись новых событий
+        :param drop: Удалить таблицу midi_log после полного переноса
+        :return: Количество перенесённых событий
+        """
+        with self.readers.cursor() as cur:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'midi_log'")
+            if not cur.fetchone():
+                return 0
+            cur.execute("SELECT value FROM meta WHERE key = 'legacy_migrated_id'")
+            row = cur.fetchone()
+        last_id = row[0] if row else 0
+
+        migrated = 0
+        while True:
+            with self.readers.cursor() as cur:
+                cur.execute(
+                    "SELECT ID, timestamp, input_name, message FROM midi_log WHERE ID > ? ORDER BY ID LIMIT ?",
+                    (last_id, batch_size)
+                )
+                records = cur.fetchall()
+            if not records:
+                break
+
+            data = []
+            for record_id, timestamp, input_name, message in records:
+                try:
+                    msg = Message.from_dict(json.loads(message))
+                    ts = datetime_to_ns(parser.parse(timestamp))
+                    data.append((record_id, ts, port_name(input_name or ""), bytes(msg.bytes())))
+                except Exception as e:
+                    log.warning(f"Skip legacy row: {e}")
+            last_id = records[-1][0]
+
+            # Своя транзакция на каждый подряд идущий месяц: шард подключается до её начала
+            groups = [list(rows) for _, rows in groupby(data, key=lambda row: self.shards.month(row[1]))] or [[]]
+            for n, rows in enumerate(groups):
+                with self._write_lock:
+                    if rows:
+                        self.shards.attach(self.con, [self.shards.month(rows[0][1])])
+                    with self._transaction() as cur:
+                        self._insert_rows([row[1:] for row in rows], sessionize=False)
+                        cur.execute(
+                            "INSERT OR REPLACE INTO meta(key, value) VALUES ('legacy_migrated_id', ?)",
+                            (last_id if n == len(groups) - 1 else rows[-1][0],)
+                        )
+            migrated += len(data)
+            log.info(f"Migrated {migrated} legacy events (ID <= {last_id})")
+            time.sleep(pause)
+
+        if migrated:
+            self.rebuild_sessions()
+        if drop:
+            with self._transaction() as cur:
+                cur.execute("DROP TABLE midi_log")
+                cur.execute("DELETE FROM meta WHERE key = 'legacy_migrated_id'")
+        return migrated
+
+    def rebuild_sessions(self) -> int:
+        """
+        Заново разбивает все события на сессии по устройствам с текущим session_gap
+        и сохраняет его в meta. Нужна после переноса исторических данных или смены паузы.
+        Вся пересборка — одна транзакция основной БД (BEGIN IMMEDIATE): читатели до commit
+        видят старые сессии, прерванная пересборка ничего не меняет. События основной БД
+        и шардов, в том числе замороженных, только читаются соединением читателя:
+        сессия находит свои события по устройству и интервалу. Запись на это время
+        приостанавливается, логгер в другом процессе ждёт busy_timeout и повторяет.
+        Поколение сессий в meta увеличивается, поэтому работающий логгер
+        сбрасывает свои открытые сессии перед следующей записью (_check_generation).
+        Границы и статистика сессий считаются векторно (segment, segment_stats)
+        :return: Количество сессий
+        """
+        with self._write_lock:
+            self.cur.execute("BEGIN IMMEDIATE")
+            with self._transaction() as cur, self.readers.cursor() as main, self.readers.cursor() as shards:
+                # Сжатые сессии событий уже не имеют, они остаются как есть
+                cur.execute("DELETE FROM session_stats WHERE session_id NOT IN (SELECT session_id FROM session_archive)")
+                cur.execute("DELETE FROM sessions WHERE id NOT IN (SELECT session_id FROM session_archive)")
+                cur.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('session_gap', ?)", (self.session_gap,))
+                cur.execute(
+                    "INSERT INTO meta(key, value) VALUES ('sessions_generation', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+                self._check_generation(cur)
+
+                count = 0
+                for device_id in [row[0] for row in main.execute("SELECT id FROM devices").fetchall()]:
+                    count += self._rebuild_device_sessions(cur, self._device_events(main, shards, device_id), device_id)
+                self._rebuild_daily_stats(cur)
+        # id сессий поменялись, старые файлы в кеше больше не соответствуют им
+        self.cache.clear()
+        self.generation = self._generation
+        return count
+
+    def _device_events(self, main: sqlite3.Cursor, shards: sqlite3.Cursor, device_id: int) -> Iterator[tuple]:
+        """
+        События устройства из основной БД и всех шардов по возрастанию ts.
+        В основной БД, кроме событий до появления шардов, лежат поздние события
+        замороженных месяцев, поэтому она сливается с цепочкой шардов
+        :param main: Курсор читателя для основной БД
+        :param shards: Курсор другого соединения читателя, к нему по очереди подключаются шарды
+        :return: Генератор (id, ts, data)
+        """
+        query = "SELECT id, ts, data FROM {events} WHERE device_id = ? ORDER BY ts, id"
+
+        def read(cur: sqlite3.Cursor, table: str):
+            cur.execute(query.format(events=table), (device_id,))
+            while chunk := cur.fetchmany(self.EVENT_CHUNK_SIZE):
+                yield from chunk
+
+        def shard_events():
+            for month in self.shards.existing():
+                schema = self.shards.attach(shards.connection, [month], readonly=True)[0]
+                yield from read(shards, f"{schema}.events")
+
+        return heapq.merge(read(main, "main.events"), shard_events(), key=itemgetter(1))
+
+    def _rebuild_device_sessions(self, cur: sqlite3.Cursor, events: Iterator[tuple], device_id: int) -> int:
+        """
+        Разбивает события устройства на сессии и сохраняет их. События обрабатываются
+        порциями по REBUILD_CHUNK_SIZE, последняя сессия порции может продолжиться
+        в следующей, поэтому память не зависит от длины истории устройства
+        :param events: (id, ts, data) по возрастанию ts (_device_events)
+        :return: Количество сессий
+        """
+        session = None
+        count = 0
+        while rows := list(islice(events, self.REBUILD_CHUNK_SIZE)):
+            event_ids, timestamps, payloads = zip(*rows)
+            event_ids = np.fromiter(event_ids, np.int64, len(rows))
+            timestamps = np.fromiter(timestamps, np.int64, len(rows))
+            starts = segment(timestamps, self.session_gap)
+            ends = np.append(starts[1:], len(rows)) - 1
+            note_counts, pitches, velocities, channels = segment_stats(payloads, starts)
+
+            sessions = []
+            for n, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+                ts = int(timestamps[start])
+                if session is None or ts - session.end_ts >= self.session_gap:
+                    cur.execute(
+                        "INSERT INTO sessions(device_id, start_ts, end_ts) VALUES (?, ?, ?)", (device_id, ts, ts)
+                    )
+                    session = OpenSession(device_id, cur.lastrowid, ts, ts)
+                    count += 1
+                session.add_segment(int(event_ids[start]), int(event_ids[end]), int(timestamps[end]),
+                                    int(note_counts[n]), pitches[n], velocities[n], channels[n])
+                sessions.append(session)
+            self._save_sessions(sessions)
+        return count
+
+    def rebuild_daily_stats(self) -> int:
+        """
+        Пересчитывает дневные сводки из таблицы sessions.
+        Последние (ещё открытые) сессии устройств не включаются, как и при записи
+        :return: Количество строк в сводках
+        """
+        with self._transaction() as cur:
+            return self._rebuild_daily_stats(cur)
+
+    @staticmethod
+    def _rebuild_daily_stats(cur: sqlite3.Cursor) -> int:
+        cur.execute("DELETE FROM daily_stats")
+        cur.execute(
+            """
+            INSERT INTO daily_stats(device_id, day, play_ns, session_count, note_count)
+            SELECT device_id, start_ts / ?, SUM(end_ts - start_ts), COUNT(*), SUM(note_count)
+            FROM sessions
+            WHERE id NOT IN (
+                SELECT (SELECT id FROM sessions WHERE device_id = devices.id ORDER BY start_ts DESC LIMIT 1)
+                FROM devices)
+            GROUP BY device_id, start_ts / ?
+            """,
+            (NS_PER_DAY, NS_PER_DAY)
+        )
+        return cur.rowcount
+
+    def compact_sessions(self, days: int = None, batch_size: int = None, vacuum: bool = True) -> int:
+        """
+        Сжимает сессии, закончившиеся больше days дней назад: события сессии без потерь
+        сохраняются в session_archive одним сжатым блобом (pack_events) и удаляются из events.
+        Сессия, статистика и сводки остаются. Каждая сессия — отдельная транзакция,
+        поэтому задачу можно запускать при работающем логгере. Сессии из
+        замороженных шардов (freeze_shards) не трогаются
+        :param days: Возраст сессий в днях, по умолчанию RETENTION_DAYS
+        :param batch_size: Сколько сессий собирать за раз, по умолчанию COMPACT_BATCH_SIZE
+        :param vacuum: Вернуть освободившееся место файлу через incremental VACUUM
+        :return: Количество сжатых сессий
+        """
+        days = self.RETENTION_DAYS if days is None else days
+        batch_size = batch_size or self.COMPACT_BATCH_SIZE
+        cutoff = time.time_ns() - days * NS_PER_DAY
+
+        compacted = 0
+        after = (-1, 0)  # (start_ts, id) последней просмотренной сессии
+        while True:
+            with self.readers.cursor() as cur:
+                cur.execute(self.QUERIES["sessions_to_archive"], (cutoff, *after, batch_size))
+                page = cur.fetchall()
+                if not page:
+                    break
+                after = (page[-1][2], page[-1][0])
+                rows = [
+                    row for row in page
+                    if all(self.shards.writable(month) for month in self.shards.existing(row[2], row[3]))
+                ]
+                sessions = [self._session_messages(cur, row[0]) for row in rows]
+
+            blobs = [pack_events(messages) for messages in sessions]
+            for (session_id, device_id, start_ts, end_ts), blob in zip(rows, blobs):
+                with self._write_lock:
+                    months = self.shards.existing(start_ts, end_ts)
+                    schemas = ["main"] + self.shards.attach(self.con, months)
+                    with self._transaction() as cur:
+                        cur.execute("INSERT INTO session_archive(session_id, midi) VALUES (?, ?)", (session_id, blob))
+                        for schema in schemas:
+                            cur.execute(
+                                f"DELETE FROM {schema}.events WHERE device_id = ? AND ts BETWEEN ? AND ?",
+                                (device_id, start_ts, end_ts)
+                            )
+            compacted += len(rows)
+            log.info(f"Compacted {compacted} sessions")
+
+        if vacuum and compacted:
+            self.vacuum()
+        return compacted
+
+    def vacuum(self, pages: int = 0, full: bool = False) -> int:
+        """
+        Возвращает свободные страницы файлам основной БД и незамороженных шардов
+        через incremental VACUUM порциями по VACUUM_CHUNK_PAGES: между порциями
+        запись не ждёт. Файл, созданный без auto_vacuum = INCREMENTAL, переводится
+        в этот режим только с full: полный VACUUM переписывает файл целиком
+        и всё это время держит блокировку записи, поэтому логгер нужно остановить
+        :param pages: Сколько страниц освободить в каждом файле, 0 — все
+        :param full: Разрешить полный VACUUM таких файлов
+        :return: Количество освобождённых страниц
+        """
+        released = 0
+        for month in [None] + [month for month in self.shards.existing() if self.shards.writable(month)]:
+            with self._write_lock:
+                schema = "main" if month is None else self.shards.attach(self.con, [month])[0]
+                if self.cur.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != 2:
+                    if not full:
+                        log.warning(f"auto_vacuum of {schema} is not incremental, skipping; "
+                                    "run a full vacuum while the logger is stopped")
+                        continue
+                    log.warning(f"auto_vacuum of {schema} is not incremental, running full VACUUM")
+                    before = self.cur.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                    self.cur.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+                    self.cur.execute(f"VACUUM {schema}")
+                    released += before - self.cur.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                    continue
+
+            done = 0
+            while not pages or done < pages:
+                step = self.VACUUM_CHUNK_PAGES if not pages else min(self.VACUUM_CHUNK_PAGES, pages - done)
+                with self._write_lock:
+                    schema = "main" if month is None else self.shards.attach(self.con, [month])[0]
+                    before = self.cur.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                    if not before:
+                        break
+                    # Прагма освобождает по странице за шаг; execute делает только первый,
+                    # executescript выполняет её до конца
+                    self.cur.executescript(f"PRAGMA {schema}.incremental_vacuum({int(step)});")
+                    freed = before - self.cur.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                if not freed:
+                    break
+                done += freed
+            released += done
+        log.info(f"Vacuum released {released} pages")
+        return released
+
+    def freeze_shards(self, keep_months: int = 1) -> list[str]:
+        """
+        Делает шарды прошлых месяцев файлами только для чтения: WAL сбрасывается
+        в файл, журнал переключается в DELETE, права на запись снимаются.
+        Такой файл больше не меняется, его достаточно один раз сохранить в бэкап,
+        а читатели открывают его с immutable=1. Шард, который держит соединение
+        другого процесса или занятый запросом читатель, пропускается до следующего запуска
+        :param keep_months: Сколько последних месяцев, кроме текущего, оставить открытыми для записи
+        :return: Замороженные месяцы
+        """
+        start, _, _ = self.shards.bounds(time.time_ns())
+        for _ in range(keep_months):
+            start, _, _ = self.shards.bounds(start - 1)
+        frozen = []
+        for month in self.shards.existing():
+            if month >= self.shards.month(start) or not self.shards.writable(month):
+                continue
+            # Из WAL файл выводится, только когда его не держит ни одно соединение
+            schema = self.shards.schema(month)
+            with self._write_lock:
+                with suppress(sqlite3.OperationalError):
+                    self.con.execute(f"DETACH DATABASE {schema}")
+            self.readers.detach(schema)
+            path = self.shards.path(month)
+            con = sqlite3.connect(path)
+            try:
+                con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                mode = con.execute("PRAGMA journal_mode = DELETE").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                log.warning(f"Shard {month} is in use, not frozen: {e}")
+                continue
+            finally:
+                con.close()
+            if mode != "delete":
+                # Шард открыт другим процессом — попробуем в следующий раз
+                log.warning(f"Shard {month} is in use, not frozen")
+                continue
+            path.chmod(0o444)
+            frozen.append(month)
+            log.info(f"Shard {month} frozen")
+        return frozen
+
+    def get_practice_summary(self, days: int, input_name: str = None) -> dict:
+        """
+        Сводка занятий по дням: дневные сводки плюс ещё открытые сессии устройств,
+        без чтения событий
+        :param days: Период в календарных днях (UTC), включая сегодняшний, 0 — всё время
+        :param input_name: Фильтр по устройству (опционально)
+        :return: {дата: (время игры в секундах, количество сессий, количество нот)} по возрастанию дат
+        """
+        first_day = period_start(days) // NS_PER_DAY
+        totals = defaultdict(lambda: [0, 0, 0])
+        with self.readers.cursor() as cur:
+            if input_name:
+                cur.execute(self.QUERIES["device_daily_stats"], (input_name, first_day))
+            else:
+                cur.execute(self.QUERIES["daily_stats"], (first_day,))
+            for day, play_ns, session_count, note_count in cur.fetchall():
+                day_totals = totals[day]
+                day_totals[0] += play_ns
+                day_totals[1] += session_count
+                day_totals[2] += note_count
+
+            if input_name:
+                cur.execute(self.QUERIES["device_open_sessions"], (input_name, first_day * NS_PER_DAY))
+            else:
+                cur.execute(self.QUERIES["open_sessions"], (first_day * NS_PER_DAY,))
+            for start_ts, end_ts, note_count in cur.fetchall():
+                day_totals = totals[start_ts // NS_PER_DAY]
+                day_totals[0] += end_ts - start_ts
+                day_totals[1] += 1
+                day_totals[2] += note_count
+
+        return {
+            ns_to_datetime(day * NS_PER_DAY).date(): (play_ns / NS_PER_SEC, session_count, note_count)
+            for day, (play_ns, session_count, note_count) in sorted(totals.items())
+        }
 
     def get_midi_logs(self, days: int, input_name: str = None) -> list[tuple[str, bytes, int, str, str]]:
         """
@@ -88,96 +1693,193 @@ class MidiLog:
         - отформатированное время (чч:мм)
         """
         try:
-            # 1. Запрос к БД с фильтрами
-            query = """
-                SELECT timestamp, message 
-                FROM midi_log 
-                WHERE timestamp >= ? 
-                {}  -- Фильтр по устройству
-                ORDER BY timestamp
-            """
-            conditions = []
-            params = []
+            return list(self.iter_midi_logs(days, input_name))
+        except Exception as e:
+            logging.error(f"Error in get_midi_logs: {e}")
+            return []
 
-            if days > 0:
-                cutoff_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
-                params.append(cutoff_date)
+    def iter_midi_logs(self, days: int, input_name: str = None,
+                       cancel: threading.Event = None) -> Iterator[tuple[str, bytes, int, str, str]]:
+        """
+        Потоковый вариант get_midi_logs: отдаёт сессии по одной в том же формате.
+        Сессии читаются страницами, события — порциями, соединение из пула
+        не удерживается между yield, поэтому память ограничена самой большой сессией
+        :param days: Период в календарных днях (UTC), включая сегодняшний, 0 — всё время
+        :param input_name: Фильтр по устройству (опционально)
+        :param cancel: Событие отмены: выгрузка завершается перед сборкой следующей сессии
+        """
+        # 1. Запрос сессий с фильтрами
+        cutoff = period_start(days)  # 0 — все записи
+        # Страницы начинаются с самой ранней сессии, которая ещё идёт в cutoff, а не с начала
+        # таблицы: сессии устройства не пересекаются, такая у него только последняя до cutoff
+        with self.readers.cursor() as cur:
+            if input_name:
+                cur.execute(self.QUERIES["device_spanning_session"], (input_name, cutoff))
             else:
-                params.append("1970-01-01")  # Все записи
-
+                cur.execute(self.QUERIES["spanning_sessions"], (cutoff,))
+            first_ts = min([row[0] for row in cur.fetchall()], default=cutoff)
+        after = (first_ts - 1, 0)  # (start_ts, id) последней отданной сессии
+        while True:
             if input_name:
-                conditions.append("AND input_name = ?")
-                params.append(input_name)
+                query = self.QUERIES["device_sessions_since"]
+                params = (input_name, cutoff, *after, self.SESSION_PAGE_SIZE)
+            else:
+                query = self.QUERIES["sessions_since"]
+                params = (cutoff, *after, self.SESSION_PAGE_SIZE)
+            with self.readers.cursor() as cur:
+                cur.execute(query, params)
+                page = cur.fetchall()
+            if not page:
+                return
 
-            query = query.format(" ".join(conditions))
-            self.cur.execute(query, params)
-            records = self.cur.fetchall()
+            # 2. Создание MIDI-файлов с учетом времени
+            for row, midi_bytes in zip(page, self._render_sessions(page, cancel)):
+                if midi_bytes is None:
+                    return
+                yield self._session_file(row, midi_bytes, input_name)
+            after = (page[-1][1], page[-1][0])
 
-            if not records:
-                return []
-
-            # 2. Группировка по сессиям (интервал >=1 минуты = новая сессия)
-            sessions = {}  # Инициализируем словарь сессий
-            session_id = 0
-            prev_timestamp = parser.parse(records[0][0])
-
-            for row in records:
-                current_timestamp = parser.parse(row[0])
-                if (current_timestamp - prev_timestamp) >= timedelta(minutes=1):
-                    session_id += 1
-                if session_id not in sessions:
-                    sessions[session_id] = {
-                        "start_time": current_timestamp,
-                        "messages": []
-                    }
-                sessions[session_id]["messages"].append((current_timestamp, json.loads(row[1])))
-                prev_timestamp = current_timestamp
-
-            # 3. Создание MIDI-файлов с учетом времени
-            result = []
-            for session_id, data in sessions.items():
-                midi_file = MidiFile()
-                track = MidiTrack()
-                midi_file.tracks.append(track)
-
-                prev_time = data["start_time"]
-                notes_count = 0  # Счетчик нот
-
-                for timestamp, msg_dict in data["messages"]:
-                    delta_ticks = int((timestamp - prev_time).total_seconds() * 1000)
-                    msg = Message.from_dict(msg_dict)
-                    msg.time = delta_ticks
-                    track.append(msg)
-                    prev_time = timestamp
-
-                    # Подсчет нот
-                    if msg.type == 'note_on':
-                        notes_count += 1
-
-                # Сохраняем в bytes
-                midi_bytes = io.BytesIO()
-                midi_file.save(file=midi_bytes)
-
-                # Форматируем дату и время
-                device_tag = f"_{input_name}" if input_name else ""
-                start_time = data['start_time']
-                session_name = f"session_{session_id}{device_tag}_{start_time.strftime('%Y-%m-%d_%H-%M')}.mid"
-                formatted_date = start_time.strftime("%d.%m.%Y")
-                formatted_time = start_time.strftime("%H:%M")
-
-                result.append((
-                    session_name,
-                    midi_bytes.getvalue(),
-                    notes_count,
-                    formatted_date,
-                    formatted_time
-                ))
-
-            return result
+    def _event_tables(self, cur: sqlite3.Cursor, session_id: int) -> tuple[list[str], tuple]:
+        """
+        Таблицы, где могут лежать события сессии: основная БД и шарды месяцев,
+        которые пересекает сессия. Нужные шарды подключаются к соединению читателя
+        :return: Таблицы и параметры выборки (устройство, начало, конец сессии)
+        """
+        cur.execute(self.QUERIES["session_span"], (session_id,))
+        row = cur.fetchone()
+        if not row:
+            return [], ()
+        months = self.shards.existing(row[1], row[2])
+        return ["main.events"] + [
+            f"{schema}.events" for schema in self.shards.attach(cur.connection, months, readonly=True)
+        ], row
 
-        except Exception as e:
-            logging.error(f"Error in get_midi_logs: {e}")
-            return []
+    def _read_events(self, cur: sqlite3.Cursor, session_id: int, query: str) -> list:
+        events = []
+        tables, params = self._event_tables(cur, session_id)
+        for table in tables:
+            cur.execute(self.QUERIES[query].format(events=table), params)
+            while chunk := cur.fetchmany(self.EVENT_CHUNK_SIZE):
+                events.extend(chunk)
+        # Шарды идут по возрастанию месяцев, но в основной БД, кроме самых старых,
+        # лежат поздние события замороженных месяцев
+        events.sort(key=itemgetter(0))
+        return events
+
+    def _session_messages(self, cur: sqlite3.Cursor, session_id: int) -> list:
+        messages = self._read_events(cur, session_id, "session_events")
+        if not messages:
+            # У сжатой сессии событий нет, они восстанавливаются из файла
+            cur.execute(self.QUERIES["session_archive"], (session_id,))
+            row = cur.fetchone()
+            if row and row[0].startswith(ARCHIVE_MAGIC):
+                messages = unpack_events(row[0])
+            elif row:
+                # Сжатая прежней версией сессия: события с точностью до тика файла
+                messages = midi_events(zlib.decompress(row[0]), row[1])
+        return messages
+
+    def _archived_midi(self, cur: sqlite3.Cursor, session_id: int):
+        """:return: Готовый MIDI-файл сессии, сжатой прежней версией, или None"""
+        cur.execute(self.QUERIES["session_archive"], (session_id,))
+        row = cur.fetchone()
+        return zlib.decompress(row[0]) if row and not row[0].startswith(ARCHIVE_MAGIC) else None
+
+    def _render_session(self, row: tuple) -> bytes:
+        return next(self._render_sessions([row]))
+
+    def _render_sessions(self, rows: list, cancel: threading.Event = None) -> Iterator[bytes]:
+        """
+        Отдаёт MIDI-файлы сессий в исходном порядке: из кеша или собирая из событий.
+        Если собирать нужно хотя бы PARALLEL_MIN_SESSIONS сессий, работа делится
+        между процессами пула окнами по 2 сессии на процесс
+        :param rows: Строки sessions (id, start_ts, end_ts, first_event_id, last_event_id, note_count)
+        :param cancel: Событие отмены: после него вместо следующего окна отдаётся None
+        """
+        with self.readers.cursor() as cur:
+            self._check_cache_generation(cur)
+        keys = [(session_id, first_event_id, last_event_id)
+                for session_id, _, _, first_event_id, last_event_id, _ in rows]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, midi_bytes in enumerate(results) if midi_bytes is None]
+        parallel = len(missing) >= self.PARALLEL_MIN_SESSIONS and self.render_workers > 1
+        window = 2 * self.render_workers if parallel else 1
+
+        pos = 0
+        for i in range(len(rows)):
+            if results[i] is None:
+                if cancel is not None and cancel.is_set():
+                    yield None
+                    return
+                # Собираем окно следующих сессий, которых не было в кеше
+                batch = missing[pos:pos + window]
+                pos += len(batch)
+                sessions = []
+                rendered = []
+                for j in batch:
+                    with self.readers.cursor() as cur:
+                        # Сжатая сессия читается готовым файлом одним блобом
+                        results[j] = self._archived_midi(cur, rows[j][0])
+                        if results[j] is None:
+                            sessions.append(self._session_messages(cur, rows[j][0]))
+                            rendered.append(j)
+                for j, midi_bytes in zip(rendered, self._render_many(sessions)):
+                    self.cache.put(keys[j], midi_bytes, persistent=self.is_closed(rows[j]))
+                    results[j] = midi_bytes
+            yield results[i]
+            results[i] = None
+
+    def _render_many(self, sessions: list) -> list[bytes]:
+        if len(sessions) < 2:
+            return [render_midi(messages)[0] for messages in sessions]
+        with self._render_lock:
+            if self._render_pool is None:
+                self._render_pool = ProcessPoolExecutor(
+                    max_workers=self.render_workers, mp_context=multiprocessing.get_context(self.PROCESS_START_METHOD)
+                )
+            pool = self._render_pool
+        return [midi_bytes for midi_bytes, _ in pool.map(render_midi, sessions)]
+
+    @staticmethod
+    def _session_file(row: tuple, midi_bytes: bytes, input_name: str = None) -> tuple:
+        session_id, start_ts, _, _, _, notes_count = row
+
+        # Форматируем дату и время
+        device_tag = f"_{input_name}" if input_name else ""
+        start_time = ns_to_datetime(start_ts)
+        session_name = f"session_{session_id}{device_tag}_{start_time.strftime('%Y-%m-%d_%H-%M')}.mid"
+        formatted_date = start_time.strftime("%d.%m.%Y")
+        formatted_time = start_time.strftime("%H:%M")
+
+        return (
+            session_name,
+            midi_bytes,
+            notes_count,
+            formatted_date,
+            formatted_time
+        )
+
+    def explain_queries(self) -> dict[str, list[str]]:
+        """
+        Возвращает EXPLAIN QUERY PLAN для каждого запроса из QUERIES
+        и предупреждает в логе о полном просмотре таблиц, кроме SMALL_TABLES, и о проходе
+        по диапазону индекса без нижней границы в запросах больше чем на одну строку.
+        Нижнюю границу вида (start_ts, id) > (?, ?) план показывает всегда, поэтому запрос
+        должен получать в ней настоящую границу, а не -1
+        :return: Словарь имя запроса -> строки плана
+        """
+        plans = {}
+        with self.readers.cursor() as cur:
+            for name, query in self.QUERIES.items():
+                cur.execute(f"EXPLAIN QUERY PLAN {query.format(events='events')}", self.QUERY_SAMPLE_PARAMS[name])
+                plans[name] = [row[3] for row in cur.fetchall()]
+                single_row = re.search(r"\bLIMIT 1\b(?!\s*OFFSET)", query) is not None
+                for detail in plans[name]:
+                    if detail.startswith("SCAN") and "INDEX" not in detail and detail[5:] not in self.SMALL_TABLES:
+                        log.warning(f"Query {name} does a full scan: {detail}")
+                    elif detail.startswith("SEARCH") and "<" in detail and ">" not in detail and not single_row:
+                        log.warning(f"Query {name} walks an index range without a lower bound: {detail}")
+        return plans
 
     def play_midi(self, ordered_num: int, output_device: str = None) -> str:
         """
@@ -188,39 +1890,18 @@ class MidiLog:
         """
         try:
             # 1. Получаем MIDI-файл из БД
-            query = """
-                SELECT timestamp, message 
-                FROM midi_log 
-                WHERE session_id = (
-                    SELECT session_id 
-                    FROM (
-                        SELECT DISTINCT session_id 
-                        FROM midi_log 
-                        ORDER BY MIN(timestamp)
-                    ) 
-                    LIMIT 1 OFFSET ?
-                )
-                ORDER BY timestamp
-            """
-            self.cur.execute(query, (ordered_num - 1,))
-            records = self.cur.fetchall()
+            with self.readers.cursor() as cur:
+                cur.execute(self.QUERIES["session_by_number"], (ordered_num - 1,))
+                row = cur.fetchone()
+                records = self._session_messages(cur, row[0]) if row else []
 
             if not records:
                 return f"🚫 Сессия №{ordered_num} не найдена"
 
-            # 2. Создаем MIDI-файл в памяти
-            midi_file = MidiFile()
-            track = MidiTrack()
-            midi_file.tracks.append(track)
-
-            prev_time = parser.parse(records[0][0])
-            for row in records:
-                current_time = parser.parse(row[0])
-                delta = int((current_time - prev_time).total_seconds() * 1000)
-                msg = Message.from_dict(json.loads(row[1]))
-                msg.time = delta
-                track.append(msg)
-                prev_time = current_time
+            # 2. Смещения от начала сессии с исходной (наносекундной) точностью.
+            # Отправляются только канальные сообщения
+            start_ts = records[0][0]
+            events = [(ts - start_ts, data) for ts, data in records if data[0] < 0xF0]
 
             # 3. Воспроизведение с выбором устройства
             try:
@@ -247,10 +1928,7 @@ class MidiLog:
                 # 4. Воспроизведение в отдельном потоке
                 def play_thread():
                     try:
-                        for msg in midi_file:
-                            if msg.type in ['note_on', 'note_off', 'control_change']:
-                                midi_out.send_message(msg.bytes())
-                            time.sleep(msg.time / 1000)  # Преобразуем ms в секунды
+                        Player(midi_out.send_message).play(events)
                     finally:
                         midi_out.close_port()
                         del midi_out
@@ -274,10 +1952,7 @@ class MidiLog:
                             break
 
                 player = pygame.midi.Output(device_id)
-                for msg in midi_file:
-                    if msg.type in ['note_on', 'note_off']:
-                        player.write_short(msg.bytes())
-                    time.sleep(msg.time / 1000)
+                Player(lambda data: player.write_short(*data)).play(events)
                 player.close()
 
                 return f"🎵 Воспроизведено сессия №{ordered_num} (через pygame.midi)"
@@ -289,79 +1964,151 @@ class MidiLog:
     def get_session_by_id(self, session_id: int, input_name: str = None):
         """
         Возвращает данные конкретной сессии по её номеру
-        :param session_id: Номер сессии (начиная с 0)
+        :param session_id: Номер сессии (id из таблицы sessions), None — последняя
         :param input_name: Фильтр по устройству (опционально)
         :return: Кортеж с данными сессии или None если не найдена
         """
         try:
-            all_sessions = self.get_midi_logs(days=0, input_name=input_name)
-            if session_id < 0 or session_id >= len(all_sessions):
+            row = self.find_session(session_id, input_name)
+            if not row:
                 return None
-            return all_sessions[session_id+1]
+            return self._session_file(row, self._render_session(row), input_name)
         except Exception as e:
             logging.error(f"Error in get_session_by_id: {e}")
             return None
 
-    async def send_midi_visualization(self, chat_id: int, session_id: int, input_name: str = None):
+    def find_session(self, session_id: int, input_name: str = None):
         """
-        Генерирует и отправляет визуализацию нот для выбранной сессии в телеграм
-        :param chat_id: ID чата для отправки
-        :param session_id: Номер сессии
+        :param session_id: id сессии, None — последняя
         :param input_name: Фильтр по устройству (опционально)
+        :return: Строка sessions (id, start_ts, end_ts, first_event_id, last_event_id, note_count) или None
+        """
+        if session_id is None:
+            query, params = self.QUERIES["last_session"], ()
+            if input_name:
+                query, params = self.QUERIES["device_last_session"], (input_name,)
+        else:
+            query, params = self.QUERIES["session_by_id"], (session_id,)
+            if input_name:
+                query, params = self.QUERIES["device_session_by_id"], (session_id, input_name)
+
+        with self.readers.cursor() as cur:
+            self._check_cache_generation(cur)
+            cur.execute(query, params)
+            return cur.fetchone()
+
+    def get_note_events(self, session_id: int) -> list:
+        """
+        Трёхбайтовые события сессии (ноты, контроллеры и т.п.) без сборки MIDI
+        :return: Список (ts в наносекундах, байты сообщения)
+        """
+        with self.readers.cursor() as cur:
+            events = self._read_events(cur, session_id, "session_short_events")
+            if not events:
+                events = [event for event in self._session_messages(cur, session_id) if len(event[1]) == 3]
+            return events
+
+    def get_session_stats(self, session_id: int = None, input_name: str = None):
+        """
+        Статистика сессии из агрегатов, посчитанных при записи
+        :param session_id: id сессии, None — последняя
+        :param input_name: Фильтр по устройству (опционально)
+        :return: Словарь со статистикой или None, если сессия не найдена
         """
         try:
-            # Получаем данные сессии
-            session_data = self.get_session_by_id(session_id, input_name)
-            if not session_data:
-                await self.bot.send_message(chat_id, "Сессия не найдена")
-                return
+            row = self.find_session(session_id, input_name)
+            if not row:
+                return None
+            session_id, start_ts, end_ts, _, _, note_count = row
+            with self.readers.cursor() as cur:
+                cur.execute(self.QUERIES["session_stats"], (session_id,))
+                stats = cur.fetchone()
 
-            # Извлекаем MIDI данные
-            midi_bytes = session_data[1]
+            session = OpenSession(None, session_id, start_ts, end_ts, note_count=note_count)
+            if stats:
+                session.load_stats(*stats)
+            return {
+                "session_id": session_id,
+                "start": ns_to_datetime(start_ts),
+                "duration": (end_ts - start_ts) / NS_PER_SEC,
+                "note_count": note_count,
+                "presses": sum(session.pitches),
+                "pitches": session.pitches.tolist(),
+                "velocities": session.velocities.tolist(),
+                "channels": [channel + 1 for channel in range(16) if session.channels >> channel & 1],
+            }
+        except Exception as e:
+            logging.error(f"Error in get_session_stats: {e}")
+            return None
 
-            # Создаем временный файл для анализа
-            with io.BytesIO(midi_bytes) as midi_stream:
-                midi_file = MidiFile(file=midi_stream)
+    def is_closed(self, row: tuple) -> bool:
+        """Сессия закрыта, если после её конца прошло больше session_gap"""
+        return row[2] < time.time_ns() - self.session_gap
 
-                # Анализируем треки и собираем данные для графика
-                notes = []
-                times = []
 
-                for i, track in enumerate(midi_file.tracks):
-                    current_time = 0
-                    for msg in track:
-                        current_time += msg.time
-                        if msg.type == 'note_on' and msg.velocity > 0:
-                            notes.append(msg.note)
-                            times.append(current_time / 1000)  # переводим в секунды
+class AsyncMidiLog:
+    """
+    Асинхронная обёртка над MidiLog для бота: запросы и сборка MIDI
+    выполняются в ограниченном пуле потоков, event loop не блокируется.
+    У каждого вызова есть таймаут; потоковая выгрузка отменяется
+    между сессиями, как только вызывающая задача перестаёт её читать
+    """
 
-                if not notes:
-                    await self.bot.send_message(chat_id, "В сессии не найдено нот")
-                    return
+    def __init__(self, midi_log: MidiLog, workers: int = 4, timeout: float = 120):
+        """
+        :param midi_log: Синхронный MidiLog
+        :param workers: Размер пула потоков
+        :param timeout: Таймаут одного запроса по умолчанию, секунды
+        """
+        self.midi_log = midi_log
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="midi-log")
 
-                # Создаем график
-                plt.figure(figsize=(10, 5))
-                plt.scatter(times, notes, alpha=0.5)
-                plt.title(f"Визуализация нот сессии {session_id}")
-                plt.xlabel("Время (секунды)")
-                plt.ylabel("Высота ноты")
-                plt.grid(True)
-
-                # Сохраняем во временный файл
-                with io.BytesIO() as plot_buffer:
-                    plt.savefig(plot_buffer, format='png')
-                    plot_buffer.seek(0)
-
-                    # Отправляем изображение
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=plot_buffer,
-                        caption=f"Сессия {session_id} | {session_data[3]} {session_data[4]}\n"
-                                f"Всего нот: {session_data[2]}"
-                    )
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        """Выполняет func(*args, **kwargs) в пуле с таймаутом"""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout or self.timeout)
 
-                plt.close()
+    async def get_midi_logs(self, days: int, input_name: str = None, timeout: float = None):
+        return await self.run(self.midi_log.get_midi_logs, days, input_name, timeout=timeout)
 
-        except Exception as e:
-            logging.error(f"Error in send_midi_visualization: {e}")
-            await self.bot.send_message(chat_id, "Произошла ошибка при создании визуализации")
\ No newline at end of file
+    async def get_session_by_id(self, session_id: int, input_name: str = None, timeout: float = None):
+        return await self.run(self.midi_log.get_session_by_id, session_id, input_name, timeout=timeout)
+
+    async def get_session_stats(self, session_id: int = None, input_name: str = None, timeout: float = None):
+        return await self.run(self.midi_log.get_session_stats, session_id, input_name, timeout=timeout)
+
+    async def get_practice_summary(self, days: int, input_name: str = None, timeout: float = None):
+        return await self.run(self.midi_log.get_practice_summary, days, input_name, timeout=timeout)
+
+    async def iter_midi_logs(self, days: int, input_name: str = None,
+                             timeout: float = None) -> AsyncIterator[tuple[str, bytes, int, str, str]]:
+        """
+        Потоковая выгрузка: каждая следующая сессия собирается в пуле.
+        Таймаут действует на всю выгрузку целиком
+        """
+        cancel = threading.Event()
+        sessions = self.midi_log.iter_midi_logs(days, input_name, cancel)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                session = await self.run(next, sessions, None, timeout=remaining)
+                if session is None:
+                    return
+                yield session
+        finally:
+            # Сессия может ещё собираться в пуле: тогда генератор увидит cancel
+            # и завершится сам, не начиная следующую
+            cancel.set()
+            if not sessions.gi_running:
+                # Между проверкой и close поток пула может успеть запустить next
+                with suppress(ValueError):
+                    sessions.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.midi_log.close()
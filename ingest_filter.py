@@ -0,0 +1,186 @@
+import json
+import threading
+
+import mido
+
+from data_engine import NS_PER_MS
+
+
+class DeviceFilter:
+    """Настройки и состояние фильтра одного устройства"""
+    __slots__ = ("drop", "coalesce", "last", "pending", "dropped", "lock")
+
+    def __init__(self, drop: frozenset, coalesce: dict):
+        """
+        :param drop: Типы сообщений, которые не записываются
+        :param coalesce: Тип -> минимальный интервал между значениями в наносекундах,
+            0 — записывать только изменения
+        """
+        self.drop = drop
+        self.coalesce = coalesce
+        # Поток (тип, канал[, номер]) -> (метка, значение) последнего записанного
+        self.last = {}
+        # Поток -> (метка, сообщение), придержанное до конца интервала
+        self.pending = {}
+        # Тип -> количество отброшенных
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def count(self, kind: str):
+        self.dropped[kind] = self.dropped.get(kind, 0) + 1
+
+
+class IngestFilter:
+    """
+    Фильтр между приёмом с порта и MidiLog.add_messages. Отбрасывает служебные
+    сообщения и прореживает непрерывные контроллеры: повтор последнего записанного
+    значения не пишется, а чаще одного раза за интервал пишется только последнее значение.
+    Придержанное значение уходит при следующем значении того же потока или по flush,
+    поэтому событие может прийти в add_messages позже событий других потоков
+    с большими метками: сессии и чтение событий порядок меток не требуют
+    """
+    DROP = ("clock", "active_sensing")
+    # Интервал в миллисекундах, 0 — только изменения
+    COALESCE = {"control_change": 0, "pitchwheel": 10, "aftertouch": 10, "polytouch": 10}
+    # Педали-переключатели и режимные контроллеры пишутся всегда
+    KEEP_CONTROLS = frozenset(range(64, 70)) | frozenset(range(120, 128))
+
+    def __init__(self, emit, config: dict = None, metrics=None):
+        """
+        :param emit: Функция emit(имя устройства, сообщение, метка в наносекундах)
+        :param config: {"drop": [...], "coalesce": {тип: мс}, "devices": {имя: {"drop": ..., "coalesce": ...}}},
+            для устройства недостающие ключи берутся из общих
+        :param metrics: Metrics, куда добавить показатель dropped
+        """
+        config = config or {}
+        self.emit = emit
+        defaults = {"drop": config.get("drop", self.DROP), "coalesce": config.get("coalesce", self.COALESCE)}
+        self._default = self._settings(defaults)
+        self._overrides = {
+            name: self._settings({**defaults, **settings}) for name, settings in config.get("devices", {}).items()
+        }
+        self._devices = {}
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.gauge("dropped", self.dropped)
+
+    @staticmethod
+    def _settings(config: dict) -> tuple[frozenset, dict]:
+        drop = frozenset(config["drop"])
+        coalesce = {kind: int(interval * NS_PER_MS) for kind, interval in config["coalesce"].items()}
+        unknown = (drop | coalesce.keys()) - mido.messages.SPEC_BY_TYPE.keys()
+        if unknown:
+            raise ValueError(f"Unknown message types: {', '.join(sorted(unknown))}")
+        return drop, coalesce
+
+    def _device(self, name: str) -> DeviceFilter:
+        with self._lock:
+            device = self._devices.get(name)
+            if device is None:
+                device = self._devices[name] = DeviceFilter(*self._overrides.get(name, self._default))
+            return device
+
+    def _stream(self, msg: mido.Message) -> tuple:
+        """:return: Ключ потока значений и значение, None — не прореживать"""
+        kind = msg.type
+        if kind == "control_change":
+            if msg.control in self.KEEP_CONTROLS:
+                return None, None
+            return (kind, msg.channel, msg.control), msg.value
+        if kind == "pitchwheel":
+            return (kind, msg.channel), msg.pitch
+        if kind == "aftertouch":
+            return (kind, msg.channel), msg.value
+        if kind == "polytouch":
+            return (kind, msg.channel, msg.note), msg.value
+        return None, None
+
+    def _emit_pending(self, name: str, device: DeviceFilter, key: tuple):
+        ts, msg = device.pending.pop(key)
+        value = self._stream(msg)[1]
+        last = device.last.get(key)
+        if last is not None and last[1] == value:
+            device.count(msg.type)
+            return
+        device.last[key] = (ts, value)
+        self.emit(name, msg, ts)
+
+    def _flush_pending(self, name: str, device: DeviceFilter, now: int = None):
+        """
+        Отправляет придержанные значения по порядку меток; с now — только те, чей интервал истёк.
+        Интервалы у типов разные, поэтому неистёкшее значение не задерживает более поздние
+        """
+        for key, (ts, msg) in sorted(device.pending.items(), key=lambda item: item[1][0]):
+            if now is not None and ts + device.coalesce[msg.type] > now:
+                continue
+            self._emit_pending(name, device, key)
+
+    def add(self, name: str, msg: mido.Message, ts: int):
+        """
+        :param name: Имя устройства
+        :param ts: Метка прихода в epoch-наносекундах
+        """
+        device = self._devices.get(name) or self._device(name)
+        kind = msg.type
+        with device.lock:
+            if kind in device.drop:
+                device.count(kind)
+                return
+
+            interval = device.coalesce.get(kind)
+            key, value = self._stream(msg) if interval is not None else (None, None)
+            if key is not None:
+                last = device.last.get(key)
+                pending = device.pending.get(key)
+                current = self._stream(pending[1])[1] if pending else last and last[1]
+                if last is not None and current == value:
+                    device.count(kind)
+                    return
+                if interval and last is not None and ts - last[0] < interval:
+                    # Внутри интервала держим только последнее значение
+                    if pending:
+                        device.count(kind)
+                    if value == last[1]:
+                        # Значение вернулось к записанному: писать нечего
+                        del device.pending[key]
+                        device.count(kind)
+                    else:
+                        device.pending[key] = (ts, msg)
+                    return
+                if pending:
+                    # Придержанное значение пишем, только если оно продержалось хотя бы интервал
+                    if ts - pending[0] < interval:
+                        del device.pending[key]
+                        device.count(kind)
+                        if last is not None and last[1] == value:
+                            device.count(kind)
+                            return
+                    else:
+                        self._emit_pending(name, device, key)
+                device.last[key] = (ts, value)
+            self.emit(name, msg, ts)
+
+    def flush(self, now: int = None):
+        """
+        Отправляет придержанные значения
+        :param now: Текущее время в epoch-наносекундах: отправить только те, чей интервал истёк.
+            None — все
+        """
+        with self._lock:
+            devices = list(self._devices.items())
+        for name, device in devices:
+            if device.pending:
+                with device.lock:
+                    self._flush_pending(name, device, now)
+
+    def dropped(self) -> dict:
+        """:return: Устройство -> {тип: количество отброшенных}"""
+        with self._lock:
+            devices = list(self._devices.items())
+        return {name: dict(device.dropped) for name, device in devices if device.dropped}
+
+
+def load_config(path: str) -> dict:
+    """Настройки фильтра из JSON-файла в формате IngestFilter"""
+    with open(path) as f:
+        return json.load(f)
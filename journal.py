@@ -0,0 +1,264 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+log = logging.getLogger()
+
+
+class Journal:
+    """
+    Кольцевой журнал событий в отображённом в память файле. Захват пишет
+    сюда всегда и сразу, в БД события переносит JournalReplayer.
+
+    Файл: заголовок на HEADER_SIZE байт, дальше кольцо на capacity байт.
+    Запись: (позиция, длина, crc32) + (ts, длина имени) + имя + байты сообщения.
+    Позиция — сквозное смещение с момента создания журнала, кольцо адресуется
+    по модулю capacity. Она же хранится в записи, поэтому старые данные с прошлого
+    круга не спутать с новыми. Запись сначала пишется целиком, затем сдвигается
+    write_pos в заголовке; при открытии хвост после write_pos дочитывается, если
+    процесс упал между этими шагами. Данные в page cache переживают падение процесса,
+    sync сбрасывает их на диск на случай падения системы. Повреждённая запись
+    до write_pos пропускается и считается в corrupted, чтобы перенос не вставал на ней
+    """
+    MAGIC = b"MIDIJRNL"
+    VERSION = 1
+    HEADER_SIZE = 4096
+    # magic, версия, capacity, id журнала, write_pos, checkpoint
+    HEADER = struct.Struct("<8sIxxxxQQQQ")
+    WRITE_POS_OFFSET = 32
+    CHECKPOINT_OFFSET = 40
+    RECORD = struct.Struct("<QII")
+    EVENT = struct.Struct("<qB")
+    # Длина-маркер: остаток кольца до конца пропускается
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, path: str, capacity: int):
+        """
+        :param path: Файл журнала, создаётся при отсутствии
+        :param capacity: Размер кольца в байтах для нового файла
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.overflow = 0
+        self.corrupted = 0
+        if not self.path.exists():
+            self._create(capacity)
+        self._file = open(self.path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.capacity, self.id, write_pos, checkpoint = self.HEADER.unpack_from(self._mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a MIDI journal")
+        if self.capacity != capacity:
+            log.warning(f"Journal {path} keeps its capacity {self.capacity} instead of {capacity}")
+        self.checkpoint = checkpoint
+        # Записи, попавшие в кольцо, но не в заголовок до падения
+        self.write_pos, recovered = self._scan(write_pos)
+        if recovered:
+            log.warning(f"Recovered {recovered} journal records written before a crash")
+            struct.pack_into("<Q", self._mm, self.WRITE_POS_OFFSET, self.write_pos)
+        self.pending = self._scan(checkpoint, self.write_pos)[1]
+
+    def _create(self, capacity: int):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.truncate(self.HEADER_SIZE + capacity)
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, capacity, int.from_bytes(os.urandom(8), "little") >> 1,
+                                     0, 0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _records(self, pos: int, stop: int = None):
+        """
+        Читает записи с позиции pos
+        :param stop: Позиция, до которой читать; None — пока записи корректны.
+            До stop все записи были дописаны целиком, поэтому повреждённая запись
+            не останавливает чтение: она пропускается по своей длине, а если испорчен
+            заголовок — вместе со всем остатком до stop
+        :return: Генератор (позиция записи, позиция после неё, ts, имя устройства, байты сообщения),
+            у пропущенной записи ts, имя и байты — None
+        """
+        mm, capacity = self._mm, self.capacity
+        while stop is None or pos < stop:
+            offset = pos % capacity
+            remaining = capacity - offset
+            if remaining < self.RECORD.size:
+                pos += remaining
+                continue
+            start = self.HEADER_SIZE + offset
+            record_pos, length, crc = self.RECORD.unpack_from(mm, start)
+            if record_pos == pos and length == self.WRAP:
+                pos += remaining
+                continue
+            end = pos + self.RECORD.size + length
+            header_valid = record_pos == pos and self.EVENT.size <= length <= remaining - self.RECORD.size
+            payload = mm[start + self.RECORD.size:start + self.RECORD.size + length] if header_valid else None
+            if payload is None or zlib.crc32(payload, zlib.crc32(mm[start:start + 12])) != crc:
+                if stop is None:
+                    return
+                end = min(end, stop) if header_valid else stop
+                yield pos, end, None, None, None
+                pos = end
+                continue
+            ts, name_length = self.EVENT.unpack_from(payload)
+            name_end = self.EVENT.size + name_length
+            yield pos, end, ts, payload[self.EVENT.size:name_end].decode(errors="replace"), payload[name_end:]
+            pos = end
+
+    def _scan(self, pos: int, stop: int = None) -> tuple[int, int]:
+        """:return: Позиция после последней прочитанной записи и число корректных записей"""
+        count = 0
+        for _, pos, ts, *_ in self._records(pos, stop):
+            count += ts is not None
+        return pos, count
+
+    def append(self, ts: int, name: str, data: bytes) -> bool:
+        """
+        Дописывает событие
+        :return: False, если кольцо заполнено непереданными в БД записями и событие отброшено
+        """
+        # Длина имени хранится в байте: обрезаем по границе символа UTF-8
+        name = name.encode()[:255].decode(errors="ignore").encode()
+        length = self.EVENT.size + len(name) + len(data)
+        size = self.RECORD.size + length
+        with self._lock:
+            mm, pos = self._mm, self.write_pos
+            remaining = self.capacity - pos % self.capacity
+            skip = remaining if remaining < size else 0
+            if pos + skip + size - self.checkpoint > self.capacity:
+                self.overflow += 1
+                return False
+            if skip:
+                if remaining >= self.RECORD.size:
+                    self.RECORD.pack_into(mm, self.HEADER_SIZE + pos % self.capacity, pos, self.WRAP, 0)
+                pos += skip
+
+            start = self.HEADER_SIZE + pos % self.capacity
+            payload_start = start + self.RECORD.size
+            self.EVENT.pack_into(mm, payload_start, ts, len(name))
+            name_end = payload_start + self.EVENT.size + len(name)
+            mm[payload_start + self.EVENT.size:name_end] = name
+            mm[name_end:name_end + len(data)] = data
+            # crc считается по позиции и длине, затем по полезной нагрузке
+            struct.pack_into("<QI", mm, start, pos, length)
+            crc = zlib.crc32(mm[payload_start:payload_start + length], zlib.crc32(mm[start:start + 12]))
+            struct.pack_into("<I", mm, start + 12, crc)
+
+            self.write_pos = pos + size
+            struct.pack_into("<Q", mm, self.WRITE_POS_OFFSET, self.write_pos)
+            self.pending += 1
+        return True
+
+    def read(self, pos: int, limit: int) -> tuple[list, list, int]:
+        """
+        :param pos: Позиция, с которой читать (checkpoint)
+        :param limit: Максимум записей
+        :return: Список (ts, имя, байты) для MidiLog.write_rows, позиции этих записей
+            и позиция после последней прочитанной, в том числе пропущенной, записи
+        """
+        rows = []
+        positions = []
+        for record_pos, pos, ts, name, data in self._records(pos, self.write_pos):
+            if ts is None:
+                self.corrupted += 1
+                log.error(f"Skipped corrupted journal record at {record_pos} ({pos - record_pos} bytes)")
+                continue
+            rows.append((ts, name, data))
+            positions.append(record_pos)
+            if len(rows) >= limit:
+                break
+        return rows, positions, pos
+
+    def advance(self, pos: int, count: int):
+        """Записи до pos перенесены в БД, их место в кольце можно переиспользовать"""
+        with self._lock:
+            self.checkpoint = pos
+            self.pending -= count
+            struct.pack_into("<Q", self._mm, self.CHECKPOINT_OFFSET, pos)
+
+    def sync(self):
+        """Сбрасывает изменения на диск"""
+        self._mm.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "pending_bytes": self.write_pos - self.checkpoint,
+            "capacity": self.capacity,
+            "overflow": self.overflow,
+            "corrupted": self.corrupted,
+        }
+
+    def close(self):
+        with self._lock:
+            if not self._mm.closed:
+                self._mm.flush()
+                self._mm.close()
+            self._file.close()
+
+
+class JournalReplayer:
+    """
+    Фоновый перенос записей журнала в БД. Позиция журнала сохраняется в основной БД
+    и в каждом шарде, куда попала пачка, в тех же транзакциях, что и события
+    (MidiLog.write_rows). Перенос после перезапуска начинается с checkpoint журнала,
+    а уже записанные в файл строки write_rows пропускает по позиции этого файла.
+    При ошибках БД повторяет с нарастающей паузой, захват при этом не ждёт
+    """
+    BATCH_SIZE = 2000
+    INTERVAL = .25
+    MAX_BACKOFF = 5.0
+
+    def __init__(self, journal: Journal, midi_log, batch_size: int = BATCH_SIZE, interval: float = INTERVAL):
+        self.journal = journal
+        self.midi_log = midi_log
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="journal-replayer", daemon=True)
+        self._thread.start()
+
+    def replay(self) -> int:
+        """
+        Переносит одну пачку
+        :return: Количество перенесённых записей
+        """
+        journal = self.journal
+        rows, positions, end = journal.read(journal.checkpoint, self.batch_size)
+        if rows:
+            self.midi_log.write_rows(rows, journal=(journal.id, positions, end))
+        if end != journal.checkpoint:
+            journal.advance(end, len(rows))
+        return len(rows)
+
+    def _run(self):
+        backoff = 0
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                replayed = self.replay()
+            except Exception as e:
+                log.error(f"Error in JournalReplayer: {e}")
+                self.midi_log.metrics.incr("write_errors")
+                if stopping:
+                    return
+                backoff = min(backoff * 2 or self.interval, self.MAX_BACKOFF)
+                self._stop.wait(backoff)
+                continue
+            backoff = 0
+            if replayed < self.batch_size:
+                if stopping:
+                    return
+                self.journal.sync()
+                self._stop.wait(self.interval)
+
+    def close(self, timeout: float = None):
+        """Переносит остаток журнала и останавливает поток"""
+        self._stop.set()
+        self._thread.join(timeout)
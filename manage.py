@@ -0,0 +1,102 @@
+import argparse
+import logging
+
+from data_engine import NS_PER_SEC, MidiLog
+
+log = logging.getLogger()
+
+
+def migrate(args):
+    """Перенос событий из старой таблицы midi_log в компактную схему"""
+    with MidiLog(db_path=args.db) as db:
+        migrated = db.migrate_legacy(batch_size=args.batch_size, drop=args.drop)
+    log.info(f"Перенесено событий: {migrated}")
+
+
+def rebuild_sessions(args):
+    """Повторная разбивка всех событий на сессии"""
+    with MidiLog(db_path=args.db, session_gap=args.gap) as db:
+        sessions = db.rebuild_sessions()
+        gap = db.session_gap / NS_PER_SEC
+    log.info(f"Сессий: {sessions} (пауза {gap:g} с)")
+
+
+def rebuild_daily_stats(args):
+    """Пересчёт дневных сводок из таблицы sessions"""
+    with MidiLog(db_path=args.db) as db:
+        rows = db.rebuild_daily_stats()
+    log.info(f"Строк в дневных сводках: {rows}")
+
+
+def compact(args):
+    """Сжатие событий старых сессий в архив с удалением из events"""
+    with MidiLog(db_path=args.db) as db:
+        sessions = db.compact_sessions(days=args.days, batch_size=args.batch_size, vacuum=not args.no_vacuum)
+    log.info(f"Сжато сессий: {sessions}")
+
+
+def vacuum(args):
+    """Возврат свободного места файлу БД"""
+    with MidiLog(db_path=args.db) as db:
+        pages = db.vacuum(full=args.full)
+    log.info(f"Освобождено страниц: {pages}")
+
+
+def freeze(args):
+    """Перевод шардов прошлых месяцев в режим только для чтения"""
+    with MidiLog(db_path=args.db) as db:
+        months = db.freeze_shards(keep_months=args.keep_months)
+    log.info(f"Заморожено шардов: {', '.join(months) or 0}")
+
+
+def explain(args):
+    """Планы запросов бота"""
+    with MidiLog(db_path=args.db) as db:
+        for name, plan in db.explain_queries().items():
+            print(name)
+            for detail in plan:
+                print(f"    {detail}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание БД MIDI-логов")
+    parser.add_argument("--db", default=MidiLog.DB_PATH, help="Путь к файлу БД")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("migrate", help="Перенести midi_log в таблицу events")
+    cmd.add_argument("--batch-size", type=int, default=10000)
+    cmd.add_argument("--drop", action="store_true", help="Удалить midi_log после переноса")
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser("rebuild-sessions", help="Пересобрать таблицу sessions")
+    cmd.add_argument("--gap", type=float,
+                     help="Пауза между сессиями в секундах, сохраняется для логгера; по умолчанию текущая")
+    cmd.set_defaults(func=rebuild_sessions)
+
+    cmd = commands.add_parser("rebuild-daily-stats", help="Пересчитать дневные сводки занятий")
+    cmd.set_defaults(func=rebuild_daily_stats)
+
+    cmd = commands.add_parser("compact", help="Сжать сессии старше --days дней и удалить их события")
+    cmd.add_argument("--days", type=int, default=MidiLog.RETENTION_DAYS)
+    cmd.add_argument("--batch-size", type=int, default=MidiLog.COMPACT_BATCH_SIZE)
+    cmd.add_argument("--no-vacuum", action="store_true", help="Не запускать incremental VACUUM")
+    cmd.set_defaults(func=compact)
+
+    cmd = commands.add_parser("vacuum", help="Вернуть свободные страницы файлу БД")
+    cmd.add_argument("--full", action="store_true",
+                     help="Перевести старую БД в auto_vacuum = INCREMENTAL полным VACUUM; логгер нужно остановить")
+    cmd.set_defaults(func=vacuum)
+
+    cmd = commands.add_parser("freeze", help="Сделать шарды прошлых месяцев только для чтения")
+    cmd.add_argument("--keep-months", type=int, default=1, help="Сколько прошлых месяцев оставить открытыми")
+    cmd.set_defaults(func=freeze)
+
+    cmd = commands.add_parser("explain", help="Показать EXPLAIN QUERY PLAN запросов бота")
+    cmd.set_defaults(func=explain)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger()
+
+
+class RateCounter:
+    """
+    Счётчик событий с корзинами по секундам за последние WINDOW секунд.
+    Запись — пара операций со списком, скорость считается только при чтении
+    """
+    WINDOW = 60
+    __slots__ = ("total", "_counts", "_seconds")
+
+    def __init__(self):
+        self.total = 0
+        self._counts = [0] * self.WINDOW
+        self._seconds = [0] * self.WINDOW
+
+    def add(self, count: int = 1):
+        second = int(time.monotonic())
+        i = second % self.WINDOW
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += count
+        self.total += count
+
+    def rate(self, seconds: int = 10) -> float:
+        """Среднее число событий в секунду за последние полные seconds секунд"""
+        current = int(time.monotonic())
+        return sum(
+            count for count, second in zip(self._counts, self._seconds)
+            if current - seconds <= second < current
+        ) / seconds
+
+
+class Histogram:
+    """
+    Гистограмма длительностей в наносекундах с корзинами по степеням двойки.
+    Квантили оцениваются сверху по границе корзины
+    """
+    BUCKETS = 48  # 2**47 нс — больше полутора суток
+    __slots__ = ("count", "sum", "max", "_counts")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._counts = [0] * self.BUCKETS
+
+    def add(self, value: int):
+        value = max(value, 0)
+        self._counts[min(value.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(1 << bucket, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        """Сводка в миллисекундах"""
+        return {
+            "count": self.count,
+            "avg_ms": self.sum / self.count / 1e6 if self.count else 0,
+            "p50_ms": self.quantile(.5) / 1e6,
+            "p99_ms": self.quantile(.99) / 1e6,
+            "max_ms": self.max / 1e6,
+        }
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы записи событий. Обновляются из нескольких потоков
+    без блокировок: под GIL гонка может потерять единичные отсчёты, что для
+    мониторинга допустимо. Всё агрегирование — в snapshot
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ports = {}
+        self.counters = {}
+        self.gauges = {}
+        self.commit_latency = Histogram()
+        self.storage_delay = Histogram()
+
+    def event(self, port_name: str, count: int = 1):
+        """События пришли с порта"""
+        counter = self.ports.get(port_name)
+        if counter is None:
+            counter = self.ports.setdefault(port_name, RateCounter())
+        counter.add(count)
+
+    def incr(self, name: str, count: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name: str, read):
+        """
+        Регистрирует показатель, который читается только при snapshot
+        :param read: Функция без аргументов, возвращающая текущее значение
+        """
+        self.gauges[name] = read
+
+    def commit(self, latency: int, timestamps, now: int):
+        """
+        Пачка событий записана
+        :param latency: Время транзакции в наносекундах
+        :param timestamps: Метки прихода записанных событий, epoch-наносекунды
+        :param now: Момент завершения commit, epoch-наносекунды
+        """
+        self.incr("commits")
+        self.commit_latency.add(latency)
+        for ts in timestamps:
+            self.storage_delay.add(now - ts)
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = None
+                log.warning(f"Cannot read gauge {name}: {e}")
+        return {
+            "uptime": time.monotonic() - self.started,
+            "events": sum(counter.total for counter in list(self.ports.values())),
+            "ports": {
+                name: {"events": counter.total, "rate": counter.rate()}
+                for name, counter in list(self.ports.items())
+            },
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "commit_latency": self.commit_latency.snapshot(),
+            "storage_delay": self.storage_delay.snapshot(),
+        }
+
+
+class StatsServer:
+    """Локальный HTTP-эндпоинт: GET /stats отдаёт Metrics.snapshot в JSON"""
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 8765):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.rstrip("/") != "/stats":
+                    handler.send_error(404)
+                    return
+                body = json.dumps(self.metrics.snapshot()).encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug(f"Stats request: {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="midi-log-stats", daemon=True)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+        log.info(f"Stats endpoint: http://{self.address[0]}:{self.address[1]}/stats")
+
+    def close(self):
+        if self._thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
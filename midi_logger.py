@@ -1,19 +1,258 @@
+import itertools
 import logging
+import multiprocessing
+import os
+import queue
+import threading
 import time
+from pathlib import Path
 
 import mido
 
 from data_engine import MidiLog
+from ingest_filter import IngestFilter, load_config
+from journal import Journal, JournalReplayer
+from metrics import StatsServer
 
 log = logging.getLogger()
 log.addHandler(logging.StreamHandler())
 log.setLevel(logging.DEBUG)
 
 
+class PortManager:
+    """
+    Набор открытых входных портов. reconcile сверяет его со списком устройств:
+    открывает только появившиеся и закрывает только пропавшие, остальные
+    порты не трогает и событий не теряют
+    """
+
+    def __init__(self, open_port, on_connect=None, on_disconnect=None):
+        """
+        :param open_port: Функция имя -> открытый порт
+        :param on_connect: Вызывается с именем подключенного устройства
+        :param on_disconnect: Вызывается с именем отключенного устройства
+        """
+        self.open_port = open_port
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.ports = {}
+
+    def reconcile(self) -> tuple[set, set]:
+        """
+        :return: Имена подключенных и отключенных устройств
+        """
+        try:
+            current_names = set(mido.get_input_names())
+        except Exception as e:
+            log.error(f"Cannot list MIDI inputs: {e}")
+            return set(), set()
+
+        # Порт, закрытый бэкендом, считаем отключенным и переоткроем
+        removed = {name for name, port in self.ports.items() if name not in current_names or port.closed}
+        for name in removed:
+            self._close(name)
+            log.info(f"MIDI input disconnected: {name}")
+            if self.on_disconnect:
+                self.on_disconnect(name)
+
+        added = set()
+        for name in current_names - self.ports.keys():
+            try:
+                self.ports[name] = self.open_port(name)
+            except Exception as e:
+                log.error(f"Cannot open {name}: {e}")
+                continue
+            added.add(name)
+            log.info(f"MIDI input connected: {name}")
+            if self.on_connect:
+                self.on_connect(name)
+        return added, removed
+
+    def _close(self, name: str):
+        port = self.ports.pop(name)
+        try:
+            port.close()
+        except Exception as e:
+            log.warning(f"Error closing {name}: {e}")
+
+    def close_all(self):
+        for name in list(self.ports):
+            self._close(name)
+
+
+def capture_worker(worker_id: int, name: str, events: multiprocessing.Queue, credits, stop,
+                   filter_config: dict, batch_interval: float, max_pending: int, stop_timeout: float,
+                   open_input=None):
+    """
+    Процесс захвата одного порта. Метка ставится в callback порта, события
+    проходят фильтр и раз в batch_interval уходят пачкой в общую очередь.
+    Пачку можно отправить, только взяв кредит из credits — их возвращает писатель
+    после записи в журнал, так что у каждого порта не больше заданного числа пачек в пути.
+    Пока кредитов нет, события копятся локально, сверх max_pending — отбрасываются
+    (счётчик overflow). Кредит для последней пачки ждётся до stop_timeout
+    """
+    rows = []
+    lock = threading.Lock()
+
+    def emit(port_name, msg, ts):
+        with lock:
+            rows.append((ts, bytes(msg.bytes())))
+
+    ingest_filter = IngestFilter(emit, filter_config)
+    add = ingest_filter.add
+    open_input = open_input or mido.open_input
+    try:
+        port = open_input(name, callback=lambda msg: add(name, msg, time.time_ns()))
+    except Exception as e:
+        log.error(f"Cannot open {name}: {e}")
+        return
+
+    pending = []
+    overflow = 0
+    sent_dropped = {}
+
+    def dropped() -> dict:
+        counts = ingest_filter.dropped().get(name, {})
+        if overflow:
+            counts["overflow"] = overflow
+        return counts
+
+    try:
+        while not stop.wait(batch_interval) and not port.closed:
+            ingest_filter.flush(time.time_ns())
+            with lock:
+                pending.extend(rows)
+                rows.clear()
+            if len(pending) > max_pending:
+                overflow += len(pending) - max_pending
+                del pending[max_pending:]
+            counts = dropped()
+            if (pending or counts != sent_dropped) and credits.acquire(False):
+                events.put((worker_id, name, pending, counts))
+                pending = []
+                sent_dropped = counts
+    finally:
+        port.close()
+        ingest_filter.flush()
+        with lock:
+            pending.extend(rows)
+        if len(pending) > max_pending:
+            overflow += len(pending) - max_pending
+            del pending[max_pending:]
+        # Родитель ждёт процесс stop_timeout, кредит ждём вдвое меньше
+        if credits.acquire(timeout=stop_timeout / 2):
+            events.put((worker_id, name, pending, dropped()))
+        elif pending:
+            log.warning(f"No credit for the last batch of {name}, {len(pending)} events lost")
+
+
+class CaptureWorker:
+    """Процесс захвата порта с интерфейсом порта для PortManager"""
+    _ids = itertools.count()
+
+    def __init__(self, name: str, events: multiprocessing.Queue, filter_config: dict,
+                 batch_interval: float, port_batches: int, max_pending: int, stop_timeout: float,
+                 context=multiprocessing, open_input=None):
+        """
+        :param context: Контекст multiprocessing, из которого создана events
+        :param open_input: Функция открытия порта в процессе (передаётся через pickle), None — mido.open_input
+        """
+        self.id = next(self._ids)
+        self.name = name
+        self.stop_timeout = stop_timeout
+        self.credits = context.Semaphore(port_batches)
+        self._stop = context.Event()
+        self.process = context.Process(
+            target=capture_worker, name=f"capture-{name}", daemon=True,
+            args=(self.id, name, events, self.credits, self._stop, filter_config, batch_interval, max_pending,
+                  stop_timeout, open_input),
+        )
+        self.process.start()
+
+    @property
+    def closed(self) -> bool:
+        return self._stop.is_set() or not self.process.is_alive()
+
+    def close(self):
+        """
+        Останавливает процесс и ждёт его до stop_timeout. Последнюю пачку процесса
+        в это время должен вычитывать из очереди другой поток, иначе процесс не завершится
+        """
+        self._stop.set()
+        self.process.join(self.stop_timeout)
+        if self.process.is_alive():
+            log.warning(f"Capture process for {self.name} did not stop, terminating")
+            self.process.terminate()
+            self.process.join()
+
+
 class MidiLogApp:
-    def __init__(self):
-        self.midi_log = MidiLog()
+    # Как часто сверять список устройств, секунды
+    PORT_CHECK_INTERVAL = 2.0
+    # Как часто отправлять придержанные фильтром значения контроллеров, секунды
+    FILTER_FLUSH_INTERVAL = .1
+    # Режим "poll": пауза опроса, когда ни в одном порту нет сообщений, секунды
+    POLL_INTERVAL = .001
+
+    # Режим "process": как часто процесс порта отправляет пачку, сколько пачек
+    # порта может ждать записи и сколько событий копить, пока писатель занят
+    CAPTURE_BATCH_INTERVAL = .01
+    CAPTURE_PORT_BATCHES = 16
+    CAPTURE_MAX_PENDING = 100_000
+    # Сколько ждать завершения процесса захвата при остановке, секунды
+    CAPTURE_STOP_TIMEOUT = 5.0
+
+    # Журнал рядом с файлом БД: захват пишет в него, в БД события переносит JournalReplayer
+    JOURNAL_SUFFIX = ".journal"
+    JOURNAL_SIZE = 64 * 1024 * 1024
+
+    # Локальный эндпоинт со статистикой записи, None — не запускать
+    STATS_HOST = "127.0.0.1"
+    STATS_PORT = 8765
+
+    def __init__(self, capture_mode: str = "callback", stats_port: int = STATS_PORT, db_path: str = None,
+                 filter_config: dict = None, open_input=None):
+        """
+        :param capture_mode: "callback" — события приходят из потока бэкенда,
+            "poll" — опрос портов в цикле, "process" — отдельный процесс на каждый порт
+        :param stats_port: Порт эндпоинта статистики, None — без него
+        :param db_path: Путь к файлу БД, по умолчанию MidiLog.DB_PATH
+        :param filter_config: Настройки IngestFilter, по умолчанию — его значения по умолчанию
+        :param open_input: Функция открытия входного порта, по умолчанию mido.open_input.
+            В режиме "process" передаётся в процессы захвата, поэтому должна сериализоваться pickle
+        """
+        if capture_mode not in ("callback", "poll", "process"):
+            raise ValueError(f"Unknown capture mode: {capture_mode}")
+        # Пачки в БД собирает JournalReplayer, отдельный писатель MidiLog не нужен
+        self.midi_log = MidiLog(writer_mode="sync", db_path=db_path)
+        self.metrics = self.midi_log.metrics
+        self.journal = Journal(Path(self.midi_log.db_path).with_suffix(self.JOURNAL_SUFFIX), self.JOURNAL_SIZE)
+        self.metrics.gauge("queue_depth", lambda: self.journal.pending)
+        self.metrics.gauge("journal", self.journal.stats)
+        self.filter_config = filter_config
+        # В режиме "process" фильтруют процессы захвата, показатель dropped собирает process_workers
+        self.filter = None if capture_mode == "process" else IngestFilter(self._store, filter_config, self.metrics)
+        self.open_input = open_input
+        self.capture_mode = capture_mode
+        self.stats_port = stats_port
         self.pause = False
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self.journal.close()
+        self.midi_log.close()
+
+    def _port_manager(self, open_port) -> PortManager:
+        ports = PortManager(
+            open_port,
+            on_connect=lambda name: self.metrics.incr("port_connects"),
+            on_disconnect=lambda name: self.metrics.incr("port_disconnects"),
+        )
+        self.metrics.gauge("open_ports", lambda: sorted(ports.ports))
+        return ports
 
     def add_messages(self):
         midi_log = MidiLog()
@@ -28,33 +267,167 @@ class MidiLogApp:
             return
 
     def process(self):
+        stats = None
+        if self.stats_port is not None:
+            try:
+                stats = StatsServer(self.metrics, self.STATS_HOST, self.stats_port)
+                stats.start()
+            except OSError as e:
+                log.error(f"Cannot start stats endpoint: {e}")
+        # Сначала переносится всё, что осталось в журнале с прошлого запуска
+        replayer = JournalReplayer(self.journal, self.midi_log)
+        try:
+            if self.capture_mode == "callback":
+                self.process_callbacks()
+            elif self.capture_mode == "process":
+                self.process_workers()
+            else:
+                self.process_polling()
+        finally:
+            replayer.close()
+            if stats:
+                stats.close()
 
-        input_names = set(mido.get_input_names())
-        open_ports = [mido.open_input(input_name) for input_name in input_names]
-        i = 0
-        while True:
-            i += 1
-            if i >= 100000:
-                print('recon')
-                i = 0
-                for port in open_ports:
-                    port.close()
-
-                input_names = set(mido.get_input_names())
-                try:
-                    open_ports = [mido.open_input(input_name) for input_name in input_names]
-                except Exception:
-                    print('no port')
-                    time.sleep(1)
-            a = ([(port.closed) for port in open_ports])
-            time.sleep(.00001)
-            for port, msg in mido.ports.multi_receive(ports=open_ports, yield_ports=True, block=False):
-                if port.closed:
-                    print('pori clo')
-                    continue
-                self.midi_log.add_messages(str(port), msg)
+    def _store(self, port_name: str, msg, ts: int):
+        self.metrics.event(port_name)
+        self.journal.append(ts, port_name, bytes(msg.bytes()))
+
+    def _on_message(self, port_name: str):
+        add = self.filter.add
+
+        def callback(msg):
+            # Метка времени ставится в момент прихода, после фильтра запись уходит в очередь писателя
+            add(port_name, msg, time.time_ns())
+
+        return callback
+
+    def process_callbacks(self):
+        """
+        Захват через callback бэкенда: основной поток спит и только
+        периодически сверяет список устройств
+        """
+        open_input = self.open_input or mido.open_input
+        ports = self._port_manager(lambda name: open_input(name, callback=self._on_message(name)))
+        ports.reconcile()
+        next_check = time.monotonic() + self.PORT_CHECK_INTERVAL
+        try:
+            while not self._stop.wait(self.FILTER_FLUSH_INTERVAL):
+                self.filter.flush(time.time_ns())
+                if time.monotonic() >= next_check:
+                    ports.reconcile()
+                    next_check = time.monotonic() + self.PORT_CHECK_INTERVAL
+        finally:
+            ports.close_all()
+            self.filter.flush()
+
+    def process_polling(self):
+        """
+        Захват опросом портов: накопившиеся сообщения вычитываются из всех портов,
+        а если их не было, поток ждёт POLL_INTERVAL. Метка ставится при вычитывании,
+        поэтому её точность — до POLL_INTERVAL
+        """
+        ports = self._port_manager(self.open_input or mido.open_input)
+        ports.reconcile()
+        next_check = time.monotonic() + self.PORT_CHECK_INTERVAL
+        next_flush = time.monotonic() + self.FILTER_FLUSH_INTERVAL
+        add = self.filter.add
+        try:
+            while not self._stop.is_set():
+                received = False
+                for port in list(ports.ports.values()):
+                    # Закрытый бэкендом порт переоткроет reconcile
+                    if port.closed:
+                        continue
+                    for msg in port.iter_pending():
+                        add(port.name, msg, time.time_ns())
+                        received = True
+                if time.monotonic() >= next_flush:
+                    self.filter.flush(time.time_ns())
+                    next_flush = time.monotonic() + self.FILTER_FLUSH_INTERVAL
+                if time.monotonic() >= next_check:
+                    ports.reconcile()
+                    next_check = time.monotonic() + self.PORT_CHECK_INTERVAL
+                if not received:
+                    self._stop.wait(self.POLL_INTERVAL)
+        finally:
+            ports.close_all()
+            self.filter.flush()
+
+    def process_workers(self):
+        """
+        Захват процессами: у каждого порта свой процесс. Пачки из общей очереди
+        пишет в журнал отдельный поток, он же возвращает портам кредиты,
+        а этот поток сверяет список устройств и останавливает процессы пропавших портов
+        """
+        context = multiprocessing.get_context(MidiLog.PROCESS_START_METHOD)
+        events = context.Queue()
+        workers = {}
+        # Отброшенное фильтрами процессов: порт -> {тип: количество}
+        dropped = {}
+        self.metrics.gauge("dropped", lambda: {name: counts for name, counts in dropped.items() if counts})
+        self.metrics.gauge("capture_workers", lambda: len(workers))
+
+        def start_worker(name: str) -> CaptureWorker:
+            worker = CaptureWorker(name, events, self.filter_config, self.CAPTURE_BATCH_INTERVAL,
+                                   self.CAPTURE_PORT_BATCHES, self.CAPTURE_MAX_PENDING, self.CAPTURE_STOP_TIMEOUT,
+                                   context, self.open_input)
+            workers[worker.id] = worker
+            return worker
+
+        def receive(timeout: float) -> bool:
+            try:
+                worker_id, name, rows, counts = events.get(timeout=timeout)
+            except queue.Empty:
+                return False
+            dropped[name] = counts
+            if rows:
+                self.metrics.event(name, len(rows))
+                append = self.journal.append
+                for ts, data in rows:
+                    append(ts, name, data)
+            # Кредит возвращается, только когда пачка уже в журнале
+            worker = workers.get(worker_id)
+            if worker is not None:
+                worker.credits.release()
+            return True
+
+        def reap():
+            for worker_id, worker in list(workers.items()):
+                if not worker.process.is_alive():
+                    worker.process.join()
+                    del workers[worker_id]
+
+        receiving = threading.Event()
+        receiving.set()
+
+        def receiver():
+            while receiving.is_set():
+                receive(self.FILTER_FLUSH_INTERVAL)
+
+        thread = threading.Thread(target=receiver, name="capture-receiver", daemon=True)
+        thread.start()
+        ports = self._port_manager(start_worker)
+        try:
+            ports.reconcile()
+            while not self._stop.wait(self.PORT_CHECK_INTERVAL):
+                ports.reconcile()
+                reap()
+        finally:
+            # close ждёт каждый процесс, пока поток записи дочитывает его последнюю пачку
+            ports.close_all()
+            reap()
+            receiving.clear()
+            thread.join()
+            while receive(0):
+                pass
 
 
 if __name__ == "__main__":
-    app = MidiLogApp()
-    app.process()
+    # Путь к JSON с настройками фильтра (см. IngestFilter)
+    filter_path = os.environ.get("ingest_filter")
+    app = MidiLogApp(os.environ.get("capture_mode", "callback"),
+                     filter_config=load_config(filter_path) if filter_path else None)
+    try:
+        app.process()
+    finally:
+        app.close()
@@ -0,0 +1,268 @@
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+import mido
+from mido import MidiFile
+
+from metrics import Histogram
+
+log = logging.getLogger()
+
+NS_PER_SEC = 1_000_000_000
+
+
+def group_events(events) -> list[tuple[int, list]]:
+    """
+    Склеивает события с одинаковым смещением в одну пачку
+    :param events: Пары (смещение от начала в наносекундах, сообщение) по возрастанию смещения
+    :return: Список (смещение, [сообщения])
+    """
+    groups = []
+    for offset, message in events:
+        if groups and groups[-1][0] == offset:
+            groups[-1][1].append(message)
+        else:
+            groups.append((offset, [message]))
+    return groups
+
+
+def midi_file_events(midi_file: MidiFile) -> list:
+    """
+    События MIDI-файла с абсолютными смещениями от начала (с учётом темпа),
+    без мета-сообщений
+    :return: Пары (смещение в наносекундах, mido.Message)
+    """
+    events = []
+    seconds = 0.0
+    for msg in midi_file:
+        seconds += msg.time
+        if not msg.is_meta:
+            events.append((round(seconds * NS_PER_SEC), msg))
+    return events
+
+
+class Player:
+    """
+    Воспроизведение по абсолютным дедлайнам: время каждого события считается
+    от момента старта по монотонным часам, поэтому ошибки sleep не накапливаются.
+    Основную часть ожидания поток спит, последние spin наносекунд крутится
+    в цикле, события с одинаковым дедлайном отправляются подряд одной пачкой
+    """
+    # Сколько ждать активно: типичная погрешность sleep на десктопных ОС.
+    # Пока поток крутится, он держит GIL, поэтому окно ограничено MAX_SPIN_NS
+    SPIN_NS = 1_000_000
+    MAX_SPIN_NS = 2_000_000
+    # Запас на подготовку перед первым событием
+    START_DELAY_NS = 5_000_000
+
+    def __init__(self, send, spin_ns: int = SPIN_NS, lateness: Histogram = None):
+        """
+        :param send: Функция, отправляющая одно сообщение на выход
+        :param spin_ns: Длительность активного ожидания перед дедлайном, не больше MAX_SPIN_NS
+        :param lateness: Гистограмма опозданий пачек относительно дедлайна, общая для нескольких плееров
+        """
+        self.send = send
+        self.spin_ns = min(max(spin_ns, 0), self.MAX_SPIN_NS)
+        self.lateness = lateness if lateness is not None else Histogram()
+
+    def play(self, events, stop: threading.Event = None) -> int:
+        """
+        :param events: Пары (смещение от начала в наносекундах, сообщение) по возрастанию смещения
+        :param stop: Событие для досрочной остановки
+        :return: Количество отправленных сообщений
+        """
+        stop = stop or threading.Event()
+        send = self.send
+        sent = 0
+        start = time.monotonic_ns() + self.START_DELAY_NS
+        for offset, batch in group_events(events):
+            deadline = start + offset
+            wait = deadline - time.monotonic_ns() - self.spin_ns
+            if wait > 0 and stop.wait(wait / NS_PER_SEC):
+                break
+            if stop.is_set():
+                break
+            while (now := time.monotonic_ns()) < deadline:
+                pass
+            for message in batch:
+                send(message)
+            sent += len(batch)
+            self.lateness.add(now - deadline)
+        return sent
+
+
+class PlaybackItem:
+    """Элемент очереди воспроизведения"""
+    __slots__ = ("title", "events", "notify", "stop")
+
+    def __init__(self, title: str, events: list, notify=None):
+        """
+        :param title: Название для статусов и /queue
+        :param events: Пары (смещение в наносекундах, сообщение)
+        :param notify: Функция notify(item, status) для статусов
+        """
+        self.title = title
+        self.events = events
+        self.notify = notify
+        self.stop = threading.Event()
+
+
+class DevicePlayer:
+    """
+    Очередь воспроизведения одного устройства со своим потоком.
+    Порт открывается при первом воспроизведении и остаётся открытым
+    """
+    _STOP = object()
+
+    def __init__(self, name: str, open_port, lateness: Histogram = None):
+        self.name = name
+        self.lateness = lateness
+        self.current = None
+        self.queue = queue.Queue()
+        self._open_port = open_port
+        self._port = None
+        self._thread = threading.Thread(target=self._run, name=f"player-{name}", daemon=True)
+        self._thread.start()
+
+    def pending(self) -> list[PlaybackItem]:
+        with self.queue.mutex:
+            return [item for item in self.queue.queue if item is not self._STOP]
+
+    def put(self, item: PlaybackItem) -> int:
+        """:return: Сколько элементов играет и ждёт перед item"""
+        ahead = len(self.pending()) + (self.current is not None)
+        self.queue.put(item)
+        return ahead
+
+    def stop(self) -> int:
+        """
+        Останавливает текущее воспроизведение и очищает очередь
+        :return: Количество остановленных и отменённых элементов
+        """
+        cancelled = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                self.queue.put(item)
+                break
+            cancelled += 1
+        current = self.current
+        if current is not None and not current.stop.is_set():
+            current.stop.set()
+            cancelled += 1
+        return cancelled
+
+    def close(self, timeout: float = None):
+        self.stop()
+        if self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+        if self._port is not None:
+            self._port.close()
+            self._port = None
+
+    @staticmethod
+    def _notify(item: PlaybackItem, status: str):
+        if item.notify is not None:
+            try:
+                item.notify(item, status)
+            except Exception as e:
+                log.error(f"Error in playback notify: {e}")
+
+    def _play(self, item: PlaybackItem):
+        if self._port is None:
+            self._port = self._open_port(self.name)
+        port = self._port
+        self._notify(item, "started")
+        try:
+            Player(port.send, lateness=self.lateness).play(item.events, item.stop)
+        except Exception:
+            # Порт мог пропасть (устройство отключили) — переоткроем в следующий раз
+            self._port = None
+            with contextlib.suppress(Exception):
+                port.close()
+            raise
+        if item.stop.is_set():
+            # Снимаем зависшие ноты после прерывания
+            port.reset()
+            self._notify(item, "stopped")
+        else:
+            self._notify(item, "finished")
+
+    def _run(self):
+        while (item := self.queue.get()) is not self._STOP:
+            self.current = item
+            try:
+                self._play(item)
+            except Exception as e:
+                log.error(f"Error in DevicePlayer {self.name}: {e}")
+                self._notify(item, "failed")
+            finally:
+                self.current = None
+
+
+class PlayerService:
+    """
+    Воспроизведение в фоне: у каждого устройства своя очередь и поток,
+    вызывающий код (например, обработчики бота) не блокируется
+    """
+
+    def __init__(self, open_port=mido.open_output):
+        """
+        :param open_port: Функция, открывающая выходной порт по имени
+        """
+        self._open_port = open_port
+        self._devices = {}
+        self._lock = threading.Lock()
+        # Опоздание пачек относительно дедлайна на всех устройствах
+        self.lateness = Histogram()
+
+    def play(self, device: str, title: str, events: list, notify=None) -> int:
+        """
+        Ставит воспроизведение в очередь устройства
+        :param notify: Функция notify(item, status), status — started, finished, stopped или failed.
+        Вызывается из потока устройства
+        :return: Сколько элементов играет и ждёт перед этим
+        """
+        with self._lock:
+            player = self._devices.get(device)
+            if player is None:
+                player = self._devices[device] = DevicePlayer(device, self._open_port, self.lateness)
+        return player.put(PlaybackItem(title, events, notify))
+
+    def stop(self, device: str = None) -> int:
+        """
+        Останавливает воспроизведение и очищает очередь
+        :param device: Устройство, None — все
+        :return: Количество остановленных и отменённых элементов
+        """
+        with self._lock:
+            players = list(self._devices.values()) if device is None else [self._devices.get(device)]
+        return sum(player.stop() for player in players if player is not None)
+
+    def queue(self) -> dict[str, tuple]:
+        """
+        :return: Устройство -> (текущий элемент или None, ожидающие элементы),
+        только устройства, где что-то играет или ждёт
+        """
+        with self._lock:
+            players = list(self._devices.values())
+        state = {}
+        for player in players:
+            current, pending = player.current, player.pending()
+            if current is not None or pending:
+                state[player.name] = (current, pending)
+        return state
+
+    def close(self):
+        with self._lock:
+            players = list(self._devices.values())
+            self._devices.clear()
+        for player in players:
+            player.close()
@@ -0,0 +1,32 @@
+import pytest
+
+from data_engine import MidiLog, NS_PER_SEC
+
+# 2024-01-15 12:00 UTC
+T0 = 1_705_320_000 * NS_PER_SEC
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "midi_log.db")
+
+
+@pytest.fixture
+def midi_log(db_path):
+    db = MidiLog(db_path=db_path, render_workers=1)
+    yield db
+    db.close()
+
+
+def note(ts: int, pitch: int = 60, velocity: int = 64, device: str = "piano") -> tuple:
+    """Строка для MidiLog.write_rows: note_on на первом канале"""
+    return ts, device, bytes([0x90, pitch, velocity])
+
+
+def count_events(db: MidiLog) -> int:
+    with db.readers.cursor() as cur:
+        total = cur.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+        for month in db.shards.existing():
+            schema = db.shards.attach(cur.connection, [month], readonly=True)[0]
+            total += cur.execute(f"SELECT COUNT(*) FROM {schema}.events").fetchone()[0]
+    return total
@@ -0,0 +1,41 @@
+import os
+import zipfile
+
+from archive import SplitZipWriter
+
+
+def collect(writer: SplitZipWriter, files: list) -> list:
+    parts = []
+    for name, data in files:
+        parts.extend(writer.add(name, data))
+    last = writer.close()
+    if last:
+        parts.append(last)
+    return parts
+
+
+def test_parts_fit_limit():
+    limit = 64 * 1024
+    files = [(f"{n}.bin", os.urandom(5000)) for n in range(40)]
+    parts = collect(SplitZipWriter(limit=limit), files)
+
+    assert len(parts) > 1
+    names = []
+    for part in parts:
+        assert part.size <= limit
+        with zipfile.ZipFile(part.file) as archive:
+            names.extend(archive.namelist())
+            assert archive.namelist() == part.names
+        part.close()
+    assert names == [name for name, _ in files]
+
+
+def test_oversized_file_skipped():
+    limit = 16 * 1024
+    writer = SplitZipWriter(limit=limit)
+    parts = collect(writer, [("small.bin", os.urandom(1000)), ("big.bin", os.urandom(2 * limit)),
+                             ("tail.bin", os.urandom(1000))])
+
+    assert writer.skipped == ["big.bin"]
+    assert [part.names for part in parts] == [["small.bin"], ["tail.bin"]]
+    assert all(part.size <= limit for part in parts)
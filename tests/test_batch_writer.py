@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import T0, count_events, note
+from data_engine import BatchWriter, MidiLog
+
+
+@pytest.fixture
+def batch_log(db_path, monkeypatch):
+    monkeypatch.setattr(BatchWriter, "RETRY_DELAY", .001)
+    db = MidiLog(writer_mode="batch", db_path=db_path, render_workers=1)
+    yield db
+    db.close()
+
+
+def test_batch_is_written_on_flush(batch_log):
+    for i in range(10):
+        batch_log.writer.put(note(T0 + i))
+    assert batch_log.flush(timeout=5)
+    assert count_events(batch_log) == 10
+
+
+def test_failed_batch_is_rolled_back(midi_log):
+    # Второе событие нарушает NOT NULL: первое не должно остаться в БД
+    with pytest.raises(Exception):
+        midi_log.write_rows([note(T0), (T0 + 1, "piano", None)])
+    assert count_events(midi_log) == 0
+
+
+def test_persistent_error_drops_batch(batch_log, monkeypatch):
+    calls = []
+
+    def fail(data, **kwargs):
+        calls.append(len(data))
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(batch_log, "write_rows", fail)
+    batch_log.writer.put(note(T0))
+    batch_log.writer.put(note(T0 + 1))
+    assert batch_log.flush(timeout=5)
+    assert len(calls) == BatchWriter.MAX_ATTEMPTS
+    counters = batch_log.metrics.counters
+    assert counters["lost_events"] == 2
+    assert counters["write_errors"] == BatchWriter.MAX_ATTEMPTS
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.ports import fake_inputs
+from benchmarks.source import SyntheticSource
+from conftest import count_events
+from midi_logger import MidiLogApp
+
+
+def capture(db_path: str, capture_mode: str, limit: int = 200) -> MidiLogApp:
+    sources = {f"keys {n}": SyntheticSource(rate=1000, seed=n) for n in range(2)}
+    with fake_inputs(sources, limit=limit, speed=100) as inputs:
+        app = MidiLogApp(capture_mode, stats_port=None, db_path=db_path)
+        thread = threading.Thread(target=app.process, daemon=True)
+        thread.start()
+        for name in sources:
+            while name not in inputs.opened:
+                thread.join(.01)
+            assert inputs.opened[name].done.wait(10)
+        app.stop()
+        thread.join(10)
+    return app
+
+
+@pytest.mark.parametrize("capture_mode", ["callback", "poll"])
+def test_capture_records_devices_by_port_name(db_path, capture_mode):
+    app = capture(db_path, capture_mode)
+    try:
+        with app.midi_log.readers.cursor() as cur:
+            names = sorted(row[0] for row in cur.execute("SELECT name FROM devices"))
+        assert names == ["keys 0", "keys 1"]
+        assert count_events(app.midi_log) > 0
+        assert app.journal.pending == 0
+    finally:
+        app.close()
+
+
+def test_process_capture_joins_workers(db_path, monkeypatch):
+    monkeypatch.setattr(MidiLogApp, "PORT_CHECK_INTERVAL", .1)
+    sources = {f"keys {n}": SyntheticSource(rate=1000, seed=n) for n in range(2)}
+    with fake_inputs(sources, speed=100) as inputs:
+        app = MidiLogApp("process", stats_port=None, db_path=db_path, open_input=inputs)
+        thread = threading.Thread(target=app.process, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 30
+        while app.metrics.snapshot()["events"] < 1000 and time.monotonic() < deadline:
+            time.sleep(.05)
+        app.stop()
+        thread.join(30)
+    try:
+        assert not thread.is_alive()
+        snapshot = app.metrics.snapshot()
+        assert snapshot["gauges"]["capture_workers"] == 0
+        assert sorted(snapshot["ports"]) == ["keys 0", "keys 1"]
+        assert count_events(app.midi_log) == snapshot["events"]
+        assert "overflow" not in str(snapshot["gauges"]["dropped"])
+    finally:
+        app.close()
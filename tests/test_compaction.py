@@ -0,0 +1,60 @@
+import sqlite3
+
+from conftest import T0, count_events, note
+from data_engine import MidiLog, pack_events, render_midi, unpack_events
+
+
+def test_pack_events_roundtrip():
+    messages = [(T0 + 123, bytes([0x90, 60, 64])), (T0 + 457, bytes([0xF0, *range(1, 100), 0xF7])),
+                (T0 + 457, bytes([0xC0, 5]))]
+    assert unpack_events(pack_events(messages)) == messages
+    assert unpack_events(pack_events([])) == []
+
+
+def test_compaction_is_lossless(midi_log):
+    # Метки с точностью меньше миллисекунды не переживали сжатие в MIDI-файл
+    rows = [note(T0 + n * 1_234_567, pitch=60 + n % 12) for n in range(50)]
+    midi_log.write_rows(rows)
+    with midi_log.readers.cursor() as cur:
+        session_id, = cur.execute("SELECT id FROM sessions").fetchone()
+    exported = midi_log.get_midi_logs(0)
+
+    assert midi_log.compact_sessions(days=1) == 1
+    assert count_events(midi_log) == 0
+    with midi_log.readers.cursor() as cur:
+        assert midi_log._session_messages(cur, session_id) == [(ts, data) for ts, _, data in rows]
+    midi_log.cache.clear()
+    assert midi_log.get_midi_logs(0) == exported
+    assert midi_log.get_midi_logs(0)[0][1] == render_midi([(ts, data) for ts, _, data in rows])[0]
+
+
+def test_full_vacuum_only_on_request(db_path):
+    # База прежней версии: создана без auto_vacuum = INCREMENTAL
+    con = sqlite3.connect(db_path)
+    con.execute("CREATE TABLE legacy (id INTEGER PRIMARY KEY)")
+    con.close()
+
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        db.vacuum()
+        assert db.cur.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+        db.vacuum(full=True)
+        assert db.cur.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_full_vacuum_converts_shard(db_path):
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        db.write_rows([note(T0)])
+        path = db.shards.path("2024-01")
+    # Шард, созданный без auto_vacuum = INCREMENTAL
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA auto_vacuum = NONE")
+    con.execute("VACUUM")
+    con.close()
+
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        statements = []
+        db.con.set_trace_callback(statements.append)
+        db.vacuum(full=True)
+        assert [sql for sql in statements if sql.startswith("VACUUM")] == ["VACUUM shard_2024_01"]
+        schema = db.shards.attach(db.con, ["2024-01"])[0]
+        assert db.cur.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == 2
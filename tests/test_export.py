@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import data_engine
+from data_engine import AsyncMidiLog, MidiLog, NS_PER_SEC, ns_to_datetime, period_start
+
+from conftest import T0, note
+
+
+def test_timeout_stops_export(midi_log, monkeypatch):
+    # Десять сессий, разделённых паузой больше session_gap
+    gap = midi_log.session_gap * 2
+    midi_log.write_rows([note(T0 + n * gap) for n in range(10)])
+
+    rendered = []
+    render_midi = data_engine.render_midi
+
+    def slow_render(messages):
+        rendered.append(threading.get_ident())
+        time.sleep(.2)
+        return render_midi(messages)
+
+    monkeypatch.setattr(data_engine, "render_midi", slow_render)
+    async_log = AsyncMidiLog(midi_log)
+
+    async def export():
+        return [session async for session in async_log.iter_midi_logs(0, timeout=.3)]
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(export())
+    time.sleep(.5)
+    count = len(rendered)
+    time.sleep(.5)
+    assert len(rendered) == count < 10
+    async_log.executor.shutdown(wait=True)
+
+
+def test_parallel_render_matches_serial(db_path):
+    with MidiLog(db_path=db_path, render_workers=2) as db:
+        gap = db.session_gap * 2
+        db.write_rows([note(T0 + n * gap + k * NS_PER_SEC, pitch=60 + k)
+                       for n in range(MidiLog.PARALLEL_MIN_SESSIONS) for k in range(3)])
+        parallel = db.get_midi_logs(0)
+        db.cache.clear()
+        db.render_workers = 1
+        assert db.get_midi_logs(0) == parallel
+        assert db._render_pool is not None
+
+
+def test_summary_and_export_share_period(midi_log):
+    today = period_start(1)
+    yesterday = today - midi_log.session_gap * 2
+    midi_log.write_rows([note(yesterday), note(yesterday + NS_PER_SEC), note(today), note(today + 1)])
+
+    summary = midi_log.get_practice_summary(1)
+    assert list(summary) == [ns_to_datetime(today).date()]
+    assert summary[ns_to_datetime(today).date()][1] == 1
+    assert len(midi_log.get_midi_logs(1)) == 1
+
+    summary = midi_log.get_practice_summary(2)
+    assert [sessions for _, sessions, _ in summary.values()] == [1, 1]
+    assert len(midi_log.get_midi_logs(2)) == 2
+
+
+def test_export_includes_session_spanning_period_start(midi_log):
+    today = period_start(1)
+    gap = midi_log.session_gap
+    midi_log.write_rows([note(today - 3 * gap), note(today - gap // 4), note(today + gap // 4)])
+
+    files = midi_log.get_midi_logs(1)
+    assert [notes for _, _, notes, _, _ in files] == [2]
+    assert len(midi_log.get_midi_logs(1, input_name="piano")) == 1
+    assert len(midi_log.get_midi_logs(0)) == 2
+
+
+def test_explain_flags_range_without_lower_bound(midi_log, monkeypatch, caplog):
+    queries = {"sessions_before": "SELECT id FROM sessions WHERE start_ts < ? ORDER BY start_ts"}
+    monkeypatch.setattr(MidiLog, "QUERIES", {**MidiLog.QUERIES, **queries})
+    monkeypatch.setattr(MidiLog, "QUERY_SAMPLE_PARAMS", {**MidiLog.QUERY_SAMPLE_PARAMS, "sessions_before": (0,)})
+    midi_log.explain_queries()
+    assert [record.message for record in caplog.records if "lower bound" in record.message] == [
+        "Query sessions_before walks an index range without a lower bound: "
+        "SEARCH sessions USING COVERING INDEX idx_sessions_start (start_ts<?)"
+    ]
+
+
+def test_concurrent_exports_share_one_render_pool(midi_log, monkeypatch):
+    pools = []
+
+    class SlowPool(data_engine.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            time.sleep(.1)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(data_engine, "ProcessPoolExecutor", SlowPool)
+    midi_log.render_workers = 2
+    sessions = [[(T0, bytes([0x90, 60, 64]))]] * 2
+    threads = [threading.Thread(target=midi_log._render_many, args=(sessions,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pools) == 1
@@ -0,0 +1,63 @@
+import mido
+
+from data_engine import NS_PER_MS
+from ingest_filter import IngestFilter
+
+from conftest import T0
+
+
+def make_filter() -> tuple[IngestFilter, list]:
+    emitted = []
+    return IngestFilter(lambda name, msg, ts: emitted.append((msg, ts))), emitted
+
+
+def pitch(value: int) -> mido.Message:
+    return mido.Message("pitchwheel", pitch=value)
+
+
+def test_other_messages_keep_pending_values():
+    ingest_filter, emitted = make_filter()
+    note = mido.Message("note_on", note=60, velocity=64)
+    ingest_filter.add("piano", pitch(100), T0)
+    ingest_filter.add("piano", pitch(200), T0 + NS_PER_MS)
+    ingest_filter.add("piano", note, T0 + 2 * NS_PER_MS)
+
+    assert emitted == [(pitch(100), T0), (note, T0 + 2 * NS_PER_MS)]
+    ingest_filter.flush(T0 + 20 * NS_PER_MS)
+    assert emitted[-1] == (pitch(200), T0 + NS_PER_MS)
+
+
+def test_value_back_to_last_written_is_dropped():
+    ingest_filter, emitted = make_filter()
+    ingest_filter.add("piano", pitch(100), T0)
+    ingest_filter.add("piano", pitch(200), T0 + NS_PER_MS)
+    ingest_filter.add("piano", pitch(100), T0 + 2 * NS_PER_MS)
+    ingest_filter.flush()
+
+    assert emitted == [(pitch(100), T0)]
+    assert ingest_filter.dropped() == {"piano": {"pitchwheel": 2}}
+
+
+def test_short_lived_value_is_replaced():
+    ingest_filter, emitted = make_filter()
+    ingest_filter.add("piano", pitch(100), T0)
+    ingest_filter.add("piano", pitch(200), T0 + 8 * NS_PER_MS)
+    ingest_filter.add("piano", pitch(300), T0 + 12 * NS_PER_MS)
+
+    assert emitted == [(pitch(100), T0), (pitch(300), T0 + 12 * NS_PER_MS)]
+
+
+def test_long_interval_does_not_hold_back_expired_values():
+    emitted = []
+    ingest_filter = IngestFilter(lambda name, msg, ts: emitted.append((msg, ts)),
+                                 {"coalesce": {"pitchwheel": 100, "aftertouch": 10}})
+    touch = mido.Message("aftertouch", value=10)
+    ingest_filter.add("piano", pitch(100), T0)
+    ingest_filter.add("piano", pitch(200), T0 + NS_PER_MS)
+    ingest_filter.add("piano", mido.Message("aftertouch", value=5), T0 + NS_PER_MS)
+    ingest_filter.add("piano", touch, T0 + 2 * NS_PER_MS)
+
+    ingest_filter.flush(T0 + 20 * NS_PER_MS)
+    assert emitted[-1] == (touch, T0 + 2 * NS_PER_MS)
+    ingest_filter.flush(T0 + 200 * NS_PER_MS)
+    assert emitted[-1] == (pitch(200), T0 + NS_PER_MS)
@@ -0,0 +1,127 @@
+import shutil
+import struct
+
+import pytest
+
+from conftest import T0, count_events
+from data_engine import MidiLog, NS_PER_SEC
+from journal import Journal
+
+NOTE = bytes([0x90, 60, 64])
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return tmp_path / "midi_log.journal"
+
+
+def fill(journal: Journal, count: int, start: int = 0, name: str = "piano") -> list:
+    rows = [(T0 + (start + n) * NS_PER_SEC, name, NOTE) for n in range(count)]
+    for row in rows:
+        assert journal.append(*row)
+    return rows
+
+
+def drain(journal: Journal) -> list:
+    rows, _, end = journal.read(journal.checkpoint, 10 ** 6)
+    journal.advance(end, len(rows))
+    return rows
+
+
+def test_wrap_around(journal_path):
+    journal = Journal(journal_path, 1024)
+    written = []
+    for round_number in range(5):
+        written += fill(journal, 20, start=20 * round_number)
+        assert drain(journal) == written[-20:]
+    assert journal.write_pos > 3 * journal.capacity
+    assert journal.pending == 0
+    journal.close()
+
+
+def test_overflow(journal_path):
+    journal = Journal(journal_path, 1024)
+    accepted = 0
+    while journal.append(T0, "piano", NOTE):
+        accepted += 1
+    assert journal.overflow == 1
+    assert journal.stats()["pending"] == accepted
+
+    drain(journal)
+    assert journal.append(T0, "piano", NOTE)
+    journal.close()
+
+
+def test_recovers_records_past_write_pos(journal_path):
+    journal = Journal(journal_path, 4096)
+    rows = fill(journal, 10)
+    write_pos = journal.write_pos
+    # Падение между записью события и сдвигом write_pos в заголовке
+    first = journal.read(0, 1)[2]
+    struct.pack_into("<Q", journal._mm, Journal.WRITE_POS_OFFSET, first)
+    journal.close()
+
+    journal = Journal(journal_path, 4096)
+    assert journal.write_pos == write_pos
+    assert journal.pending == 10
+    assert drain(journal) == rows
+    journal.close()
+
+
+def test_skips_corrupted_records(journal_path):
+    journal = Journal(journal_path, 4096)
+    rows = fill(journal, 4)
+    _, positions, _ = journal.read(0, 4)
+    # Порча данных второй записи и заголовка четвёртой
+    journal._mm[Journal.HEADER_SIZE + positions[1] + Journal.RECORD.size] ^= 0xFF
+    journal._mm[Journal.HEADER_SIZE + positions[3]] ^= 0xFF
+    journal.close()
+
+    journal = Journal(journal_path, 4096)
+    assert journal.pending == 2
+    assert drain(journal) == [rows[0], rows[2]]
+    assert journal.corrupted == 2
+    assert journal.checkpoint == journal.write_pos
+    journal.close()
+
+
+def test_long_name_truncated_on_character_boundary(journal_path):
+    journal = Journal(journal_path, 4096)
+    journal.append(T0, "п" * 200, NOTE)
+    assert drain(journal) == [(T0, "п" * 127, NOTE)]
+    journal.close()
+
+
+def replay_batch(db_path: str, journal: Journal):
+    """Перенос пачки без сдвига checkpoint журнала: процесс упал сразу после commit"""
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        rows, positions, end = journal.read(journal.checkpoint, 10 ** 6)
+        db.write_rows(rows, journal=(journal.id, positions, end))
+
+
+def check_replayed(db_path: str, count: int):
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        assert count_events(db) == count
+        with db.readers.cursor() as cur:
+            assert cur.execute("SELECT COUNT(*), SUM(note_count) FROM sessions").fetchone() == (1, count)
+
+
+@pytest.mark.parametrize("lost", ["main", "shard"])
+def test_replay_after_partial_commit(tmp_path, db_path, journal_path, lost):
+    journal = Journal(journal_path, 64 * 1024)
+    fill(journal, 10)
+    replay_batch(db_path, journal)
+    drain(journal)
+    fill(journal, 10, start=10)
+
+    # Снимок файла до второй пачки: после неё он «потеряет» её commit
+    with MidiLog(db_path=db_path, render_workers=1) as db:
+        shard = db.shards.path(db.shards.month(T0))
+    path = db_path if lost == "main" else str(shard)
+    shutil.copy(path, tmp_path / "before.db")
+    replay_batch(db_path, journal)
+    shutil.copy(tmp_path / "before.db", path)
+
+    replay_batch(db_path, journal)
+    check_replayed(db_path, 20)
+    journal.close()
@@ -0,0 +1,35 @@
+import json
+import sqlite3
+
+from mido import Message
+
+from conftest import T0, note
+from data_engine import ns_to_datetime
+
+
+def test_legacy_port_repr_shares_device_with_capture(midi_log, db_path):
+    midi_log.write_rows([note(T0, device="Piano")])
+    # Старый захват в режиме опроса писал str(port) и время UTC без зоны
+    con = sqlite3.connect(db_path)
+    con.execute("""
+        CREATE TABLE midi_log (
+            ID INTEGER PRIMARY KEY,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            input_name varchar(128),
+            message_type varchar(128),
+            message varchar(255))
+    """)
+    msg = Message("note_on", note=62, velocity=64)
+    con.execute(
+        "INSERT INTO midi_log VALUES (NULL, ?, ?, ?, ?)",
+        (str(ns_to_datetime(T0 - 1_000_000_000).replace(tzinfo=None)), "<open input 'Piano' (RtMidi/ALSA)>",
+         msg.type, json.dumps(msg.dict()))
+    )
+    con.commit()
+    con.close()
+
+    assert midi_log.migrate_legacy(pause=0) == 1
+    with midi_log.readers.cursor() as cur:
+        assert cur.execute("SELECT name FROM devices").fetchall() == [("Piano",)]
+    session_id = midi_log.find_session(None, input_name="Piano")[0]
+    assert [data[1] for _, data in midi_log.get_note_events(session_id)] == [62, 60]
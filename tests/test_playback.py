@@ -0,0 +1,35 @@
+import threading
+
+from data_engine import NS_PER_MS
+from playback import Player, PlayerService
+
+
+class FakePort:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_spin_window_capped():
+    assert Player(print, spin_ns=10 ** 9).spin_ns == Player.MAX_SPIN_NS
+
+
+def test_service_collects_lateness():
+    port = FakePort()
+    service = PlayerService(open_port=lambda name: port)
+    done = threading.Event()
+    events = [(n * NS_PER_MS, f"msg {n}") for n in range(5)]
+    service.play("out", "test", events, lambda item, status: status == "finished" and done.set())
+    assert done.wait(5)
+    service.close()
+
+    assert port.sent == [message for _, message in events]
+    assert service.lateness.count == len(events)
@@ -0,0 +1,107 @@
+import hashlib
+
+import pytest
+
+from conftest import T0, note
+from data_engine import MidiLog, NS_PER_SEC
+
+
+def sessions(db: MidiLog) -> list:
+    with db.readers.cursor() as cur:
+        return cur.execute("SELECT start_ts, end_ts, note_count FROM sessions ORDER BY start_ts").fetchall()
+
+
+def test_sessions_split_by_gap(midi_log):
+    midi_log.write_rows([note(T0), note(T0 + 10 * NS_PER_SEC), note(T0 + 100 * NS_PER_SEC)])
+    assert sessions(midi_log) == [(T0, T0 + 10 * NS_PER_SEC, 2), (T0 + 100 * NS_PER_SEC, T0 + 100 * NS_PER_SEC, 1)]
+
+
+def test_rebuild_in_other_process_invalidates_open_sessions(midi_log, db_path):
+    midi_log.write_rows([note(T0), note(T0 + 10 * NS_PER_SEC), note(T0 + 100 * NS_PER_SEC)])
+
+    # manage.py rebuild-sessions при работающем логгере
+    with MidiLog(db_path=db_path, render_workers=1, session_gap=200) as other:
+        assert other.rebuild_sessions() == 1
+
+    midi_log.write_rows([note(T0 + 110 * NS_PER_SEC)])
+    assert sessions(midi_log) == [(T0, T0 + 110 * NS_PER_SEC, 4)]
+
+
+def file_digest(path) -> bytes:
+    return hashlib.sha256(path.read_bytes()).digest()
+
+
+def test_rebuild_reads_frozen_shards_without_writing(midi_log):
+    midi_log.write_rows([note(T0), note(T0 + 10 * NS_PER_SEC), note(T0 + 100 * NS_PER_SEC)])
+    assert midi_log.freeze_shards() == ["2024-01"]
+    path = midi_log.shards.path("2024-01")
+    digest = file_digest(path)
+
+    midi_log.session_gap = 200 * NS_PER_SEC
+    assert midi_log.rebuild_sessions() == 1
+    assert file_digest(path) == digest
+    assert sessions(midi_log) == [(T0, T0 + 100 * NS_PER_SEC, 3)]
+
+
+def test_late_event_for_frozen_month_goes_to_main(midi_log):
+    midi_log.write_rows([note(T0)])
+    midi_log.freeze_shards()
+    path = midi_log.shards.path("2024-01")
+    digest = file_digest(path)
+
+    midi_log.write_rows([note(T0 + NS_PER_SEC, pitch=62)])
+    assert file_digest(path) == digest
+    session_id = midi_log.find_session(None)[0]
+    assert [data[1] for _, data in midi_log.get_note_events(session_id)] == [60, 62]
+    assert midi_log.rebuild_sessions() == 1
+    assert sessions(midi_log) == [(T0, T0 + NS_PER_SEC, 2)]
+
+
+def test_failed_rebuild_keeps_old_sessions(midi_log, monkeypatch):
+    midi_log.write_rows([note(T0), note(T0 + 100 * NS_PER_SEC)])
+    before = sessions(midi_log)
+
+    def fail(cur):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(midi_log, "_rebuild_daily_stats", fail)
+    midi_log.session_gap = 200 * NS_PER_SEC
+    with pytest.raises(RuntimeError):
+        midi_log.rebuild_sessions()
+    assert sessions(midi_log) == before
+    assert midi_log.con.in_transaction is False
+
+
+def test_rebuild_in_chunks_matches_single_pass(midi_log, monkeypatch):
+    # Паузы 30 и 90 с: при session_gap 60 с получаются сессии по 2, 3 и 1 событию
+    offsets = [0, 30, 120, 150, 180, 270]
+    midi_log.write_rows([note(T0 + offset * NS_PER_SEC, pitch=60 + n) for n, offset in enumerate(offsets)])
+    expected = sessions(midi_log)
+    assert midi_log.rebuild_sessions() == 3
+    assert sessions(midi_log) == expected
+
+    monkeypatch.setattr(MidiLog, "REBUILD_CHUNK_SIZE", 2)
+    assert midi_log.rebuild_sessions() == 3
+    assert sessions(midi_log) == expected
+    stats = midi_log.get_session_stats(midi_log.find_session(None)[0] - 1)
+    assert stats["note_count"] == 3 and stats["presses"] == 3
+
+
+def test_running_logger_and_bot_pick_up_rebuilt_gap(midi_log, db_path):
+    midi_log.write_rows([note(T0)])
+    with MidiLog(db_path=db_path, render_workers=1, session_gap=200) as other:
+        other.rebuild_sessions()
+
+    midi_log.find_session(None)
+    assert midi_log.session_gap == 200 * NS_PER_SEC
+    midi_log.write_rows([note(T0 + 150 * NS_PER_SEC)])
+    assert sessions(midi_log) == [(T0, T0 + 150 * NS_PER_SEC, 2)]
+
+
+def test_freeze_after_read(midi_log):
+    midi_log.write_rows([note(T0)])
+    # Читатель пула держит шард подключённым после запроса
+    assert len(midi_log.get_midi_logs(0)) == 1
+    assert midi_log.freeze_shards() == ["2024-01"]
+    assert not midi_log.shards.writable("2024-01")
+    assert len(midi_log.get_midi_logs(0)) == 1
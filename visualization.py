@@ -0,0 +1,133 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from data_engine import AsyncMidiLog, MidiLog, NS_PER_SEC, SessionCache, ns_to_datetime
+
+log = logging.getLogger()
+
+
+def extract_notes(events: list, start_ts: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Достаёт нажатия нот из трёхбайтовых событий без разбора каждого сообщения
+    :param events: Список (ts в наносекундах, 3 байта сообщения)
+    :param start_ts: Начало сессии
+    :return: Время от начала сессии в секундах и номера нот
+    """
+    if not events:
+        return np.empty(0), np.empty(0, dtype=np.uint8)
+    timestamps, payloads = zip(*events)
+    ts = np.fromiter(timestamps, dtype=np.int64, count=len(events))
+    data = np.frombuffer(b"".join(payloads), dtype=np.uint8).reshape(-1, 3)
+    # note_on с ненулевой скоростью; note_on с velocity=0 — это отпускание
+    mask = ((data[:, 0] & 0xF0) == 0x90) & (data[:, 2] > 0)
+    return (ts[mask] - start_ts) / NS_PER_SEC, data[mask, 1]
+
+
+def render_notes_png(times: np.ndarray, notes: np.ndarray, title: str) -> bytes:
+    """Рисует ноты на отдельной Agg-фигуре, без глобального состояния pyplot"""
+    figure = Figure(figsize=(10, 5))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    ax.scatter(times, notes, alpha=0.5)
+    ax.set_title(title)
+    ax.set_xlabel("Время (секунды)")
+    ax.set_ylabel("Высота ноты")
+    ax.grid(True)
+
+    with io.BytesIO() as plot_buffer:
+        figure.savefig(plot_buffer, format='png')
+        return plot_buffer.getvalue()
+
+
+class NotesImage:
+    """Готовая визуализация сессии"""
+
+    def __init__(self, session_id: int, png: bytes, notes_count: int, formatted_date: str, formatted_time: str):
+        self.session_id = session_id
+        self.png = png
+        self.notes_count = notes_count
+        self.formatted_date = formatted_date
+        self.formatted_time = formatted_time
+
+
+class NoteRenderer:
+    """
+    Визуализация нот для /notes: события читаются в пуле AsyncMidiLog,
+    рисование идёт в пуле процессов, PNG закрытых сессий кешируются
+    """
+    CACHE_DIR = "notes"
+    CACHE_MEMORY_BYTES = 16 * 1024 * 1024
+    CACHE_DISK_BYTES = 128 * 1024 * 1024
+
+    def __init__(self, db: AsyncMidiLog, workers: int = 2):
+        """
+        :param db: Асинхронный доступ к БД
+        :param workers: Процессов для рисования
+        """
+        self.db = db
+        midi_log = db.midi_log
+        self.cache = SessionCache(
+            Path(midi_log.db_path).parent / MidiLog.CACHE_DIR / self.CACHE_DIR,
+            self.CACHE_MEMORY_BYTES, self.CACHE_DISK_BYTES, suffix=".png"
+        )
+        # Поколение сессий, для которого действителен кеш: после пересборки id сессий меняются
+        self.generation = midi_log.generation
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(MidiLog.PROCESS_START_METHOD)
+        )
+
+    def _load(self, session_id: int, input_name: str = None):
+        """
+        Синхронная часть: сессия, PNG из кеша или массивы нот
+        :return: (строка sessions, ключ кеша, PNG или None, время, ноты) или None
+        """
+        midi_log = self.db.midi_log
+        row = midi_log.find_session(session_id, input_name)
+        if not row:
+            return None
+        # find_session уже сверил поколение сессий с БД
+        if self.generation != midi_log.generation:
+            self.cache.clear()
+            self.generation = midi_log.generation
+        key = (row[0], row[3], row[4])
+        png = self.cache.get(key)
+        if png is not None:
+            return row, key, png, None, None
+        times, notes = extract_notes(midi_log.get_note_events(row[0]), row[1])
+        return row, key, None, times, notes
+
+    async def render(self, session_id: int = None, input_name: str = None):
+        """
+        :param session_id: id сессии, None — последняя
+        :param input_name: Фильтр по устройству (опционально)
+        :return: NotesImage (png=None, если нот нет) или None, если сессия не найдена
+        """
+        loaded = await self.db.run(self._load, session_id, input_name)
+        if loaded is None:
+            return None
+        row, key, png, times, notes = loaded
+        session_id, start_ts, _, _, _, notes_count = row
+
+        if png is None and len(notes):
+            loop = asyncio.get_running_loop()
+            png = await asyncio.wait_for(
+                loop.run_in_executor(
+                    self.executor, render_notes_png, times, notes, f"Визуализация нот сессии {session_id}"
+                ),
+                self.db.timeout
+            )
+            self.cache.put(key, png, persistent=self.db.midi_log.is_closed(row))
+
+        start_time = ns_to_datetime(start_ts)
+        return NotesImage(session_id, png, notes_count, start_time.strftime("%d.%m.%Y"), start_time.strftime("%H:%M"))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)